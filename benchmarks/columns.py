@@ -0,0 +1,72 @@
+"""
+Memory and time of exporting fields of query results into NumPy arrays with
+to_columns(), against building model instances and copying their fields by
+hand; needs NumPy but no database.
+
+    python benchmarks/columns.py [number of documents]
+"""
+
+from __future__ import print_function
+
+import gc
+import sys
+import time
+import tracemalloc
+
+import numpy
+
+from remodel.columns import to_columns
+from remodel.models import Model
+
+
+class Visit(Model):
+    pass
+
+
+def docs(count):
+    # Stands in for the cursor, yielding documents as they are decoded
+    for i in range(count):
+        doc = {'id': str(i), 'url': '/page/%d' % (i % 50), 'duration': i * 0.5,
+               'clicks': i % 20}
+        if i % 10:
+            doc['score'] = i % 7
+        yield doc
+
+
+def by_hand(count):
+    visits = [Visit.objects._wrap(doc) for doc in docs(count)]
+    return {
+        'duration': numpy.array([v['duration'] for v in visits], 'f8'),
+        'clicks': numpy.array([v['clicks'] for v in visits], 'i8'),
+        'score': numpy.ma.masked_invalid(numpy.array(
+            [v.get('score', numpy.nan) for v in visits], 'f8')),
+    }
+
+
+def columns(count):
+    return to_columns(docs(count), ['duration', 'clicks', 'score'],
+                      {'duration': 'f8', 'clicks': 'i8', 'score': 'i8'})
+
+
+def measure(export, count):
+    gc.collect()
+    start = time.time()
+    export(count)
+    elapsed = time.time() - start
+    # Traced separately, as tracing slows allocations down
+    tracemalloc.start()
+    export(count)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main(count):
+    for name, export in (('by hand', by_hand), ('to_columns', columns)):
+        elapsed, peak = measure(export, count)
+        print('%-10s %6.2f us/document, peak %6.1f MB' %
+              (name, elapsed / count * 1e6, peak / 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
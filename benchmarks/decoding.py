@@ -0,0 +1,55 @@
+"""
+Cost of reading query results with two TIME fields, decoded natively or with
+the raw time_format (converted when a field is first read); needs no
+database.
+
+    python benchmarks/decoding.py [number of documents]
+"""
+
+from __future__ import print_function
+
+import json
+import sys
+import timeit
+
+from rethinkdb.net import ReQLDecoder
+
+from remodel.models import Model
+
+
+class Visit(Model):
+    pass
+
+
+def time(epoch):
+    return {'$reql_type$': 'TIME', 'epoch_time': epoch, 'timezone': '+00:00'}
+
+
+def response(count):
+    return json.dumps({'t': 2, 'r': [
+        {'id': str(i), 'url': '/page/%d' % (i % 50), 'visited_at': time(1500000000 + i),
+         'left_at': time(1500000060 + i)}
+        for i in range(count)]})
+
+
+def main(count):
+    data = response(count)
+    for name, decoder in (('native', ReQLDecoder({})),
+                          ('raw', ReQLDecoder({'time_format': 'raw'}))):
+        decode = lambda: decoder.decode(data)['r']
+        best = min(timeit.repeat(decode, number=1, repeat=5))
+        print('%-6s %6.2f us/document decoded' % (name, best / count * 1e6))
+        for read in (0, 1, 2):
+            def load():
+                for visit in map(Visit.objects._wrap, decode()):
+                    if read:
+                        visit['visited_at']
+                    if read == 2:
+                        visit['left_at']
+            best = min(timeit.repeat(load, number=1, repeat=5))
+            print('%-6s %6.2f us/document loaded, %d time(s) read' %
+                  (name, best / count * 1e6, read))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,65 @@
+"""
+Memory and field access cost of hydrated instances, with and without a
+declared fields schema; needs no database.
+
+    python benchmarks/fields.py [number of instances]
+"""
+
+from __future__ import print_function
+
+import gc
+import sys
+import timeit
+import tracemalloc
+
+from remodel.models import Model
+
+
+class User(Model):
+    pass
+
+
+class CompactUser(Model):
+    fields = ('name', 'email', 'age', 'created_at')
+
+
+def doc(i):
+    return {'id': str(i), 'name': 'user %d' % i, 'email': 'user%d@example.com' % i,
+            'age': i % 100, 'created_at': 1500000000 + i}
+
+
+def hydrate(model_cls, docs):
+    return [model_cls.objects._wrap(d) for d in docs]
+
+
+def memory(model_cls, docs):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objs = hydrate(model_cls, docs)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # Field values are shared with docs, so this is the mapping overhead
+    return (after - before) / float(len(objs))
+
+
+def main(count):
+    docs = [doc(i) for i in range(count)]
+    for model_cls in (User, CompactUser):
+        name = model_cls.__name__
+        print('%-12s %8.0f bytes/instance' % (name, memory(model_cls, docs)))
+        best = min(timeit.repeat(lambda: hydrate(model_cls, docs), number=1, repeat=10))
+        print('%-12s %8.2f us/hydration' % (name, best / count * 1e6))
+        objs = hydrate(model_cls, docs)
+
+        def read():
+            for obj in objs:
+                obj['name']
+                obj['email']
+                obj['age']
+        best = min(timeit.repeat(read, number=1, repeat=5))
+        print('%-12s %8.2f us/field read' % (name, best / count / 3 * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,58 @@
+"""
+Memory and throughput of read-only records against model instances built
+by the normal _wrap() path; needs no database.
+
+    python benchmarks/records.py [number of documents]
+"""
+
+from __future__ import print_function
+
+import gc
+import sys
+import timeit
+import tracemalloc
+
+from remodel.models import Model
+from remodel.records import record_wrapper
+
+
+class User(Model):
+    pass
+
+
+def doc(i):
+    return {'id': str(i), 'name': 'user %d' % i, 'email': 'user%d@example.com' % i,
+            'age': i % 100, 'created_at': 1500000000 + i}
+
+
+def memory(wrap, docs):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objs = [wrap(d) for d in docs]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # Field values are shared with docs, so this is the mapping overhead
+    return (after - before) / float(len(objs))
+
+
+def main(count):
+    docs = [doc(i) for i in range(count)]
+    for name, wrap in (('instances', User.objects._wrap),
+                       ('records', record_wrapper(User))):
+        print('%-10s %8.0f bytes/document' % (name, memory(wrap, docs)))
+        best = min(timeit.repeat(lambda: [wrap(d) for d in docs], number=1, repeat=5))
+        print('%-10s %8.2f us/document' % (name, best / count * 1e6))
+        objs = [wrap(d) for d in docs]
+
+        def read():
+            for obj in objs:
+                obj['name']
+                obj['email']
+                obj['age']
+        best = min(timeit.repeat(read, number=1, repeat=5))
+        print('%-10s %8.2f us/field read' % (name, best / count / 3 * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,69 @@
+"""
+Microbenchmark of relation access on hydrated instances; needs no database.
+
+    python benchmarks/relations.py [number of instances]
+"""
+
+from __future__ import print_function
+
+import sys
+import timeit
+
+from remodel.models import Model
+
+
+class Artist(Model):
+    has_many = ('Song',)
+    has_and_belongs_to_many = ('Taste',)
+
+
+class Song(Model):
+    belongs_to = ('Artist',)
+
+
+class Taste(Model):
+    has_and_belongs_to_many = ('Artist',)
+
+
+def hydrate(model_cls, count):
+    return [model_cls.objects._wrap({'id': str(i), 'artist_id': str(i)})
+            for i in range(count)]
+
+
+def bench(name, func, count, repeat=5):
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+    print('%-32s %8.2f us/instance' % (name, best / count * 1e6))
+
+
+def main(count):
+    def first_access(model_cls, field):
+        def run():
+            for obj in hydrate(model_cls, count):
+                obj[field]
+        return run
+
+    def cached_access(objs, field):
+        def run():
+            for obj in objs:
+                obj[field]
+        return run
+
+    def hydrate_only(model_cls):
+        return lambda: hydrate(model_cls, count)
+
+    bench('hydrate Artist', hydrate_only(Artist), count)
+    bench('has_many, first access', first_access(Artist, 'songs'), count)
+    bench('habtm, first access', first_access(Artist, 'tastes'), count)
+    artists = hydrate(Artist, count)
+    for artist in artists:
+        artist['songs']
+    bench('has_many, cached access', cached_access(artists, 'songs'), count)
+    songs = hydrate(Song, count)
+    for song in songs:
+        # Avoid the database: assign instead of loading
+        song.fields._artist_cache = None
+    bench('belongs_to, cached access', cached_access(songs, 'artist'), count)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -1 +1,5 @@
 import remodel.monkey
+from remodel.connection import noreply_wait
+
+# Waits for all noreply writes sent so far
+flush = noreply_wait
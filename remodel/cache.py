@@ -0,0 +1,598 @@
+import base64
+import calendar
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from copy import deepcopy
+from datetime import datetime
+from threading import RLock
+from time import time
+from weakref import WeakValueDictionary
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from rethinkdb.net import ReQLEncoder
+
+
+class DocumentCache(object):
+    """
+    In-process LRU cache of raw documents, keyed by primary key. Assign an
+    instance to a model's ``cache`` attribute to have ``Model.get(id)`` served
+    from memory.
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = RLock()
+        # Bumped by every write, so that documents read meanwhile are dropped
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key):
+        with self._lock:
+            try:
+                doc = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # Re-insert so that the entry becomes the most recently used one
+            self._data[key] = doc
+            self.hits += 1
+        # Hand out copies so that callers can't alter the cached document
+        return deepcopy(doc)
+
+    def version(self):
+        """
+        Returns a token to be passed to set() along with a document read from
+        the database, so that it is not cached if the cache was written to
+        (or invalidated) meanwhile.
+        """
+
+        return self._version
+
+    def set(self, key, doc, version=None):
+        doc = deepcopy(doc)
+        with self._lock:
+            if version is not None and version != self._version:
+                return
+            if version is None:
+                # A newer document than any being read
+                self._version += 1
+            self._data.pop(key, None)
+            self._data[key] = doc
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._version += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data), 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses}
+
+
+class NegativeCache(object):
+    """
+    Remembers, for ttl seconds, the get() lookups which found no document,
+    either by id or by field values. Entries are discarded as soon as a
+    matching document is saved.
+    """
+
+    def __init__(self, ttl=5, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        # id -> expiry time
+        self._ids = OrderedDict()
+        # frozenset of (field, value) pairs -> expiry time
+        self._lookups = OrderedDict()
+        self._lock = RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._ids) + len(self._lookups)
+
+    def is_missing(self, id_=None, kwargs=None):
+        entries, key = self._entries_for(id_, kwargs)
+        with self._lock:
+            expires = entries.get(key) if key is not None else None
+            if expires is None or expires <= time():
+                if expires is not None:
+                    del entries[key]
+                self.misses += 1
+                return False
+            self.hits += 1
+            return True
+
+    def add(self, id_=None, kwargs=None):
+        entries, key = self._entries_for(id_, kwargs)
+        if key is None:
+            return
+        with self._lock:
+            entries.pop(key, None)
+            entries[key] = time() + self.ttl
+            while len(entries) > self.max_size:
+                entries.popitem(last=False)
+
+    def discard(self, doc):
+        with self._lock:
+            self._ids.pop(doc.get('id'), None)
+            # Lookups are few (max_size) and short-lived, so a scan will do
+            for key in [key for key in self._lookups
+                        if all(field in doc and doc[field] == value
+                               for field, value in key)]:
+                del self._lookups[key]
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+            self._lookups.clear()
+
+    def stats(self):
+        return {'size': len(self), 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses}
+
+    def _entries_for(self, id_, kwargs):
+        if id_:
+            return self._ids, id_
+        try:
+            key = frozenset((kwargs or {}).items())
+        except TypeError:
+            # Unhashable values (e.g. lists) can't be remembered
+            return self._lookups, None
+        return self._lookups, key
+
+
+class DocumentEncoder(json.JSONEncoder):
+    """
+    Encodes documents as JSON, turning times and binaries back into the
+    pseudo-types the server sends.
+    """
+
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            offset = obj.utcoffset()
+            if offset is None:
+                raise TypeError('Cannot encode %r: datetime has no timezone' % obj)
+            minutes = offset.days * 1440 + offset.seconds // 60
+            return {'$reql_type$': 'TIME',
+                    'epoch_time': (calendar.timegm(obj.utctimetuple()) +
+                                   obj.microsecond / 1000000.0),
+                    'timezone': '%s%02d:%02d' % ('-' if minutes < 0 else '+',
+                                                 abs(minutes) // 60, abs(minutes) % 60)}
+        if isinstance(obj, bytes):
+            return {'$reql_type$': 'BINARY',
+                    'data': base64.b64encode(obj).decode('ascii')}
+        return super(DocumentEncoder, self).default(obj)
+
+
+class SharedMemoryCache(object):
+    """
+    Document cache living in a memory-mapped file, shared by all processes on
+    the host which open it under the same name. Offers the same interface as
+    DocumentCache, so it can be assigned to a model's ``cache`` attribute.
+
+    The segment is split into fixed-size slots, grouped in buckets of
+    ``ways`` slots; a document is stored in its key's bucket, evicting the
+    least recently used slot. Documents larger than a slot aren't cached.
+    clear() bumps a generation number, invalidating every slot at once.
+
+    Documents are stored as JSON, so reading them never runs code, and come
+    back with times and binaries as raw pseudo-types, which model fields
+    convert when first read. The file must belong to the current user and
+    be accessible to no one else.
+    """
+
+    MAGIC = b'RMDLSHM3'
+    # magic, generation, slots, slot size, version (see DocumentCache.version)
+    HEADER = struct.Struct('<8sQIIQ')
+    # key hash, generation, last used (microseconds), key length, data length
+    SLOT_HEADER = struct.Struct('<QQQII')
+    LAST_USED = struct.Struct('<Q')
+    encoder = DocumentEncoder(separators=(',', ':'))
+
+    def __init__(self, name, slots=4096, slot_size=4096, ways=8, path=None):
+        if fcntl is None:
+            raise RuntimeError('SharedMemoryCache requires a POSIX system')
+        if slot_size <= self.SLOT_HEADER.size:
+            raise ValueError('slot_size must be larger than %d bytes' %
+                             self.SLOT_HEADER.size)
+        self.name = name
+        self.ways = ways
+        self.buckets = max(1, slots // ways)
+        self.slots = self.buckets * ways
+        self.slot_size = slot_size
+        if path is None:
+            directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+            path = os.path.join(directory, 'remodel-%s' % name)
+        self.path = path
+        self.size = self.HEADER.size + self.slots * slot_size
+        self._lock = RLock()
+        self._fd = None
+        self._mmap = None
+        self.hits = 0
+        self.misses = 0
+        self.oversized = 0
+        self._open()
+
+    def __len__(self):
+        with self._locked(exclusive=False):
+            generation = self._generation()
+            return sum(1 for index in range(self.slots)
+                       if self._valid(self._read_slot_header(index), generation))
+
+    def __contains__(self, key):
+        key_bytes = self._dump_key(key)
+        with self._locked(exclusive=False):
+            return self._find(self._hash(key_bytes), key_bytes,
+                              self._generation()) is not None
+
+    def get(self, key):
+        key_bytes = self._dump_key(key)
+        key_hash = self._hash(key_bytes)
+        with self._locked(exclusive=False):
+            index = self._find(key_hash, key_bytes, self._generation())
+            if index is None:
+                self.misses += 1
+                return None
+            _, _, _, key_len, data_len = self._read_slot_header(index)
+            start = self._offset(index) + self.SLOT_HEADER.size + key_len
+            data = self._mmap[start:start + data_len]
+            # Racing readers may overwrite each other's timestamp; that only
+            # makes eviction slightly less accurate
+            self.LAST_USED.pack_into(self._mmap, self._offset(index) + 16,
+                                     int(time() * 1000000))
+            self.hits += 1
+        return json.loads(data.decode('utf-8'))
+
+    def version(self):
+        with self._locked(exclusive=False):
+            return self._version()
+
+    def set(self, key, doc, version=None):
+        key_bytes = self._dump_key(key)
+        key_hash = self._hash(key_bytes)
+        data = self.encoder.encode(doc).encode('utf-8')
+        if len(key_bytes) + len(data) > self.slot_size - self.SLOT_HEADER.size:
+            self.oversized += 1
+            if version is None:
+                self.delete(key)
+            return
+        with self._locked(exclusive=True):
+            if version is not None and version != self._version():
+                return
+            if version is None:
+                self._bump_version()
+            generation = self._generation()
+            index = self._find(key_hash, key_bytes, generation)
+            if index is None:
+                index = self._victim(key_hash, generation)
+            start = self._offset(index) + self.SLOT_HEADER.size
+            self._mmap[start:start + len(key_bytes)] = key_bytes
+            start += len(key_bytes)
+            self._mmap[start:start + len(data)] = data
+            self._write_slot_header(index, key_hash, generation,
+                                    len(key_bytes), len(data))
+
+    def delete(self, key):
+        key_bytes = self._dump_key(key)
+        with self._locked(exclusive=True):
+            self._bump_version()
+            index = self._find(self._hash(key_bytes), key_bytes, self._generation())
+            if index is not None:
+                self._write_slot_header(index, 0, 0, 0, 0)
+
+    def clear(self):
+        with self._locked(exclusive=True):
+            self.HEADER.pack_into(self._mmap, 0, self.MAGIC, self._generation() + 1,
+                                  self.slots, self.slot_size, self._version() + 1)
+
+    def stats(self):
+        return {'size': len(self), 'max_size': self.slots,
+                'hits': self.hits, 'misses': self.misses,
+                'oversized': self.oversized}
+
+    def close(self):
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def unlink(self):
+        self.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _open(self):
+        self._pid = os.getpid()
+        self._fd = self._open_file()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < self.size:
+                os.ftruncate(self._fd, self.size)
+            self._mmap = mmap.mmap(self._fd, self.size)
+            magic, _, slots, slot_size, _ = self.HEADER.unpack_from(self._mmap, 0)
+            if magic != self.MAGIC:
+                # Generations start at 1, so that zeroed slots are invalid
+                self.HEADER.pack_into(self._mmap, 0, self.MAGIC, 1,
+                                      self.slots, self.slot_size, 0)
+            elif (slots, slot_size) != (self.slots, self.slot_size):
+                raise ValueError('Shared cache %s has a different layout '
+                                 '(%d slots of %d bytes)' % (self.path, slots, slot_size))
+        except Exception:
+            self.close()
+            raise
+        finally:
+            if self._fd is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _open_file(self):
+        # The file lives in a world-writable directory under a predictable
+        # name, so it may have been created by someone else
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0),
+                     0o600)
+        stat = os.fstat(fd)
+        if stat.st_uid != os.geteuid() or stat.st_mode & 0o077:
+            os.close(fd)
+            raise ValueError('Shared cache %s must belong to the current user '
+                             'and be accessible to no one else' % self.path)
+        return fd
+
+    @contextmanager
+    def _locked(self, exclusive):
+        with self._lock:
+            if self._pid != os.getpid():
+                # flock() locks belong to the open file description, which
+                # is shared with the parent after a fork, so reopen the file
+                os.close(self._fd)
+                self._fd = self._open_file()
+                self._pid = os.getpid()
+            fcntl.flock(self._fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _generation(self):
+        return self.HEADER.unpack_from(self._mmap, 0)[1]
+
+    def _version(self):
+        return self.HEADER.unpack_from(self._mmap, 0)[4]
+
+    def _bump_version(self):
+        # Must be called with the exclusive lock held
+        magic, generation, slots, slot_size, version = self.HEADER.unpack_from(self._mmap, 0)
+        self.HEADER.pack_into(self._mmap, 0, magic, generation, slots, slot_size,
+                              version + 1)
+
+    def _offset(self, index):
+        return self.HEADER.size + index * self.slot_size
+
+    def _read_slot_header(self, index):
+        return self.SLOT_HEADER.unpack_from(self._mmap, self._offset(index))
+
+    def _write_slot_header(self, index, key_hash, generation, key_len, data_len):
+        self.SLOT_HEADER.pack_into(self._mmap, self._offset(index), key_hash,
+                                   generation, int(time() * 1000000),
+                                   key_len, data_len)
+
+    def _valid(self, slot_header, generation):
+        return slot_header[0] != 0 and slot_header[1] == generation
+
+    def _find(self, key_hash, key_bytes, generation):
+        first = (key_hash % self.buckets) * self.ways
+        for index in range(first, first + self.ways):
+            slot_header = self._read_slot_header(index)
+            if slot_header[0] == key_hash and slot_header[1] == generation:
+                start = self._offset(index) + self.SLOT_HEADER.size
+                if self._mmap[start:start + slot_header[3]] == key_bytes:
+                    return index
+        return None
+
+    def _victim(self, key_hash, generation):
+        first = (key_hash % self.buckets) * self.ways
+        victim, victim_last_used = None, None
+        for index in range(first, first + self.ways):
+            slot_header = self._read_slot_header(index)
+            if not self._valid(slot_header, generation):
+                return index
+            if victim is None or slot_header[2] < victim_last_used:
+                victim, victim_last_used = index, slot_header[2]
+        return victim
+
+    def _dump_key(self, key):
+        return self.encoder.encode(key).encode('utf-8')
+
+    def _hash(self, key_bytes):
+        digest = hashlib.sha1(key_bytes).digest()[:8]
+        # 0 marks empty slots
+        return struct.unpack('<Q', digest)[0] or 1
+
+
+class IdentityMap(object):
+    """
+    Keeps track of the live instances of a model, so that every document is
+    represented by at most one object at a time. Entries go away as soon as
+    the instances are garbage collected.
+    """
+
+    def __init__(self):
+        self._data = WeakValueDictionary()
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key):
+        return self._data.get(key)
+
+    def add(self, key, obj):
+        with self._lock:
+            self._data[key] = obj
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class QueryCache(object):
+    """
+    Caches the documents returned by read-only queries, keyed by the
+    serialized query. Entries expire after their TTL, or as soon as a write is
+    made through remodel to any of the tables they were read from.
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        # key -> (tables, expiry time, documents)
+        self._data = OrderedDict()
+        self._keys_by_table = defaultdict(set)
+        self._generations = defaultdict(int)
+        self._lock = RLock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                tables, expires, docs = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires <= time():
+                self._unlink(key, tables)
+                self.misses += 1
+                return None
+            self._data[key] = (tables, expires, docs)
+            self.hits += 1
+        return deepcopy(docs)
+
+    def generation(self, tables):
+        """
+        Returns a token to be passed to set(), so that results read while a
+        table was being written to are not cached.
+        """
+
+        with self._lock:
+            return tuple(self._generations[table] for table in tables)
+
+    def set(self, key, tables, docs, ttl, generation=None):
+        docs = deepcopy(docs)
+        with self._lock:
+            if generation is not None and generation != self.generation(tables):
+                return
+            if key in self._data:
+                self._unlink(key, self._data.pop(key)[0])
+            self._data[key] = (tables, time() + ttl, docs)
+            for table in tables:
+                self._keys_by_table[table].add(key)
+            while len(self._data) > self.max_size:
+                old_key, (old_tables, _, _) = self._data.popitem(last=False)
+                self._unlink(old_key, old_tables)
+
+    def invalidate(self, table):
+        with self._lock:
+            self._generations[table] += 1
+            keys = self._keys_by_table.pop(table, ())
+            for key in keys:
+                entry = self._data.pop(key, None)
+                if entry is not None:
+                    self._unlink(key, entry[0])
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            for table in list(self._keys_by_table):
+                self._generations[table] += 1
+            self._data.clear()
+            self._keys_by_table.clear()
+
+    def stats(self):
+        return {'size': len(self._data), 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses,
+                'invalidations': self.invalidations}
+
+    def _unlink(self, key, tables):
+        # Drops an entry, already popped from _data, from the table index
+        for table in tables:
+            keys = self._keys_by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_table[table]
+
+
+# Shared by all ObjectSet.cached() queries
+query_cache = QueryCache()
+
+
+# Term types of ReQL functions and of their variables
+FUNC, VAR = 69, 10
+
+
+def query_key(query):
+    """
+    Serializes query into a query cache key. The driver numbers function
+    variables from a global counter, so they are renumbered in order of
+    appearance, making the keys of queries built alike equal.
+    """
+
+    variables = {}
+
+    def normalize(term):
+        if isinstance(term, list):
+            term_type, args = term[0], term[1]
+            if term_type == FUNC:
+                # [FUNC, [[MAKE_ARRAY, [variable ids]], body]]
+                (array_type, var_ids), body = args
+                var_ids = [variables.setdefault(var_id, len(variables) + 1)
+                           for var_id in var_ids]
+                return [FUNC, [[array_type, var_ids], normalize(body)]]
+            if term_type == VAR:
+                return [VAR, [variables.get(args[0], args[0])]]
+            return [term_type, [normalize(arg) for arg in args]] + [
+                normalize(optargs) for optargs in term[2:]]
+        if isinstance(term, dict):
+            return dict((key, normalize(value)) for key, value in term.items())
+        return term
+
+    return json.dumps(normalize(json.loads(ReQLEncoder().encode(query))),
+                      sort_keys=True, separators=(',', ':'))
@@ -0,0 +1,273 @@
+from collections import OrderedDict
+from threading import Event, RLock, Thread
+
+import rethinkdb as r
+
+from .cache import query_cache
+from .connection import pool
+
+
+class ChangefeedThread(Thread):
+    """
+    Base class for threads consuming a changefeed. The feed holds on to its
+    own connection, outside of the connection pool, and is reestablished with
+    an exponential backoff whenever it fails.
+
+    Start changefeed threads in every worker process, after forking.
+    """
+
+    def __init__(self, name, min_backoff=0.5, max_backoff=30, on_error=None):
+        super(ChangefeedThread, self).__init__(name=name)
+        self.daemon = True
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.on_error = on_error
+        self._stopped = Event()
+        self._conn = None
+
+    def run(self):
+        backoff = self.min_backoff
+        while not self._stopped.is_set():
+            try:
+                self._conn = pool.connection_class(**pool.connection_kwargs).conn
+                feed = self.feed_query().run(self._conn)
+                self.connected()
+                backoff = self.min_backoff
+                for change in feed:
+                    self.apply(change)
+            except Exception as e:
+                if self._stopped.is_set():
+                    break
+                self.disconnected()
+                if self.on_error is not None:
+                    self.on_error(self, e)
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            finally:
+                self._close()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        # Closing the connection interrupts the blocking feed iteration
+        self._close()
+        if self.is_alive():
+            self.join(timeout)
+
+    def feed_query(self):
+        raise NotImplementedError
+
+    def connected(self):
+        pass
+
+    def disconnected(self):
+        pass
+
+    def apply(self, change):
+        raise NotImplementedError
+
+    def _close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            try:
+                conn.close(noreply_wait=False)
+            except Exception:
+                pass
+
+
+class CacheInvalidator(ChangefeedThread):
+    """
+    Subscribes to a model's table changefeed and keeps the model's document
+    cache and identity map in line with writes made by other processes.
+
+    Whenever the feed is (re)established or lost, the model's cache is
+    flushed, since any change made while no feed was running went unnoticed.
+    """
+
+    def __init__(self, model_cls, update=False, **kwargs):
+        super(CacheInvalidator, self).__init__(
+            'remodel-invalidator-%s' % model_cls._table, **kwargs)
+        self.model_cls = model_cls
+        # Whether cached documents are updated in place or simply evicted
+        self.update = update
+
+    def feed_query(self):
+        return r.table(self.model_cls._table).changes()
+
+    def connected(self):
+        self.flush()
+
+    def disconnected(self):
+        self.flush()
+
+    def apply(self, change):
+        old_val, new_val = change.get('old_val'), change.get('new_val')
+        query_cache.invalidate(self.model_cls._table)
+        cache = self.model_cls.cache
+        identity_map = self.model_cls.identity_map
+
+        if new_val is None:
+            if old_val is None:
+                return
+            id_ = old_val['id']
+            if cache is not None:
+                cache.delete(id_)
+            if identity_map is not None:
+                identity_map.discard(id_)
+            return
+
+        id_ = new_val['id']
+        if self.model_cls.negative_cache is not None:
+            self.model_cls.negative_cache.discard(new_val)
+        if cache is not None:
+            if self.update and id_ in cache:
+                cache.set(id_, new_val)
+            else:
+                cache.delete(id_)
+        if identity_map is not None:
+            obj = identity_map.get(id_)
+            if obj is not None:
+                # Overwrite, flushing the related caches whose keys changed;
+                # fields with unsaved changes keep their local values
+                obj.fields._merge(new_val)
+
+    def flush(self):
+        query_cache.invalidate(self.model_cls._table)
+        if self.model_cls.cache is not None:
+            self.model_cls.cache.clear()
+
+
+class LiveObjectSet(ChangefeedThread):
+    """
+    Keeps the result set of a query current in memory, by following the
+    query's changefeed. Documents are kept in the order they were first seen,
+    or sorted by the ``order_by`` field.
+
+    Callbacks registered through ``subscribe()`` are called from the feed
+    thread with the old and the new object (either of them being None for
+    additions and removals).
+    """
+
+    def __init__(self, object_handler, query, order_by=None, reverse=False,
+                 **kwargs):
+        super(LiveObjectSet, self).__init__(
+            'remodel-live-%s' % object_handler.model_cls._table, **kwargs)
+        self.object_handler = object_handler
+        self.query = query
+        self.order_by = order_by
+        self.reverse = reverse
+        self._docs = OrderedDict()
+        # Initial results are collected here until the feed is ready
+        self._pending = None
+        self._sorted = None
+        self._callbacks = []
+        self._lock = RLock()
+        self._ready = Event()
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __len__(self):
+        return len(self._docs)
+
+    def subscribe(self, callback):
+        self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        self._callbacks.remove(callback)
+
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def snapshot(self):
+        return [self.object_handler._wrap(dict(doc)) for doc in self._ordered_docs()]
+
+    def feed_query(self):
+        return self.query.changes(include_initial=True, include_states=True)
+
+    def connected(self):
+        with self._lock:
+            self._pending = OrderedDict()
+
+    def disconnected(self):
+        self._ready.clear()
+        with self._lock:
+            self._pending = None
+
+    def apply(self, change):
+        if 'state' in change:
+            if change['state'] == 'ready':
+                self._swap_pending()
+                self._ready.set()
+            return
+
+        old_val, new_val = change.get('old_val'), change.get('new_val')
+        with self._lock:
+            initializing = self._pending is not None
+            # Still initializing; results are published once ready
+            docs = self._pending if initializing else self._docs
+            if new_val is None:
+                docs.pop(old_val['id'], None)
+            else:
+                # Updated documents keep their position
+                docs[new_val['id']] = new_val
+            self._sorted = None
+        if not initializing:
+            self._notify(old_val, new_val)
+
+    def _swap_pending(self):
+        with self._lock:
+            old_docs, self._docs = self._docs, self._pending or OrderedDict()
+            self._pending = None
+            self._sorted = None
+            new_docs = self._docs
+        # Report the differences with the set known before (re)connecting
+        for id_, old_val in old_docs.items():
+            new_val = new_docs.get(id_)
+            if new_val != old_val:
+                self._notify(old_val, new_val)
+        for id_, new_val in new_docs.items():
+            if id_ not in old_docs:
+                self._notify(None, new_val)
+
+    def _ordered_docs(self):
+        with self._lock:
+            if self._sorted is None:
+                docs = list(self._docs.values())
+                if self.order_by is not None:
+                    docs.sort(key=self._sort_key, reverse=self.reverse)
+                elif self.reverse:
+                    docs.reverse()
+                self._sorted = docs
+            return self._sorted
+
+    def _sort_key(self, doc):
+        value = doc.get(self.order_by)
+        # Documents lacking the field go first
+        return (value is not None, value)
+
+    def _notify(self, old_val, new_val):
+        if not self._callbacks:
+            return
+        old_obj = None
+        if old_val is not None:
+            # Bypass _wrap so that tracked instances aren't reverted
+            old_obj = self.object_handler.model_cls()
+            old_obj.fields.__dict__.update(old_val)
+        new_obj = None
+        if new_val is not None:
+            new_obj = self.object_handler._wrap(dict(new_val))
+        for callback in list(self._callbacks):
+            callback(old_obj, new_obj)
+
+
+def watch(*model_clss, **kwargs):
+    """
+    Starts a CacheInvalidator for each of the given models and returns them.
+    """
+
+    invalidators = []
+    for model_cls in model_clss:
+        invalidator = CacheInvalidator(model_cls, **kwargs)
+        invalidator.start()
+        invalidators.append(invalidator)
+    return invalidators
@@ -0,0 +1,136 @@
+from array import array
+from itertools import islice
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Documents converted at once into the columns
+CHUNK_SIZE = 10000
+# array.array typecodes of the dtypes usable without NumPy, besides the
+# typecodes themselves
+TYPECODES = {
+    float: 'd', int: 'q', bool: 'b',
+    'float64': 'd', 'f8': 'd', 'float32': 'f', 'f4': 'f',
+    'int64': 'q', 'i8': 'q', 'int32': 'i', 'i4': 'i', 'int16': 'h', 'i2': 'h',
+    'int8': 'b', 'i1': 'b', 'uint8': 'B', 'u1': 'B', 'bool': 'b',
+}
+
+
+class Columns(dict):
+    """
+    Values of some fields of query results, as one column per field. With
+    NumPy, columns are numpy.ma.MaskedArray objects, masking the documents
+    lacking the field or holding None there. Without NumPy, they are
+    array.array objects for fields with a dtype and lists for the others.
+
+    masks holds, for fields missing from some documents, which ones lack
+    them: boolean arrays with NumPy, otherwise array.array('B') objects.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Columns, self).__init__(*args, **kwargs)
+        self.masks = {}
+
+
+def to_columns(docs, fields, dtypes=None):
+    """
+    Collects the given fields of docs into Columns, a chunk of CHUNK_SIZE
+    documents at a time. dtypes maps fields to NumPy dtypes, or to
+    array.array typecodes; other fields are kept as Python objects.
+    """
+
+    fields = list(fields)
+    dtypes = dtypes or {}
+    unknown = set(dtypes) - set(fields)
+    if unknown:
+        raise ValueError('dtypes given for fields not exported: %s' %
+                         ', '.join(sorted(unknown)))
+    if numpy is not None:
+        builders = [NumpyColumn(dtypes.get(field)) for field in fields]
+    else:
+        builders = [ArrayColumn(dtypes.get(field)) for field in fields]
+    docs = iter(docs)
+    while True:
+        chunk = list(islice(docs, CHUNK_SIZE))
+        if not chunk:
+            break
+        for field, builder in zip(fields, builders):
+            builder.extend([doc.get(field) for doc in chunk])
+    columns = Columns()
+    for field, builder in zip(fields, builders):
+        columns[field], mask = builder.finish()
+        if mask is not None:
+            columns.masks[field] = mask
+    return columns
+
+
+class NumpyColumn(object):
+    def __init__(self, dtype):
+        self.dtype = numpy.dtype(object if dtype is None else dtype)
+        # Stored in place of missing values
+        self.fill = None if self.dtype.hasobject else self.dtype.type()
+        self.data = numpy.empty(CHUNK_SIZE, self.dtype)
+        self.mask = numpy.zeros(CHUNK_SIZE, bool)
+        self.size = 0
+        self.missing = False
+
+    def extend(self, values):
+        start, end = self.size, self.size + len(values)
+        if end > len(self.data):
+            # Grown in place, by doubling
+            capacity = max(end, 2 * len(self.data))
+            self.data.resize(capacity, refcheck=False)
+            self.mask.resize(capacity, refcheck=False)
+        if None in values:
+            self.missing = True
+            self.mask[start:end] = [value is None for value in values]
+            fill = self.fill
+            values = [fill if value is None else value for value in values]
+        if self.dtype.hasobject:
+            # Slice assignment would turn list and dict values into arrays
+            data = self.data
+            for i, value in enumerate(values, start):
+                data[i] = value
+        else:
+            self.data[start:end] = values
+        self.size = end
+
+    def finish(self):
+        self.data.resize(self.size, refcheck=False)
+        if not self.missing:
+            return numpy.ma.MaskedArray(self.data), None
+        self.mask.resize(self.size, refcheck=False)
+        return numpy.ma.MaskedArray(self.data, mask=self.mask), self.mask
+
+
+class ArrayColumn(object):
+    def __init__(self, dtype):
+        if dtype is None:
+            self.data = []
+        else:
+            typecode = TYPECODES.get(dtype, dtype)
+            try:
+                self.data = array(typecode)
+            except (TypeError, ValueError):
+                raise ValueError('Unknown dtype %r: without NumPy, use an '
+                                 'array.array typecode' % (dtype,))
+        self.fill = None if dtype is None else 0
+        self.mask = array('B')
+        self.missing = False
+
+    def extend(self, values):
+        if None in values:
+            if not self.missing:
+                self.missing = True
+                self.mask.extend(bytearray(len(self.data)))
+            fill = self.fill
+            self.mask.extend([value is None for value in values])
+            values = [fill if value is None else value for value in values]
+        elif self.missing:
+            self.mask.extend(bytearray(len(values)))
+        self.data.extend(values)
+
+    def finish(self):
+        return self.data, self.mask if self.missing else None
@@ -1,6 +1,8 @@
 
 import rethinkdb as r
 from contextlib import contextmanager
+from threading import Lock
+from rethinkdb.errors import RqlDriverError
 try:
     from queue import Queue, Empty
 except ImportError:
@@ -11,16 +13,26 @@ from .utils import Counter
 
 
 class Connection(object):
-    def __init__(self, db='test', host='localhost', port=28015, auth_key=''):
+    def __init__(self, db='test', host='localhost', port=28015, auth_key='',
+                 json_decoder=None, json_encoder=None):
         self.db = db
         self.host = host
         self.port = port
         self.auth_key = auth_key
+        # Classes replacing the driver's ReQLDecoder and ReQLEncoder, e.g.
+        # subclasses decoding with a faster JSON library
+        self.json_decoder = json_decoder
+        self.json_encoder = json_encoder
         self._conn = None
 
     def connect(self):
+        kwargs = {}
+        if self.json_decoder is not None:
+            kwargs['json_decoder'] = self.json_decoder
+        if self.json_encoder is not None:
+            kwargs['json_encoder'] = self.json_encoder
         self._conn = r.connect(host=self.host, port=self.port,
-                               auth_key=self.auth_key, db=self.db)
+                               auth_key=self.auth_key, db=self.db, **kwargs)
 
     def close(self):
         if self._conn:
@@ -41,9 +53,15 @@ class ConnectionPool(object):
         self._created_connections = Counter()
         self.connection_class = Connection
         self.connection_kwargs = {}
+        # Called with the driver errors of noreply writes instead of raising
+        self.noreply_error_handler = None
+        self._noreply_conns = set()
+        self._lock = Lock()
 
-    def configure(self, max_connections=5, **connection_kwargs):
+    def configure(self, max_connections=5, noreply_error_handler=None,
+                  **connection_kwargs):
         self.max_connections = max_connections
+        self.noreply_error_handler = noreply_error_handler
         self.connection_kwargs = connection_kwargs
 
     def get(self):
@@ -63,10 +81,48 @@ class ConnectionPool(object):
     def created(self):
         return self._created_connections.current()
 
+    def sent_noreply(self, connection):
+        with self._lock:
+            self._noreply_conns.add(connection)
+
+    def noreply_error(self, error):
+        # Must be called while handling error
+        if self.noreply_error_handler is None:
+            raise
+        self.noreply_error_handler(error)
+
+    def noreply_wait(self):
+        """
+        Waits until the server has processed all noreply writes sent so far
+        on pooled connections; the ones in use are waited for until they are
+        put back.
+        """
+
+        with self._lock:
+            pending, self._noreply_conns = self._noreply_conns, set()
+        taken = []
+        try:
+            while pending:
+                connection = self.q.get()
+                taken.append(connection)
+                if connection in pending:
+                    pending.discard(connection)
+                    try:
+                        connection.noreply_wait()
+                    except RqlDriverError as e:
+                        self.noreply_error(e)
+        finally:
+            for connection in taken:
+                self.q.put(connection)
+
 
 pool = ConnectionPool()
 
 
+def noreply_wait():
+    pool.noreply_wait()
+
+
 @contextmanager
 def get_conn():
     conn = pool.get()
@@ -1,10 +1,51 @@
+import re
+
 from inflection import tableize
+from six import string_types
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 
 from .errors import AlreadyRegisteredError
 import remodel.models
-from .registry import index_registry
+from .registry import index_registry, counter_registry
+from .tracking import ChangeSet, track
+from .utils import convert_pseudo_type
 from .related import (HasOneDescriptor, BelongsToDescriptor, HasManyDescriptor,
-                     HasAndBelongsToManyDescriptor)
+                     HasAndBelongsToManyDescriptor, HasAndBelongsToManyArrayDescriptor,
+                     HasManyThroughDescriptor, check_cache_policy, check_on_delete)
+
+
+# Field value types whose in-place changes are tracked
+TRACKABLE = (dict, list)
+# Names of fields declared in a model schema
+FIELD_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def split_options(rel):
+    """
+    Splits the trailing options dict off a relation definition, such as
+    ('Tag', {'storage': 'array'}) or ('Tag', 'tags', 'id', 'id', {...}).
+    """
+
+    if isinstance(rel, tuple) and rel and isinstance(rel[-1], dict):
+        options, rel = dict(rel[-1]), rel[:-1]
+        if len(rel) == 1:
+            rel = rel[0]
+        return rel, options
+    return rel, {}
+
+
+def counter_field(field, options):
+    counter_cache = options.get('counter_cache')
+    if counter_cache is True:
+        return '%s_count' % field
+    return counter_cache or None
+
+
+def cache_policy(options):
+    return check_cache_policy(options.get('cache', 'instance'))
 
 
 class FieldHandlerBase(type):
@@ -14,8 +55,12 @@ class FieldHandlerBase(type):
 
         # TODO: Find a way to pass model class to its field handler class
         model = dct.pop('model')
+        schema = dct.pop('schema', None)
         dct['restricted'], dct['related'] = set(), set()
+        # Counter cache fields, maintained on the server only
+        dct['counter_fields'] = set()
         for rel in dct.pop('has_one'):
+            rel, options = split_options(rel)
             if isinstance(rel, tuple):
                 # 4-tuple relation supplied
                 other, field, lkey, rkey = rel
@@ -23,34 +68,69 @@ class FieldHandlerBase(type):
                 # Just the related model supplied
                 other = rel
                 field, lkey, rkey = other.lower(), 'id', '%s_id' % model.lower()
-            dct[field] = HasOneDescriptor(other, lkey, rkey)
+            dct[field] = HasOneDescriptor(other, lkey, rkey, cache_policy(options),
+                                          check_on_delete(options.get('on_delete')))
             dct['related'].add(field)
             index_registry.register(other, rkey)
         for rel in dct.pop('belongs_to'):
+            rel, options = split_options(rel)
             if isinstance(rel, tuple):
                 other, field, lkey, rkey = rel
             else:
                 other = rel
                 field, lkey, rkey = other.lower(), '%s_id' % other.lower(), 'id'
-            dct[field] = BelongsToDescriptor(other, lkey, rkey)
+            if options.get('on_delete') is not None:
+                raise ValueError('on_delete is not supported by belongs_to '
+                                 'relations')
+            dct[field] = BelongsToDescriptor(other, lkey, rkey, cache_policy(options))
             dct['related'].add(field)
             dct['restricted'].add(lkey)
             index_registry.register(model, lkey)
         for rel in dct.pop('has_many'):
+            rel, options = split_options(rel)
             if isinstance(rel, tuple):
                 other, field, lkey, rkey = rel
             else:
                 other = rel
                 field, lkey, rkey = tableize(other), 'id', '%s_id' % model.lower()
-            dct[field] = HasManyDescriptor(other, lkey, rkey)
+            counter_cache = counter_field(field, options)
+            dct[field] = HasManyDescriptor(other, lkey, rkey, counter_cache, model,
+                                           cache_policy(options),
+                                           check_on_delete(options.get('on_delete')))
             dct['related'].add(field)
             index_registry.register(other, rkey)
+            if counter_cache:
+                dct['counter_fields'].add(counter_cache)
+                counter_registry.register(other, model, lkey, rkey, counter_cache)
         for rel in dct.pop('has_and_belongs_to_many'):
+            rel, options = split_options(rel)
             if isinstance(rel, tuple):
                 other, field, lkey, rkey = rel
             else:
                 other = rel
                 field, lkey, rkey = tableize(other), 'id', 'id'
+            counter_cache = counter_field(field, options)
+            if counter_cache:
+                dct['counter_fields'].add(counter_cache)
+            storage = options.get('storage', 'join')
+            if storage == 'array':
+                # Related keys are kept in an array on the owner's documents,
+                # looked up in reverse through a multi index
+                if options.get('inverse', False):
+                    owner, akey = other, '%s_ids' % model.lower()
+                else:
+                    owner, akey = model, '%s_ids' % other.lower()
+                akey = options.get('key', akey)
+                dct[field] = HasAndBelongsToManyArrayDescriptor(
+                    other, lkey, rkey, owner, akey, options.get('inverse', False),
+                    counter_cache, model, cache_policy(options),
+                    check_on_delete(options.get('on_delete')))
+                dct['related'].add(field)
+                index_registry.register(owner, akey, multi=True)
+                continue
+            elif storage != 'join':
+                raise ValueError('Unknown storage "%s" for relation to %s' %
+                                 (storage, other))
             join_model = '_' + ''.join(sorted([model, other]))
             try:
                 remodel.models.ModelBase(join_model, (remodel.models.Model,), {})
@@ -59,30 +139,398 @@ class FieldHandlerBase(type):
                 # other end of the relation
                 pass
             mlkey, mrkey = '%s_id' % model.lower(), '%s_id' % other.lower()
-            dct[field] = HasAndBelongsToManyDescriptor(other, lkey, rkey, join_model, mlkey, mrkey)
+            descriptor = HasAndBelongsToManyDescriptor(other, lkey, rkey, join_model, mlkey, mrkey,
+                                                       counter_cache, model, cache_policy(options),
+                                                       check_on_delete(options.get('on_delete')))
+            dct[field] = descriptor
             dct['related'].add(field)
             index_registry.register(join_model, mlkey)
             index_registry.register(join_model, mrkey)
+            index_registry.register(join_model, descriptor.mindex,
+                                    fields=[mlkey, mrkey])
+        for rel in dct.pop('has_many_through'):
+            rel, options = split_options(rel)
+            if not isinstance(rel, tuple) or len(rel) not in (2, 3):
+                raise ValueError('has_many_through relations must be passed as '
+                                 '(<related model name>, <through model name(s)>'
+                                 '[, <related objects accessor field>])')
+            other, through = rel[:2]
+            field = rel[2] if len(rel) == 3 else tableize(other)
+            if isinstance(through, string_types):
+                through = (through,)
+            dct[field] = HasManyThroughDescriptor(other, tuple(through), model,
+                                                  options.get('distinct', True),
+                                                  cache_policy(options))
+            dct['related'].add(field)
+
+        if schema is not None:
+            dct['__slots__'] = schema_slots(model, schema, dct)
+            dct['slot_fields'] = frozenset(dct['__slots__'])
+
+        new_cls = super(FieldHandlerBase, cls).__new__(cls, name, bases, dct)
+        if schema is not None:
+            new_cls.slot_setters = dict((field, vars(new_cls)[field].__set__)
+                                        for field in new_cls.slot_fields)
+        return new_cls
+
+
+def schema_slots(model, schema, dct):
+    """
+    Returns the declared fields that get a slot, id included: foreign keys
+    are restricted and so kept in the overflow dict along with undeclared
+    fields.
+    """
+
+    slots = ['id']
+    for field in schema:
+        if not isinstance(field, string_types) or not FIELD_NAME.match(field):
+            raise ValueError('Invalid field name %r for %s' % (field, model))
+        if field.startswith('_') or field in dct or hasattr(SlotFieldHandler, field):
+            raise ValueError('Field %s of %s clashes with a relation or a field '
+                             'handler attribute' % (field, model))
+        if field not in dct['restricted'] and field not in slots:
+            slots.append(field)
+    return tuple(slots)
+
+
+class BaseFieldHandler(object):
+    __slots__ = ()
+
+    def _overwrite(self, doc):
+        """
+        Replaces all fields with the ones of doc, the stored document, keeping
+        the relation caches whose keys did not change.
+        """
 
-        return super(FieldHandlerBase, cls).__new__(cls, name, bases, dct)
+        old_dict, new_dict = self.__dict__, dict(doc)
+        for field in self.related:
+            getattr(type(self), field).carry_cache(old_dict, new_dict)
+        new_dict['_changes'] = ChangeSet()
+        self.__dict__ = new_dict
 
+    def _key_saved(self, field, old_value=None):
+        """
+        Marks field, a key just written on its own, as saved, flushing the
+        relation caches looked up by its old_value. Changes made to other
+        fields are kept, as they were not written.
+        """
 
-class FieldHandler(object):
+        fields = self.__dict__
+        old_dict = dict(fields)
+        if old_value is None:
+            old_dict.pop(field, None)
+        else:
+            old_dict[field] = old_value
+        new_dict = dict((name, value) for name, value in fields.items()
+                        if not name.startswith('_'))
+        for name in self.related:
+            getattr(type(self), name).carry_cache(old_dict, new_dict)
+        changes = fields.get('_changes')
+        if changes is not None:
+            changes.forget(field)
+            new_dict['_changes'] = changes
+        self.__dict__ = new_dict
+
+    def _merge(self, doc):
+        """
+        Like _overwrite(), but keeps the fields with unsaved changes as they
+        are, along with their changes.
+        """
+
+        changes = self.__dict__.get('_changes')
+        if not changes:
+            return self._overwrite(doc)
+        old_dict, new_dict = self.__dict__, dict(doc)
+        for field in changes.fields():
+            if field in old_dict:
+                new_dict[field] = old_dict[field]
+            else:
+                new_dict.pop(field, None)
+        for field in self.related:
+            getattr(type(self), field).carry_cache(old_dict, new_dict)
+        new_dict['_changes'] = changes
+        self.__dict__ = new_dict
+
+    def _load_stored(self, doc):
+        # Fills a new handler with doc, the stored document, skipping
+        # validation
+        fields = object.__getattribute__(self, '__dict__')
+        fields.update(doc)
+        fields['_changes'] = ChangeSet()
+
+
+class FieldHandler(BaseFieldHandler):
     def __getattribute__(self, name):
         if name in super(FieldHandler, self).__getattribute__('restricted'):
             raise AttributeError('Cannot access %s: field is restricted' % name)
-        return super(FieldHandler, self).__getattribute__(name)
+        value = super(FieldHandler, self).__getattribute__(name)
+        if type(value) in TRACKABLE and name[0] != '_':
+            fields = super(FieldHandler, self).__getattribute__('__dict__')
+            if fields.get(name) is value:
+                if type(value) is dict and '$reql_type$' in value:
+                    # Times and binaries read with the raw format are
+                    # converted on first access
+                    value = fields[name] = convert_pseudo_type(value)
+                # Nested containers of loaded documents are tracked from
+                # their first access on, so that save() only sends what
+                # changed
+                changes = fields.get('_changes')
+                if changes is not None and type(value) in TRACKABLE:
+                    value = fields[name] = track(value, changes, (name,))
+        return value
 
     def __setattr__(self, name, value):
         if name in self.restricted:
             raise AttributeError('Cannot set %s: field is restricted' % name)
         super(FieldHandler, self).__setattr__(name, value)
+        self._changed(name)
 
     def __delattr__(self, name):
         if name in self.restricted:
             raise AttributeError('Cannot delete %s: field is restricted' % name)
         super(FieldHandler, self).__delattr__(name)
+        self._changed(name)
+
+    def _changed(self, name):
+        changes = self.__dict__.get('_changes')
+        if changes is not None and name[0] != '_' and name not in self.related:
+            changes.mark((name,))
+
+    def as_dict(self):
+        fields = self.__dict__
+        for field, value in list(fields.items()):
+            if type(value) is dict and '$reql_type$' in value and field[0] != '_':
+                # Converted as if read, so that the result doesn't depend on
+                # which fields were
+                fields[field] = convert_pseudo_type(value)
+        return {field: fields[field] for field in fields if not field.startswith('_')}
+
+
+class SlotFieldHandler(BaseFieldHandler):
+    """
+    Field handler of models declaring their fields. Declared fields holding
+    scalars live in slots, read without any Python-level hook; containers
+    (tracked on first access), foreign keys, relation caches and undeclared
+    fields live in an overflow dict. __dict__ is a view over both, so that
+    the handler is used like any other one.
+    """
+
+    __slots__ = ('_extra', '_changes')
+    slot_fields = frozenset()
+    # Field name -> __set__ of its slot descriptor
+    slot_setters = {}
+
+    def __init__(self):
+        # Through the slot descriptors, cheaper than object.__setattr__()
+        _set_extra(self, None)
+        _set_changes(self, None)
+
+    def __getattr__(self, name):
+        # Only called for fields missing from slots
+        if name in self.restricted:
+            raise AttributeError('Cannot access %s: field is restricted' % name)
+        extra = self._extra
+        if extra is None or name not in extra:
+            raise AttributeError(name)
+        value = extra[name]
+        if type(value) in TRACKABLE and name[0] != '_':
+            if type(value) is dict and '$reql_type$' in value:
+                # Moved to its slot, if any, once converted
+                value = convert_pseudo_type(value)
+                self._set(name, value)
+            if self._changes is not None and type(value) in TRACKABLE:
+                value = extra[name] = track(value, self._changes, (name,))
+        return value
+
+    def __setattr__(self, name, value):
+        if name in self.restricted:
+            raise AttributeError('Cannot set %s: field is restricted' % name)
+        if name in self.related or name == '__dict__':
+            object.__setattr__(self, name, value)
+        else:
+            self._set(name, value)
+        self._changed(name)
+
+    def __delattr__(self, name):
+        if name in self.restricted:
+            raise AttributeError('Cannot delete %s: field is restricted' % name)
+        if name in self.related:
+            object.__delattr__(self, name)
+        elif not self._discard(name):
+            raise AttributeError(name)
+        self._changed(name)
+
+    @property
+    def __dict__(self):
+        return FieldsView(self)
+
+    @__dict__.setter
+    def __dict__(self, doc):
+        for name in self.slot_fields:
+            try:
+                object.__delattr__(self, name)
+            except AttributeError:
+                pass
+        object.__setattr__(self, '_extra', None)
+        object.__setattr__(self, '_changes', None)
+        self._load(doc)
+
+    def _load_stored(self, doc):
+        if self._extra is not None:
+            # Fields set by after_init callbacks may need moving
+            self._load(doc)
+        else:
+            # Fresh handler: slot fields are set straight through their
+            # descriptors and the others gathered in one go
+            setters = self.slot_setters
+            extra = None
+            for name, value in doc.items():
+                setter = setters.get(name)
+                if setter is not None and type(value) not in TRACKABLE:
+                    setter(self, value)
+                elif extra is None:
+                    extra = {name: value}
+                else:
+                    extra[name] = value
+            if extra is not None:
+                _set_extra(self, extra)
+        _set_changes(self, ChangeSet())
+
+    def _load(self, doc):
+        slot_fields = self.slot_fields
+        extra = self._extra
+        for name, value in doc.items():
+            if (name in slot_fields and type(value) not in TRACKABLE and
+                    (not extra or name not in extra)):
+                object.__setattr__(self, name, value)
+            else:
+                self._set(name, value)
+                extra = self._extra
+
+    def _set(self, name, value):
+        if name in self.slot_fields and type(value) not in TRACKABLE:
+            object.__setattr__(self, name, value)
+            extra = self._extra
+            if extra and name in extra:
+                del extra[name]
+        elif name == '_changes':
+            object.__setattr__(self, name, value)
+        else:
+            if name in self.slot_fields:
+                try:
+                    object.__delattr__(self, name)
+                except AttributeError:
+                    pass
+            extra = self._extra
+            if extra is None:
+                extra = {}
+                object.__setattr__(self, '_extra', extra)
+            extra[name] = value
+
+    def _discard(self, name):
+        # Returns whether the field was set
+        if name == '_changes':
+            found = self._changes is not None
+            object.__setattr__(self, name, None)
+            return found
+        if name in self.slot_fields:
+            try:
+                object.__delattr__(self, name)
+                return True
+            except AttributeError:
+                pass
+        extra = self._extra
+        if extra is not None and name in extra:
+            del extra[name]
+            return True
+        return False
+
+    def _changed(self, name):
+        changes = self._changes
+        if changes is not None and name[0] != '_' and name not in self.related:
+            changes.mark((name,))
 
     def as_dict(self):
-        return {field: self.__dict__[field] for field in self.__dict__
-                if not field.startswith('_')}
+        fields = {}
+        for name in self.slot_fields:
+            try:
+                fields[name] = object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+        if self._extra:
+            for name, value in list(self._extra.items()):
+                if name.startswith('_'):
+                    continue
+                if type(value) is dict and '$reql_type$' in value:
+                    # Converted as if read, moving to its slot if any
+                    value = convert_pseudo_type(value)
+                    self._set(name, value)
+                fields[name] = value
+        return fields
+
+
+_set_extra = SlotFieldHandler._extra.__set__
+_set_changes = SlotFieldHandler._changes.__set__
+
+
+class FieldsView(MutableMapping):
+    """
+    Dict of the fields of a SlotFieldHandler, standing in for its __dict__.
+    """
+
+    __slots__ = ('_handler',)
+
+    def __init__(self, handler):
+        self._handler = handler
+
+    def __getitem__(self, key):
+        handler = self._handler
+        if key in handler.slot_fields or key == '_changes':
+            try:
+                value = object.__getattribute__(handler, key)
+            except AttributeError:
+                pass
+            else:
+                if value is not None or key != '_changes':
+                    return value
+        extra = handler._extra
+        if extra is not None and key in extra:
+            return extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self._handler._set(key, value)
+
+    def __delitem__(self, key):
+        if not self._handler._discard(key):
+            raise KeyError(key)
+
+    def __iter__(self):
+        handler = self._handler
+        for name in handler.slot_fields:
+            try:
+                object.__getattribute__(handler, name)
+            except AttributeError:
+                continue
+            yield name
+        if handler._changes is not None:
+            yield '_changes'
+        if handler._extra:
+            for name in list(handler._extra):
+                yield name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def update(self, *args, **kwargs):
+        if len(args) == 1 and not kwargs and isinstance(args[0], dict):
+            self._handler._load(args[0])
+        else:
+            self._handler._load(dict(*args, **kwargs))
@@ -33,8 +33,49 @@ def create_indexes():
         created_indexes = r.table(model_cls._table).index_list().run()
         for index in index_set:
             if index not in created_indexes:
-                result = r.table(model_cls._table).index_create(index).run()
+                spec = index_registry.get_spec(model, index)
+                if spec is None:
+                    query = r.table(model_cls._table).index_create(index)
+                elif spec['fields'] is not None:
+                    # Compound index
+                    query = r.table(model_cls._table).index_create(
+                        index, [r.row[field] for field in spec['fields']],
+                        multi=spec['multi'])
+                else:
+                    query = r.table(model_cls._table).index_create(
+                        index, multi=spec['multi'])
+                result = query.run()
                 if result['created'] != 1:
                     raise RuntimeError('Could not create index %s for table %s' % (
                                        index, model_cls._table))
         r.table(model_cls._table).index_wait().run()
+
+
+def rebuild_counters():
+    """
+    Recomputes every counter cache field from the related documents, for
+    instance after enabling counter_cache on an existing relation.
+    """
+
+    from .cache import query_cache
+    from .registry import model_registry
+
+    for model_cls in model_registry.all().values():
+        field_handler_cls = model_cls._field_handler_cls
+        counters = {}
+        for field in field_handler_cls.related:
+            descriptor = field_handler_cls.__dict__[field]
+            if getattr(descriptor, 'counter_cache', None):
+                counters[descriptor.counter_cache] = descriptor.count_query
+        if not counters:
+            continue
+        result = (r.table(model_cls._table)
+                  .update(lambda doc: {field: count_query(doc)
+                                       for field, count_query in counters.items()},
+                          non_atomic=True).run())
+        if result['errors'] > 0:
+            raise RuntimeError('Could not rebuild counters for table %s: %s' % (
+                               model_cls._table, result['first_error']))
+        query_cache.invalidate(model_cls._table)
+        if model_cls.cache is not None:
+            model_cls.cache.clear()
@@ -2,16 +2,26 @@ import rethinkdb as r
 from six import add_metaclass
 from inflection import tableize
 
+from .cache import query_cache
 from .decorators import callback, classaccessonlyproperty, dispatch_to_metaclass
 from .errors import OperationError
-from .field_handler import FieldHandlerBase, FieldHandler
+from .field_handler import FieldHandlerBase, FieldHandler, SlotFieldHandler
 from .object_handler import ObjectHandler
-from .registry import model_registry
-from .utils import deprecation_warning
+from .related import update_counter, refresh_cached
+from .registry import model_registry, counter_registry
+from .tracking import untrack
+from .utils import deprecation_warning, id_generator, uuid4_id
+from .write_behind import writer
 
 
-REL_TYPES = ('has_one', 'has_many', 'belongs_to', 'has_and_belongs_to_many')
+REL_TYPES = ('has_one', 'has_many', 'belongs_to', 'has_and_belongs_to_many',
+             'has_many_through')
 CALLBACKS = ('before_save', 'after_save', 'before_delete', 'after_delete', 'after_init')
+# Class-level callbacks, run once with all the objects written together
+BATCH_CALLBACKS = ('before_save_many', 'after_save_many', 'before_delete_many',
+                   'after_delete_many')
+# Error raised on the server when the predicate of update_if() fails
+UPDATE_IF_FAILED = 'remodel: update_if predicate failed'
 
 
 class ModelBase(type):
@@ -27,24 +37,45 @@ class ModelBase(type):
         dct['_table'] = tableize(name)
 
         rel_attrs = {rel: dct.setdefault(rel, ()) for rel in REL_TYPES}
+        # Declared fields, stored compactly
+        schema = dct.pop('fields', None)
+        if schema is None:
+            schema = next((vars(parent)['_schema'] for parent in parents
+                           if vars(parent).get('_schema') is not None), None)
+        dct['_schema'] = schema
+        if schema is not None and '__slots__' not in dct:
+            dct['__slots__'] = instance_slots(parents)
         dct['_field_handler_cls'] = FieldHandlerBase(
             '%sFieldHandler' % name,
-            (FieldHandler,),
-            dict(rel_attrs, model=name))
+            (FieldHandler if schema is None else SlotFieldHandler,),
+            dict(rel_attrs, model=name, schema=schema))
         object_handler_cls = dct.setdefault('object_handler', ObjectHandler)
-
-        # Register callbacks
-        dct['_callbacks'] = {callback: [] for callback in CALLBACKS}
-        for callback in CALLBACKS:
+        dct['_generate_id'] = staticmethod(id_generator(
+            dct.get('id_generator', getattr(parents[0], 'id_generator', None))))
+
+        # Register callbacks, after the ones inherited from parent models
+        for callback in BATCH_CALLBACKS:
+            if callback in dct and not isinstance(dct[callback], classmethod):
+                dct[callback] = classmethod(dct[callback])
+        dct['_callbacks'] = {}
+        for callback in CALLBACKS + BATCH_CALLBACKS:
+            names = [key for parent in parents
+                     for key in vars(parent).get('_callbacks', {}).get(callback, [])]
             # Callback-named methods
             if callback in dct:
-                dct['_callbacks'][callback].append(callback)
+                names.append(callback)
             # Callback-decorated methods
-            dct['_callbacks'][callback].extend([key
-                                                for key, value in dct.items()
-                                                if hasattr(value, callback)])
+            names.extend([key for key, value in dct.items()
+                          if hasattr(getattr(value, '__func__', value), callback)])
+            dct['_callbacks'][callback] = [key for i, key in enumerate(names)
+                                           if key not in names[:i]]
 
         new_class = super_new(mcs, name, bases, dct)
+        # Resolve the callbacks once; overridden methods take their parent's
+        # place in the chain
+        new_class._callback_chains = {
+            callback: tuple(getattr(new_class, key) for key in names)
+            for callback, names in dct['_callbacks'].items()}
         model_registry.register(name, new_class)
         setattr(new_class, 'objects', object_handler_cls(new_class))
         return new_class
@@ -55,8 +86,63 @@ class ModelBase(type):
         return getattr(self.objects, name)
 
 
+def instance_slots(parents):
+    # Instances of models declaring their fields have no __dict__, unless a
+    # parent model gives them one
+    if not all('__slots__' in vars(parent) for parent in parents):
+        return ()
+    if any('fields' in vars(parent)['__slots__'] for parent in parents):
+        return ()
+    return ('fields', '__weakref__')
+
+
+def write_optargs(durability):
+    return {'durability': durability} if durability is not None else {}
+
+
+def run_write(query, noreply):
+    # Returns None for noreply writes
+    if noreply:
+        return query.run(noreply=True)
+    return query.run()
+
+
+def check_write(result, obj, action):
+    if result['errors'] > 0:
+        raise OperationError(result['first_error'])
+    if result.get('skipped', 0) > 0:
+        raise OperationError('Cannot %s %r (object already deleted)' % (action, obj))
+
+
 @add_metaclass(ModelBase)
 class Model(object):
+    # Models declaring their fields get slots; any other one has a __dict__
+    __slots__ = ()
+
+    # Optional remodel.cache.DocumentCache serving get(id) lookups from memory
+    cache = None
+    # Optional remodel.cache.IdentityMap tracking live instances by id
+    identity_map = None
+    # Optional remodel.cache.NegativeCache remembering get() misses
+    negative_cache = None
+    # Keys of new documents: None lets the server generate them, otherwise
+    # 'uuid4', 'ulid' or a callable returning a new key
+    id_generator = None
+    # Whether saves read the stored document back; if False, the fields sent
+    # are kept locally as they are, sparing the changes in the response
+    return_changes = True
+    # Default write mode of save() and delete(): noreply writes are sent
+    # without waiting for the server, which reports their errors nowhere;
+    # 'soft' durability acknowledges writes before they reach the disk
+    noreply = False
+    durability = None
+    # How reads decode documents: json_decoder replaces the driver's
+    # ReQLDecoder class, and the 'raw' time_format and binary_format leave
+    # pseudo-types to be converted when their fields are first read
+    json_decoder = None
+    time_format = None
+    binary_format = None
+
     def __init__(self, **kwargs):
         self.fields = self._field_handler_cls()
 
@@ -66,30 +152,25 @@ class Model(object):
 
         self._run_callbacks('after_init')
 
-    def save(self):
+    def save(self, noreply=None, durability=None):
+        noreply, durability = self._write_options(noreply, durability)
         self._run_callbacks('before_save')
 
-        fields_dict = self.fields.as_dict()
-        try:
-            # Attempt update
-            id_ = fields_dict['id']
-            result = (r.table(self._table).get(id_).replace(r.row
-                        .without(r.row.keys().difference(list(fields_dict.keys())))
-                        .merge(fields_dict), return_changes='always').run())
-
-        except KeyError:
-            # Resort to insert
-            result = (r.table(self._table).insert(fields_dict, return_changes=True)
-                      .run())
-
-        if result['errors'] > 0:
-            raise OperationError(result['first_error'])
-
-        # Force overwrite so that related caches are flushed
-        self.fields.__dict__ = result['changes'][0]['new_val']
+        save = self._save_query(noreply, durability)
+        if save is not None:
+            query, handle = save
+            handle(run_write(query, noreply))
 
         self._run_callbacks('after_save')
 
+    def save_async(self, timeout=None):
+        """
+        Saves the object from a background worker, together with other
+        objects saved meanwhile. Returns a concurrent.futures.Future.
+        """
+
+        return writer.save(self, timeout)
+
     def update(self, **kwargs):
         for key, value in kwargs.items():
             # Assign fields this way to be sure that validation takes place
@@ -97,26 +178,85 @@ class Model(object):
 
         self.save()
 
-    def delete(self):
+    def increment(self, field, by=1):
+        """
+        Atomically adds by to field on the server and returns the new value.
+        """
+
+        return self._update_atomically(
+            {field: r.row[field].default(0).add(by)}, [field])[field]
+
+    def append(self, field, value):
+        """
+        Atomically appends value to the array field on the server and returns
+        the new array.
+        """
+
+        return self._update_atomically(
+            {field: r.row[field].default([]).append(value)}, [field])[field]
+
+    def remove_from(self, field, value):
+        """
+        Atomically removes all occurrences of value from the array field on
+        the server and returns the new array.
+        """
+
+        return self._update_atomically(
+            {field: r.row[field].default([]).difference([value])}, [field])[field]
+
+    def update_if(self, predicate, **kwargs):
+        """
+        Atomically sets the given fields on the server if predicate, either a
+        dict of field values or a function of the stored document, holds.
+        Returns the new values of the fields, or None if predicate failed.
+        """
+
+        if isinstance(predicate, dict):
+            conditions = predicate
+            predicate = lambda doc: r.and_(*[doc[key].default(None).eq(value)
+                                             for key, value in conditions.items()])
+        update = lambda doc: r.branch(predicate(doc), kwargs,
+                                      r.error(UPDATE_IF_FAILED))
+        new_val = self._update_atomically(update, list(kwargs.keys()),
+                                          ignore_error=UPDATE_IF_FAILED)
+        if new_val is None:
+            return None
+        return {field: new_val.get(field) for field in kwargs}
+
+    def delete(self, noreply=None, durability=None):
+        noreply, durability = self._write_options(noreply, durability)
+        if noreply and self._has_on_delete():
+            raise ValueError('%s relations with on_delete need a reply to '
+                             'delete' % type(self).__name__)
         self._run_callbacks('before_delete')
 
-        try:
-            id_ = getattr(self.fields, 'id')
-            result = r.table(self._table).get(id_).delete().run()
-        except AttributeError:
-            raise OperationError('Cannot delete %r (object not saved or '
-                                 'already deleted)' % self)
-
-        if result['errors'] > 0:
+        id_ = self._get_id('delete')
+        track = self._has_counters() or self._has_on_delete()
+        query = (r.table(self._table).get(id_)
+                 .delete(return_changes=track, **write_optargs(durability)))
+        result = run_write(query, noreply)
+        if result is not None and result['errors'] > 0:
             raise OperationError(result['first_error'])
 
-        delattr(self.fields, 'id')
-        # Remove any reference to the deleted object
-        for field in self.fields.related:
-            delattr(self.fields, field)
+        self._evict_from_caches(id_)
+        old_vals = [change['old_val'] for change in (result or {}).get('changes', [])]
+        self._update_counters_for([(old_val, None) for old_val in old_vals])
+        self._delete_related(old_vals)
+        self._deleted()
 
         self._run_callbacks('after_delete')
 
+    def refresh_related(self, name):
+        """
+        Drops the cached related object(s) for the name relation and returns
+        them freshly loaded.
+        """
+
+        if name not in self.fields.related:
+            raise KeyError(name)
+        getattr(type(self.fields), name).flush(self.fields)
+        return getattr(self.fields, name)
+
     # TODO: Get rid of this nasty decorator after renaming .get() on ObjectHandler
     @dispatch_to_metaclass
     def get(self, key, default=None):
@@ -156,9 +296,244 @@ class Model(object):
     def __str__(self):
         return '<%s object>' % self.__class__.__name__
 
+    def _store_in_caches(self):
+        id_ = self.fields.__dict__['id']
+        query_cache.invalidate(self._table)
+        if self.cache is not None:
+            self.cache.set(id_, self.fields.as_dict())
+        if self.identity_map is not None:
+            self.identity_map.add(id_, self)
+        if self.negative_cache is not None:
+            self.negative_cache.discard(self.fields.as_dict())
+
+    def _save_query(self, noreply=False, durability=None):
+        """
+        Returns the query saving the object along with the function handling
+        its result, or None if there is nothing to send.
+        """
+
+        return_changes = not noreply and self._returns_changes()
+        optargs = dict(write_optargs(durability), return_changes=return_changes)
+        if 'id' not in self.fields.__dict__:
+            # Insert; noreply ones can't learn a key generated by the server
+            fields_dict = self._fields_to_insert(need_id=noreply)
+            query = r.table(self._table).insert(fields_dict, **optargs)
+        else:
+            fields_dict = self._fields_to_save()
+            counter_fields = self.fields.counter_fields
+            changes = self.fields.__dict__.get('_changes')
+            query = r.table(self._table).get(fields_dict['id'])
+            if return_changes:
+                optargs['return_changes'] = 'always'
+            if changes is not None:
+                # Loaded document: only send the changed paths
+                update = changes.update(self.fields.__dict__, exclude=counter_fields)
+                if not update:
+                    return None
+                query = query.update(update, **optargs)
+            else:
+                # Counter caches are maintained on the server; never overwrite them
+                keep_fields = list(fields_dict.keys()) + list(counter_fields)
+                query = query.replace(r.row
+                                      .without(r.row.keys().difference(keep_fields))
+                                      .merge(fields_dict), **optargs)
+
+        def handle(result):
+            if result is not None:
+                check_write(result, self, 'save')
+            if return_changes:
+                change = result['changes'][0]
+                self._saved(change)
+                self._update_counters_for([(change.get('old_val'), change['new_val'])])
+            else:
+                id_ = fields_dict.get('id') or result['generated_keys'][0]
+                self._saved({'new_val': self._local_doc(id_)})
+
+        return query, handle
+
+    def _fields_to_save(self):
+        fields_dict = self.fields.as_dict()
+        for field in self.fields.counter_fields:
+            fields_dict.pop(field, None)
+        return fields_dict
+
+    def _fields_to_insert(self, need_id=False):
+        fields_dict = self._fields_to_save()
+        if 'id' not in fields_dict:
+            generate_id = self._generate_id or (uuid4_id if need_id else None)
+            if generate_id is not None:
+                # Only kept on the object once the insert succeeds
+                fields_dict['id'] = generate_id()
+        return fields_dict
+
+    def _write_options(self, noreply, durability):
+        if noreply is None:
+            noreply = self.noreply
+        if durability is None:
+            durability = self.durability
+        if noreply and self._has_counters():
+            raise ValueError('%s maintains counter caches, which need a reply '
+                             'to every write' % type(self).__name__)
+        return noreply, durability
+
+    def _local_doc(self, id_):
+        # The stored document, as known without reading it back
+        doc = untrack(self.fields.as_dict())
+        doc['id'] = id_
+        return doc
+
+    @classmethod
+    def _returns_changes(cls):
+        # Counter caches need the previous document to know what changed
+        return cls.return_changes or cls._has_counters()
+
+    def _saved(self, change):
+        # Overwrite, flushing the related caches whose keys changed
+        self.fields._overwrite(change['new_val'])
+        self._store_in_caches()
+
+    def _get_id(self, action):
+        try:
+            return getattr(self.fields, 'id')
+        except AttributeError:
+            raise OperationError('Cannot %s %r (object not saved or already '
+                                 'deleted)' % (action, self))
+
+    def _deleted(self):
+        delattr(self.fields, 'id')
+        # Remove any reference to the deleted object
+        field_handler_cls = type(self.fields)
+        for field in self.fields.related:
+            getattr(field_handler_cls, field).detach(self.fields)
+
+    def _update_atomically(self, update, fields, ignore_error=None):
+        # Runs a single-document update on the server, then refreshes the
+        # given fields locally without touching any other unsaved change
+        for field in fields:
+            if field in self.fields.restricted:
+                raise AttributeError('Cannot set %s: field is restricted' % field)
+        id_ = self._get_id('update')
+        result = (r.table(self._table).get(id_)
+                  .update(update, return_changes='always').run())
+        if result['errors'] > 0 and result['first_error'] == ignore_error:
+            return None
+        check_write(result, self, 'update')
+
+        change = result['changes'][0]
+        new_val = change['new_val']
+        changes = self.fields.__dict__.get('_changes')
+        for field in fields:
+            if changes is not None:
+                changes.forget(field)
+            if field in new_val:
+                self.fields.__dict__[field] = new_val[field]
+            else:
+                self.fields.__dict__.pop(field, None)
+        field_handler_cls = type(self.fields)
+        for field in self.fields.related:
+            descriptor = getattr(field_handler_cls, field)
+            if descriptor.lkey in fields:
+                descriptor.flush(self.fields)
+        query_cache.invalidate(self._table)
+        refresh_cached(type(self), new_val, fields)
+        self._update_counters_for([(change['old_val'], new_val)])
+        return new_val
+
+    @classmethod
+    def _evict_from_caches(cls, id_):
+        query_cache.invalidate(cls._table)
+        if cls.cache is not None:
+            cls.cache.delete(id_)
+        if cls.identity_map is not None:
+            cls.identity_map.discard(id_)
+
+    @classmethod
+    def _on_delete_relations(cls):
+        field_handler_cls = cls._field_handler_cls
+        return [field_handler_cls.__dict__[field]
+                for field in sorted(field_handler_cls.related)
+                if field_handler_cls.__dict__[field].on_delete is not None]
+
+    @classmethod
+    def _has_on_delete(cls):
+        return bool(cls._on_delete_relations())
+
+    @classmethod
+    def _delete_related(cls, docs):
+        """
+        Applies the on_delete action of the relations of the deleted docs,
+        then of the relations of the documents deleted along, and so on;
+        each level takes a bulk query per relation.
+        """
+
+        level = [(cls, docs)]
+        while level:
+            next_level = []
+            for model_cls, model_docs in level:
+                for descriptor in model_cls._on_delete_relations():
+                    keys = list(set(doc[descriptor.lkey] for doc in model_docs
+                                    if doc.get(descriptor.lkey) is not None))
+                    deleted = descriptor.delete_related(keys)
+                    if deleted:
+                        next_level.append((descriptor.model_cls, deleted))
+            level = next_level
+
+    @classmethod
+    def _has_counters(cls):
+        return bool(counter_registry.get_for_model(cls.__name__))
+
+    @classmethod
+    def _update_counters_for(cls, transitions):
+        """
+        Adjusts the counter caches of parent models given (old, new) document
+        pairs; either may be None for inserts and deletes. Returns the new
+        values as (field, key, value) tuples.
+        """
+
+        updated = []
+        for counter in counter_registry.get_for_model(cls.__name__):
+            rkey = counter['rkey']
+            deltas = {}
+            for old_val, new_val in transitions:
+                old_key = (old_val or {}).get(rkey)
+                new_key = (new_val or {}).get(rkey)
+                if old_key == new_key:
+                    continue
+                if old_key is not None:
+                    deltas[old_key] = deltas.get(old_key, 0) - 1
+                if new_key is not None:
+                    deltas[new_key] = deltas.get(new_key, 0) + 1
+            parent_cls = model_registry.get(counter['parent'])
+            for key, delta in deltas.items():
+                value = update_counter(parent_cls, counter['lkey'], key,
+                                       counter['field'], delta)
+                if value is not None:
+                    updated.append((counter['field'], key, value))
+        return updated
+
     def _run_callbacks(self, name):
-        for callback in self._callbacks[name]:
-            getattr(self, callback)()
+        chains = self._callback_chains
+        for callback in chains[name]:
+            callback(self)
+        for callback in chains.get(name + '_many', ()):
+            callback([self])
+
+    @classmethod
+    def _run_callbacks_many(cls, name, objs):
+        """
+        Runs the name callbacks of each of objs, then the name_many ones
+        once with all of them.
+        """
+
+        chains = cls._callback_chains
+        chain = chains[name]
+        if chain:
+            for obj in objs:
+                for callback in chain:
+                    callback(obj)
+        if objs:
+            for callback in chains.get(name + '_many', ()):
+                callback(objs)
 
     @classaccessonlyproperty
     def table(self):
@@ -173,3 +548,15 @@ after_save = callback('after_save')
 before_delete = callback('before_delete')
 after_delete = callback('after_delete')
 after_init = callback('after_init')
+
+
+def batch_callback(name):
+    def _decorator(func):
+        return classmethod(callback(name)(func))
+    return _decorator
+
+
+before_save_many = batch_callback('before_save_many')
+after_save_many = batch_callback('after_save_many')
+before_delete_many = batch_callback('before_delete_many')
+after_delete_many = batch_callback('after_delete_many')
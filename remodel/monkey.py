@@ -1,4 +1,5 @@
 import rethinkdb as r
+from rethinkdb.errors import RqlDriverError
 
 import remodel.connection
 
@@ -13,7 +14,16 @@ def remodel_run(self, c=None, **global_optargs):
 
     if not c:
         with remodel.connection.get_conn() as conn:
-            return run(self, conn, **global_optargs)
+            if not global_optargs.get('noreply'):
+                return run(self, conn, **global_optargs)
+            # Not waited for; remodel.connection.noreply_wait() is the barrier
+            pool = remodel.connection.pool
+            try:
+                run(self, conn, **global_optargs)
+            except RqlDriverError as e:
+                pool.noreply_error(e)
+            else:
+                pool.sent_noreply(conn)
     else:
         return run(self, c, **global_optargs)
 
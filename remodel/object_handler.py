@@ -1,12 +1,31 @@
 import rethinkdb as r
 
+from .cache import query_cache, query_key
+from .columns import to_columns
+from .decorators import cached_property
+from .records import record_wrapper
+from .errors import OperationError
+from .utils import chunks, run_options, FORMAT_OPTIONS
+
+
+# Maximum number of documents written by a single batched query
+BATCH_SIZE = 1000
+
 
 class ObjectHandler(object):
     def __init__(self, model_cls, query=None):
         self.model_cls = model_cls
-        self.query = query or r.table(model_cls._table)
+        if query is not None:
+            self.query = query
+
+    @cached_property
+    def query(self):
+        return r.table(self.model_cls._table)
 
     def __getattr__(self, name):
+        if name == 'query':
+            # Building the query failed; don't recurse into it
+            raise AttributeError(name)
         return getattr(self.query, name)
 
     def all(self):
@@ -17,21 +36,56 @@ class ObjectHandler(object):
         obj.save()
         return obj
 
+    def bulk_create(self, objs):
+        """
+        Saves new objs with multi-document inserts, in chunks of BATCH_SIZE
+        documents, running their save callbacks. Returns the objects.
+        """
+
+        objs = list(objs)
+        for obj in objs:
+            if not isinstance(obj, self.model_cls):
+                raise TypeError('%s instance expected, got %r' %
+                                (self.model_cls.__name__, obj))
+        self.model_cls._run_callbacks_many('before_save', objs)
+        self._insert(objs)
+        for obj in objs:
+            obj._store_in_caches()
+        self.model_cls._run_callbacks_many('after_save', objs)
+        return objs
+
     def get(self, id_=None, **kwargs):
+        negative_cache = self._get_negative_cache()
+        if negative_cache is not None and negative_cache.is_missing(id_, kwargs):
+            return None
         if id_:
+            cache = self._get_cache()
+            if cache is not None:
+                doc = cache.get(id_)
+                if doc is not None:
+                    return self._wrap(doc)
+                # Taken before reading, so that a document changed meanwhile
+                # isn't cached
+                version = cache.version()
             try:
-                doc = self.query.get(id_).run()
+                doc = self.query.get(id_).run(**self._run_options())
             except AttributeError:
                 # self.query has a get_all applied, cannot call get
                 kwargs.update(id=id_)
             else:
                 if doc is not None:
+                    if cache is not None:
+                        cache.set(id_, doc, version)
                     return self._wrap(doc)
+                if negative_cache is not None:
+                    negative_cache.add(id_, kwargs)
                 return None
-        docs = self.query.filter(kwargs).limit(1).run()
+        docs = self.query.filter(kwargs).limit(1).run(**self._run_options())
         try:
             return self._wrap(list(docs)[0])
         except IndexError:
+            if negative_cache is not None:
+                negative_cache.add(id_, kwargs)
             return None
 
     def get_or_create(self, id_=None, **kwargs):
@@ -55,14 +109,60 @@ class ObjectHandler(object):
     def count(self):
         return self.query.count().run()
 
+    def _insert(self, objs):
+        # Returns the counter cache values updated along, as
+        # _update_counters_for() does
+        updated = []
+        for chunk in chunks(objs, BATCH_SIZE):
+            docs = [obj._fields_to_insert() for obj in chunk]
+            result = r.table(self.model_cls._table).insert(docs).run()
+            if result['errors'] > 0:
+                raise OperationError(result['first_error'])
+            # Keys are generated, in insertion order, for documents lacking one
+            generated_keys = iter(result.get('generated_keys', []))
+            for obj, doc in zip(chunk, docs):
+                obj.fields.__dict__['id'] = doc['id'] if 'id' in doc else next(generated_keys)
+            updated.extend(self.model_cls._update_counters_for(
+                [(None, obj.fields.__dict__) for obj in chunk]))
+        return updated
+
+    def _run_options(self):
+        # Options of the queries reading documents of the model
+        model_cls = self.model_cls
+        return run_options(model_cls.json_decoder, time_format=model_cls.time_format,
+                           binary_format=model_cls.binary_format)
+
+    def _tables(self):
+        # Tables read by self.query; writes to any of them invalidate cached
+        # query results
+        return (self.model_cls._table,)
+
+    def _get_cache(self):
+        # Only plain table lookups can be served from the document cache
+        if isinstance(self.query, r.ast.Table):
+            return self.model_cls.cache
+        return None
+
+    def _get_negative_cache(self):
+        if isinstance(self.query, r.ast.Table):
+            return self.model_cls.negative_cache
+        return None
+
     def _wrap(self, doc):
+        identity_map = self.model_cls.identity_map
+        if identity_map is not None and 'id' in doc:
+            obj = identity_map.get(doc['id'])
+            if obj is not None:
+                # Unsaved changes of the shared instance are kept
+                obj.fields._merge(doc)
+                return obj
         obj = self.model_cls()
-        # Assign fields this way to skip validation
-        # obj.fields.__dict__ = doc
-        # Issue: #24 Above line is replaced with following.
-        # Not to call field's __setattr__ function which do validations, we just update dict
-        # As validation checks are not issued, this speeds up fetching rows from DB
-        obj.fields.__dict__.update(doc)
+        # Fill fields this way to skip validation, which speeds up fetching
+        # rows from DB (issue #24); fields match the stored document from
+        # now on
+        obj.fields._load_stored(doc)
+        if identity_map is not None and 'id' in doc:
+            identity_map.add(doc['id'], obj)
         return obj
 
 
@@ -71,6 +171,10 @@ class ObjectSet(object):
         self.object_handler = object_handler
         self.query = query
         self.result_cache = None
+        self.cache_ttl = None
+        # Function turning result documents into objects
+        self.wrap = object_handler._wrap
+        self.run_options = object_handler._run_options()
 
     def __iter__(self):
         self._fetch_results()
@@ -84,10 +188,100 @@ class ObjectSet(object):
         self._fetch_results()
         return self.result_cache[key]
 
+    def live(self, order_by=None, reverse=False, callback=None, **kwargs):
+        """
+        Returns a started LiveObjectSet following this query's changefeed.
+        """
+
+        from .changefeeds import LiveObjectSet
+
+        live_set = LiveObjectSet(self.object_handler, self.query,
+                                 order_by=order_by, reverse=reverse, **kwargs)
+        if callback is not None:
+            live_set.subscribe(callback)
+        live_set.start()
+        return live_set
+
+    def cached(self, ttl=60):
+        """
+        Returns a copy of this set whose results are served from the shared
+        query cache (see remodel.cache.query_cache) for up to ttl seconds.
+        """
+
+        object_set = self._clone()
+        object_set.cache_ttl = ttl
+        return object_set
+
+    def read_only(self):
+        """
+        Returns a copy of this set yielding read-only records (see
+        remodel.records.Record) instead of model instances, which are much
+        cheaper to build and keep for results that are only read.
+        """
+
+        object_set = self._clone()
+        object_set.wrap = record_wrapper(self.object_handler.model_cls)
+        return object_set
+
+    def formats(self, time_format=None, binary_format=None, group_format=None):
+        """
+        Returns a copy of this set read with the given pseudo-type formats,
+        overriding the model's: 'native' or 'raw'. Raw times and binaries
+        are converted when their fields are first read, nested ones are
+        left as read.
+        """
+
+        object_set = self._clone()
+        object_set.run_options = dict(self.run_options)
+        object_set.run_options.update(run_options(
+            time_format=time_format, binary_format=binary_format,
+            group_format=group_format))
+        return object_set
+
+    def to_columns(self, fields, dtypes=None):
+        """
+        Returns the given fields of the documents in this set as columns (see
+        remodel.columns.Columns), read from the database without building
+        objects. dtypes maps fields to NumPy dtypes; other fields are kept as
+        Python objects.
+        """
+
+        fields = list(fields)
+        # Pseudo-types always come converted, whatever the formats
+        options = dict((name, value) for name, value in self.run_options.items()
+                       if name not in FORMAT_OPTIONS)
+        return to_columns(self.query.pluck(*fields).run(**options), fields, dtypes)
+
     def iterator(self):
-        results = self.query.run()
+        if self.cache_ttl is not None:
+            results = self._cached_results()
+        else:
+            results = self.query.run(**self.run_options)
+        wrap = self.wrap
         for doc in results:
-            yield self.object_handler._wrap(doc)
+            yield wrap(doc)
+
+    def _cached_results(self):
+        key = query_key(self.query)
+        formats = sorted((name, value) for name, value in self.run_options.items()
+                         if name in FORMAT_OPTIONS)
+        if formats:
+            # Results read with other formats differ
+            key += ' %r' % formats
+        docs = query_cache.get(key)
+        if docs is None:
+            tables = self.object_handler._tables()
+            generation = query_cache.generation(tables)
+            docs = list(self.query.run(**self.run_options))
+            query_cache.set(key, tables, docs, self.cache_ttl, generation)
+        return docs
+
+    def _clone(self):
+        object_set = self.__class__(self.object_handler, self.query)
+        object_set.cache_ttl = self.cache_ttl
+        object_set.wrap = self.wrap
+        object_set.run_options = self.run_options
+        return object_set
 
     def _fetch_results(self):
         if self.result_cache is None:
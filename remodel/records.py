@@ -0,0 +1,141 @@
+from six import string_types
+
+from .utils import convert_pseudo_type
+
+
+# Record classes per model, by field names; once a model has this many (as
+# schemaless documents may), new ones are no longer kept
+MAX_RECORD_CLASSES = 1024
+
+
+class Record(tuple):
+    """
+    Read-only document, as yielded by ObjectSet.read_only(): a tuple of the
+    field values whose names live on its class, shared by all records with
+    the same fields. Fields are read like on a dict or as attributes, and
+    relations are loaded on each access. Fields named like methods (count,
+    keys, get...) shadow them as attributes; call them on Record then, e.g.
+    Record.keys(record).
+    """
+
+    __slots__ = ()
+    _model_cls = None
+    _keys = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        index = self._index.get(key) if isinstance(key, string_types) else None
+        if index is not None:
+            value = tuple.__getitem__(self, index)
+            if type(value) is dict and '$reql_type$' in value:
+                # Read with the raw format; records can't keep the result
+                return convert_pseudo_type(value)
+            return value
+        if key in self._model_cls._field_handler_cls.related:
+            return self._related(key)
+        raise KeyError(key)
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setitem__(self, key, value):
+        raise TypeError('%s records are read-only' % self._model_cls.__name__)
+
+    def __delitem__(self, key):
+        raise TypeError('%s records are read-only' % self._model_cls.__name__)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __eq__(self, other):
+        return (isinstance(other, Record) and self._model_cls is other._model_cls and
+                Record.as_dict(self) == Record.as_dict(other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<%s record: %s>' % (self._model_cls.__name__, Record.get(self, 'id'))
+
+    def __reduce__(self):
+        return make_record, (self._model_cls, Record.as_dict(self))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self._keys)
+
+    def as_dict(self):
+        return dict(zip(self._keys, tuple.__iter__(self)))
+
+    def _related(self, name):
+        # Relations are resolved from a throwaway holder of the fields, as
+        # records have no room for the related objects
+        holder = RelationHolder()
+        holder.__dict__.update(Record.as_dict(self))
+        return vars(self._model_cls._field_handler_cls)[name].__get__(holder)
+
+
+class RelationHolder(object):
+    pass
+
+
+def record_class(model_cls, keys, classes):
+    cls = classes.get(keys)
+    if cls is None:
+        dct = {
+            '__slots__': (),
+            '_model_cls': model_cls,
+            '_keys': keys,
+            '_index': dict((key, i) for i, key in enumerate(keys)),
+        }
+        for key in keys:
+            # Fields win over the tuple and Record methods they're named like
+            if (isinstance(key, string_types) and not key.startswith('_') and
+                    hasattr(Record, key)):
+                dct[key] = property(field_getter(key))
+        cls = type('%sRecord' % model_cls.__name__, (Record,), dct)
+        if len(classes) < MAX_RECORD_CLASSES:
+            classes[keys] = cls
+    return cls
+
+
+def field_getter(key):
+    def get(record):
+        return Record.__getitem__(record, key)
+    return get
+
+
+def record_wrapper(model_cls):
+    """
+    Returns the function turning documents of model_cls into records.
+    """
+
+    classes = model_cls.__dict__.get('_record_classes')
+    if classes is None:
+        classes = {}
+        setattr(model_cls, '_record_classes', classes)
+
+    def wrap(doc):
+        keys = tuple(doc)
+        cls = classes.get(keys)
+        if cls is None:
+            cls = record_class(model_cls, keys, classes)
+        return cls(doc.values())
+    return wrap
+
+
+def make_record(model_cls, doc):
+    return record_wrapper(model_cls)(doc)
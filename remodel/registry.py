@@ -43,23 +43,61 @@ model_registry = ModelRegistry()
 class IndexRegistry(object):
     def __init__(self):
         self._data = defaultdict(set)
+        # (model, index) -> index definition, for indexes which aren't simple
+        # single field ones
+        self._specs = {}
 
-    def register(self, model, index):
+    def register(self, model, index, fields=None, multi=False):
         self._data[model].add(index)
+        if fields is not None or multi:
+            self._specs[(model, index)] = {'fields': fields, 'multi': multi}
 
     def unregister(self, model, index):
         self._data[model].discard(index)
+        self._specs.pop((model, index), None)
 
     def get_for_model(self, model):
         if model not in self._data:
             return set()
         return self._data[model]
 
+    def get_spec(self, model, index):
+        return self._specs.get((model, index))
+
     def all(self):
         return self._data
 
     def clear(self):
         self._data = defaultdict(set)
+        self._specs = {}
 
 
 index_registry = IndexRegistry()
+
+
+class CounterRegistry(object):
+    """
+    Keeps, for each child model, the counter cache fields maintained on its
+    parents by has_many relations.
+    """
+
+    def __init__(self):
+        self._data = defaultdict(list)
+
+    def register(self, model, parent, lkey, rkey, field):
+        self._data[model].append({'parent': parent, 'lkey': lkey,
+                                  'rkey': rkey, 'field': field})
+
+    def get_for_model(self, model):
+        if model not in self._data:
+            return []
+        return self._data[model]
+
+    def all(self):
+        return self._data
+
+    def clear(self):
+        self._data = defaultdict(list)
+
+
+counter_registry = CounterRegistry()
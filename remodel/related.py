@@ -1,38 +1,267 @@
+from numbers import Number
+from time import time
+from warnings import warn
+
 import rethinkdb as r
 from inflection import tableize
+from six import string_types
 
+from .cache import query_cache
 from .decorators import cached_property
-from .object_handler import ObjectHandler
+from .errors import OperationError
+from .object_handler import ObjectHandler, BATCH_SIZE
 from .registry import model_registry
+from .session import write
+from .utils import chunks
+
+
+# (table, index) pairs known to exist
+_found_indexes = set()
+
+
+def has_index(table, index):
+    """
+    Returns whether table has index. Only found indexes are remembered, so
+    that ones created later are picked up.
+    """
+
+    if (table, index) in _found_indexes:
+        return True
+    if index not in r.table(table).index_list().run():
+        return False
+    _found_indexes.add((table, index))
+    return True
+
+
+def has_document_caches(model_cls):
+    return (model_cls.cache is not None or
+            model_cls.identity_map is not None or
+            model_cls.negative_cache is not None)
+
+
+def refresh_cached(model_cls, doc, fields):
+    """
+    Propagates a server-side change of the given fields of doc to the
+    per-document caches of model_cls.
+    """
+
+    id_ = doc['id']
+    if model_cls.cache is not None:
+        model_cls.cache.delete(id_)
+    if model_cls.identity_map is not None:
+        obj = model_cls.identity_map.get(id_)
+        if obj is not None:
+            for field in fields:
+                if field in doc:
+                    obj.fields.__dict__[field] = doc[field]
+                else:
+                    obj.fields.__dict__.pop(field, None)
+    if model_cls.negative_cache is not None:
+        model_cls.negative_cache.discard(doc)
+
+
+def update_counter(model_cls, key_field, key, field, delta, instance=None):
+    """
+    Atomically adds delta to the counter cache field of the model_cls
+    document(s) whose key_field equals key. Returns the new value; instance,
+    a field handler, is kept current if passed.
+    """
+
+    if not delta:
+        return None
+    if key_field == 'id':
+        query = r.table(model_cls._table).get(key)
+    else:
+        query = r.table(model_cls._table).filter({key_field: key})
+    result = (query.update({field: r.row[field].default(0).add(delta)},
+                      return_changes=True).run())
+    if result['errors'] > 0:
+        raise OperationError(result['first_error'])
+    query_cache.invalidate(model_cls._table)
+    value = None
+    for change in result['changes']:
+        value = change['new_val'][field]
+        refresh_cached(model_cls, change['new_val'], [field])
+    if instance is not None and value is not None:
+        instance.__dict__[field] = value
+    return value
+
+
+def unrelate_by_key(model_cls, index, keys, on_delete):
+    """
+    Deletes (on_delete='cascade') or drops the index field of
+    (on_delete='nullify') all model_cls documents whose index field is one of
+    keys, in a query per BATCH_SIZE keys. Returns the deleted documents when
+    they are needed further, for the next level of a cascade.
+    """
+
+    deleted = []
+    table = r.table(model_cls._table)
+    if on_delete == 'cascade':
+        track = (has_document_caches(model_cls) or model_cls._has_counters() or
+                 model_cls._has_on_delete())
+        for chunk in chunks(keys, BATCH_SIZE):
+            result = (table.get_all(r.args(chunk), index=index)
+                      .delete(return_changes=track).run())
+            if result['errors'] > 0:
+                raise OperationError(result['first_error'])
+            if track:
+                old_vals = [change['old_val'] for change in result['changes']]
+                for old_val in old_vals:
+                    model_cls._evict_from_caches(old_val['id'])
+                model_cls._update_counters_for([(old_val, None) for old_val in old_vals])
+                deleted.extend(old_vals)
+    else:
+        track = has_document_caches(model_cls)
+        for chunk in chunks(keys, BATCH_SIZE):
+            result = (table.get_all(r.args(chunk), index=index)
+                      .replace(r.row.without(index), return_changes=track).run())
+            if result['errors'] > 0:
+                raise OperationError(result['first_error'])
+            if track:
+                for change in result['changes']:
+                    refresh_cached(model_cls, change['new_val'], [index])
+    query_cache.invalidate(model_cls._table)
+    return deleted
+
+
+CACHE_POLICIES = ('instance', 'none', 'identity')
+ON_DELETE = (None, 'cascade', 'nullify')
+
+
+def check_on_delete(on_delete):
+    if on_delete not in ON_DELETE:
+        raise ValueError('Unknown on_delete action "%s"' % (on_delete,))
+    return on_delete
+
+
+def check_cache_policy(policy):
+    if isinstance(policy, Number) and not isinstance(policy, bool):
+        if policy < 0:
+            raise ValueError('Relation cache TTL must not be negative')
+    elif policy not in CACHE_POLICIES:
+        raise ValueError('Unknown relation cache policy "%s"' % (policy,))
+    return policy
 
 
 class RelationDescriptor(object):
-    @property
+    # How related objects are kept on the field handler: 'instance' keeps
+    # them until a relation key changes, 'none' refetches them on every
+    # access, a number of seconds expires them and 'identity' also resolves
+    # belongs_to objects through the related model's identity map
+    cache = 'instance'
+    # What becomes of related objects when the parent is deleted: None leaves
+    # them be, 'cascade' deletes them and 'nullify' drops their foreign key
+    on_delete = None
+
+    # Models are looked up once, the first time they are needed
+    @cached_property
     def model_cls(self):
         return model_registry.get(self.model)
 
+    @property
+    def expires_key(self):
+        return '%s_expires' % self.related_cache
+
+    def get_cached(self, instance):
+        """
+        Returns the cached related value, raising AttributeError if there is
+        none or it may not be used.
+        """
+
+        if self.cache == 'none':
+            raise AttributeError(self.related_cache)
+        if not isinstance(self.cache, string_types):
+            expires = instance.__dict__.get(self.expires_key)
+            if expires is not None and expires <= time():
+                raise AttributeError(self.related_cache)
+        return getattr(instance, self.related_cache)
+
+    def set_cached(self, instance, value):
+        setattr(instance, self.related_cache, value)
+        if not isinstance(self.cache, string_types):
+            instance.__dict__[self.expires_key] = time() + self.cache
+
+    def flush(self, instance):
+        instance.__dict__.pop(self.related_cache, None)
+        instance.__dict__.pop(self.expires_key, None)
+
+    def carry_cache(self, old_dict, new_dict):
+        """
+        Moves the cache from a field handler's old fields to its new ones,
+        if the key the relation is looked up by did not change.
+        """
+
+        if old_dict.get(self.lkey) != new_dict.get(self.lkey):
+            return
+        for key in (self.related_cache, self.expires_key):
+            if key in old_dict:
+                new_dict[key] = old_dict[key]
+
+    def load(self, key):
+        if self.cache == 'identity' and self.rkey == 'id':
+            identity_map = self.model_cls.identity_map
+            if identity_map is not None:
+                obj = identity_map.get(key)
+                if obj is not None:
+                    return obj
+        params = {self.rkey: key}
+        return self.model_cls.get(**params)
+
+    def detach(self, instance):
+        # Drops the related objects kept on a deleted parent
+        self.flush(instance)
+
+    def delete_related(self, keys):
+        """
+        Applies on_delete to the objects related to the deleted parents whose
+        lkey values are keys. Returns the documents deleted along.
+        """
+
+        return []
+
+    def traverse(self, seq):
+        """
+        Returns the documents related to any of the documents in seq, joined
+        in a single query.
+        """
+
+        return (seq.eq_join(self.lkey, r.table(self.model_cls._table), index=self.rkey)
+                .get_field('right'))
+
+    def tables(self):
+        # Tables read by traverse()
+        return [self.model_cls._table]
+
+    @cached_property
+    def parent_model_cls(self):
+        if self.parent_model is None:
+            return None
+        return model_registry.get(self.parent_model)
+
 
 class HasOneDescriptor(RelationDescriptor):
-    def __init__(self, model, lkey, rkey):
+    def __init__(self, model, lkey, rkey, cache='instance', on_delete=None):
         self.model = model
         self.lkey = lkey
         self.rkey = rkey
+        self.cache = cache
+        self.on_delete = on_delete
         self.related_cache = '_%s_cache' % model.lower()
 
     def __get__(self, instance, owner=None):
         if instance is None:
             return self
         try:
-            return getattr(instance, self.related_cache)
+            return self.get_cached(instance)
         except AttributeError:
             instance_lkey = getattr(instance, self.lkey, None)
             if instance_lkey is None:
                 rel_obj = None
             else:
-                params = {self.rkey: instance_lkey}
-                rel_obj = self.model_cls.get(**params)
+                rel_obj = self.load(instance_lkey)
             # Make related document available on parent (this) e.g.: user.profile
-            setattr(instance, self.related_cache, rel_obj)
+            self.set_cached(instance, rel_obj)
             return rel_obj
 
     def __set__(self, instance, value):
@@ -45,6 +274,7 @@ class HasOneDescriptor(RelationDescriptor):
             if rel_obj is not None:
                 # We are deleting the rkey attr on related field handler, not obj
                 del rel_obj.fields.__dict__[self.rkey]
+                rel_obj.fields._changed(self.rkey)
         else:
             instance_lkey = getattr(instance, self.lkey, None)
             if instance_lkey is None:
@@ -52,34 +282,43 @@ class HasOneDescriptor(RelationDescriptor):
                                  'saved' % value)
             # Assign field this way to skip validation
             value.fields.__dict__[self.rkey] = instance_lkey
+            value.fields._changed(self.rkey)
         # Make related document available on parent (this) e.g.: user.profile
-        setattr(instance, self.related_cache, value)
+        self.set_cached(instance, value)
 
     def __delete__(self, instance):
         self.__set__(instance, None)
 
+    def detach(self, instance):
+        self.__delete__(instance)
+
+    def delete_related(self, keys):
+        if self.on_delete is None or not keys:
+            return []
+        return unrelate_by_key(self.model_cls, self.rkey, keys, self.on_delete)
+
 
 class BelongsToDescriptor(RelationDescriptor):
-    def __init__(self, model, lkey, rkey):
+    def __init__(self, model, lkey, rkey, cache='instance'):
         self.model = model
         self.lkey = lkey
         self.rkey = rkey
+        self.cache = cache
         self.related_cache = '_%s_cache' % model.lower()
 
     def __get__(self, instance, owner=None):
         if instance is None:
             return self
         try:
-            return getattr(instance, self.related_cache)
+            return self.get_cached(instance)
         except AttributeError:
             instance_lkey = instance.__dict__.get(self.lkey, None)
             if instance_lkey is None:
                 rel_obj = None
             else:
-                params = {self.rkey: instance_lkey}
-                rel_obj = self.model_cls.get(**params)
+                rel_obj = self.load(instance_lkey)
             # Make parent document available on related (this) e.g.: profile.user
-            setattr(instance, self.related_cache, rel_obj)
+            self.set_cached(instance, rel_obj)
             return rel_obj
 
     def __set__(self, instance, value):
@@ -90,6 +329,7 @@ class BelongsToDescriptor(RelationDescriptor):
         if value is None:
             if self.lkey in instance.__dict__:
                 del instance.__dict__[self.lkey]
+                instance._changed(self.lkey)
         else:
             value_rkey = getattr(value.fields, self.rkey, None)
             if value_rkey is None:
@@ -97,20 +337,28 @@ class BelongsToDescriptor(RelationDescriptor):
                                  'saved' % (value, value.__class__.__name__))
             # Assign field this way to skip validation
             instance.__dict__[self.lkey] = value_rkey
+            instance._changed(self.lkey)
         # Make parent document available on related (this) e.g.: profile.user
-        setattr(instance, self.related_cache, value)
+        self.set_cached(instance, value)
 
     def __delete__(self, instance):
         self.__set__(instance, None)
 
+    def detach(self, instance):
+        self.__delete__(instance)
+
 
-def create_related_object_handler_cls(model_cls, lkey, rkey):
+def create_related_object_handler_cls(model_cls, lkey, rkey, counter_cache=None):
     class RelatedObjectHandler(ObjectHandler):
         def __init__(self, parent):
             super(RelatedObjectHandler, self).__init__(model_cls)
             # Parent field handler instance
             self.parent = parent
-            self.query = self.query.get_all(self._get_parent_lkey(), index=rkey)
+
+        @cached_property
+        def query(self):
+            # Composed on first read, so that writes don't pay for it
+            return r.table(model_cls._table).get_all(self._get_parent_lkey(), index=rkey)
 
         def create(self, **kwargs):
             obj = super(RelatedObjectHandler, self).create(**kwargs)
@@ -123,27 +371,154 @@ def create_related_object_handler_cls(model_cls, lkey, rkey):
             return obj, created
 
         def add(self, *objs):
+            """
+            Relates objs to the parent in a few batched queries: unsaved
+            objects are inserted, running their save callbacks, while saved
+            ones only get their foreign key updated, without callbacks (any
+            other unsaved change on them is kept, unsaved).
+            """
+
             for obj in objs:
                 if not isinstance(obj, model_cls):
                     raise TypeError('%s instance expected, got %r' %
                                     (model_cls.__name__, obj))
+            parent_lkey = self._get_parent_lkey()
+
+            unique_objs = []
+            seen = set()
+            old_keys = {}
+            for obj in objs:
+                if id(obj) in seen:
+                    continue
+                seen.add(id(obj))
+                old_keys[id(obj)] = obj.fields.__dict__.get(rkey)
                 # Assign field this way to skip validation
-                obj.fields.__dict__[rkey] = self._get_parent_lkey()
-                obj.save()
+                obj.fields.__dict__[rkey] = parent_lkey
+                unique_objs.append(obj)
+            new_objs = [obj for obj in unique_objs if 'id' not in obj.fields.__dict__]
+            saved_objs = [obj for obj in unique_objs if 'id' in obj.fields.__dict__]
+            # Saved objects aren't saved as a whole, so fields set by their
+            # save callbacks would never be written
+            model_cls._run_callbacks_many('before_save', new_objs)
 
-        def remove(self, *objs):
+            self._set_parent_counter(self._insert(new_objs))
+            # Changes are only needed to keep counter caches current
+            track = model_cls._has_counters()
+            for chunk in chunks(saved_objs, BATCH_SIZE):
+                ids = [obj.fields.__dict__['id'] for obj in chunk]
+                result = (r.table(model_cls._table).get_all(r.args(ids))
+                          .update({rkey: parent_lkey}, return_changes=track).run())
+                if result['errors'] > 0:
+                    raise OperationError(result['first_error'])
+                if track:
+                    self._update_counters(result['changes'])
+
+            for obj in new_objs:
+                # Overwrite so that related caches are flushed; the foreign
+                # key is already set, so _overwrite() can't tell it changed
+                obj.fields.__dict__ = obj.fields.as_dict()
+                obj._store_in_caches()
+            for obj in saved_objs:
+                self._key_saved(obj, old_keys[id(obj)])
+            model_cls._run_callbacks_many('after_save', new_objs)
+
+        def remove(self, *objs, **kwargs):
+            """
+            Unrelates objs from the parent by dropping their foreign key in a
+            few batched queries. Save callbacks are run for each object only
+            if callbacks=True is passed, in which case the objects are saved
+            as a whole, writing any field their callbacks set. Returns the
+            number of documents updated.
+            """
+
+            callbacks = kwargs.pop('callbacks', False)
+            if kwargs:
+                raise TypeError('remove() got unexpected keyword arguments: %s' %
+                                ', '.join(sorted(kwargs)))
             ref_key = self._get_parent_lkey()
             for obj in objs:
                 obj_key = obj.fields.__dict__.get(rkey, None)
                 if obj_key != ref_key:
                     raise ValueError('%r is not a related object' % obj)
-                del obj.fields.__dict__[rkey]
-                obj.save()
 
-        def clear(self):
-            for obj in self.all():
-                del obj.fields.__dict__[rkey]
-                obj.save()
+            if callbacks:
+                model_cls._run_callbacks_many('before_save', list(objs))
+            ids = list({obj.fields.__dict__['id'] for obj in objs
+                        if 'id' in obj.fields.__dict__})
+            removed = 0
+            for chunk in chunks(ids, BATCH_SIZE):
+                result = (r.table(model_cls._table).get_all(r.args(chunk))
+                          .filter({rkey: ref_key})
+                          .replace(r.row.without(rkey),
+                                   return_changes=model_cls._has_counters()).run())
+                if result['errors'] > 0:
+                    raise OperationError(result['first_error'])
+                removed += result['replaced']
+                self._update_counters(result.get('changes', []))
+
+            for obj in objs:
+                obj.fields.__dict__.pop(rkey, None)
+                if 'id' in obj.fields.__dict__:
+                    self._key_saved(obj, ref_key)
+            if callbacks:
+                # Write the other changes, such as the ones made by
+                # before_save callbacks, in a single query
+                failed = write([], [obj for obj in objs if 'id' in obj.fields.__dict__], [])
+                if failed:
+                    raise failed[0][1]
+                model_cls._run_callbacks_many('after_save', list(objs))
+            return removed
+
+        def clear(self, callbacks=False):
+            """
+            Unrelates all objects from the parent with a single query. Related
+            objects are only fetched if callbacks=True is passed, so that save
+            callbacks can be run for each of them. Returns the number of
+            documents updated.
+            """
+
+            if callbacks:
+                return self.remove(*self.all(), callbacks=True)
+
+            # Changes are only needed to keep caches and counters current
+            track = has_document_caches(model_cls) or model_cls._has_counters()
+            result = (r.table(model_cls._table)
+                      .get_all(self._get_parent_lkey(), index=rkey)
+                      .replace(r.row.without(rkey), return_changes=track).run())
+            if result['errors'] > 0:
+                raise OperationError(result['first_error'])
+            query_cache.invalidate(model_cls._table)
+            if track:
+                for change in result['changes']:
+                    refresh_cached(model_cls, change['new_val'], [rkey])
+                self._update_counters(result['changes'])
+            return result['replaced']
+
+        def _key_saved(self, obj, old_key):
+            # Only the foreign key of obj was written, so the document cache
+            # entry is dropped rather than filled with unsaved fields
+            obj.fields._key_saved(rkey, old_key)
+            id_ = obj.fields.__dict__['id']
+            query_cache.invalidate(model_cls._table)
+            if model_cls.cache is not None:
+                model_cls.cache.delete(id_)
+            if model_cls.identity_map is not None:
+                model_cls.identity_map.add(id_, obj)
+            if model_cls.negative_cache is not None:
+                model_cls.negative_cache.discard(obj.fields.as_dict())
+
+        def _update_counters(self, changes):
+            self._set_parent_counter(model_cls._update_counters_for(
+                [(change['old_val'], change['new_val']) for change in changes]))
+
+        def _set_parent_counter(self, updated):
+            if counter_cache is None:
+                return
+            parent_lkey = getattr(self.parent, lkey, None)
+            for field, key, value in updated:
+                if field == counter_cache and key == parent_lkey:
+                    # Keep the parent instance current, skipping validation
+                    self.parent.__dict__[field] = value
 
         def _get_parent_lkey(self):
             parent_lkey = getattr(self.parent, lkey, None)
@@ -156,21 +531,26 @@ def create_related_object_handler_cls(model_cls, lkey, rkey):
 
 
 class HasManyDescriptor(RelationDescriptor):
-    def __init__(self, model, lkey, rkey):
+    def __init__(self, model, lkey, rkey, counter_cache=None, parent_model=None,
+                 cache='instance', on_delete=None):
         self.model = model
         self.lkey = lkey
         self.rkey = rkey
+        self.counter_cache = counter_cache
+        self.parent_model = parent_model
+        self.cache = cache
+        self.on_delete = on_delete
         self.related_cache = '_%s_cache' % tableize(model)
 
     def __get__(self, instance, owner=None):
         if instance is None:
             return self
         try:
-            return getattr(instance, self.related_cache)
+            return self.get_cached(instance)
         except AttributeError:
             rel_object_handler = self.related_object_handler_cls(instance)
             # Make related set available on parent (this) e.g.: artist.songs
-            setattr(instance, self.related_cache, rel_object_handler)
+            self.set_cached(instance, rel_object_handler)
             return rel_object_handler
 
     def __set__(self, instance, value):
@@ -184,20 +564,34 @@ class HasManyDescriptor(RelationDescriptor):
 
     @cached_property
     def related_object_handler_cls(self):
-        return create_related_object_handler_cls(self.model_cls, self.lkey, self.rkey)
+        return create_related_object_handler_cls(self.model_cls, self.lkey, self.rkey,
+                                                 self.counter_cache)
 
+    def count_query(self, doc):
+        return r.table(self.model_cls._table).get_all(doc[self.lkey], index=self.rkey).count()
 
-def create_related_m2m_object_handler_cls(model_cls, lkey, rkey, join_model_cls, mlkey, mrkey):
+    def delete_related(self, keys):
+        if self.on_delete is None or not keys:
+            return []
+        return unrelate_by_key(self.model_cls, self.rkey, keys, self.on_delete)
+
+
+def create_related_m2m_object_handler_cls(model_cls, lkey, rkey, join_model_cls, mlkey, mrkey, mindex,
+                                          parent_model_cls=None, counter_cache=None,
+                                          reverse_counter=None):
     class RelatedM2MObjectHandler(ObjectHandler):
         def __init__(self, parent):
             super(RelatedM2MObjectHandler, self).__init__(model_cls)
             # Parent field handler instance
             self.parent = parent
+
+        @cached_property
+        def query(self):
             # Returns all docs from model_cls which are referenced in join_model_cls
-            self.query = (r.table(join_model_cls._table)
-                          .get_all(self._get_parent_lkey(), index=mlkey)
-                          .eq_join(mrkey, r.table(model_cls._table), index=rkey)
-                          .map(lambda res: res['right']))
+            return (r.table(join_model_cls._table)
+                    .get_all(self._get_parent_lkey(), index=mlkey)
+                    .eq_join(mrkey, r.table(model_cls._table), index=rkey)
+                    .map(lambda res: res['right']))
 
         def create(self, **kwargs):
             obj = super(RelatedM2MObjectHandler, self).create(**kwargs)
@@ -210,7 +604,13 @@ def create_related_m2m_object_handler_cls(model_cls, lkey, rkey, join_model_cls,
             return obj, created
 
         def add(self, *objs):
-            new_keys = set()
+            """
+            Links objs to the parent. Existing links are looked up through the
+            compound (parent, child) join index and new ones are inserted with
+            multi-document inserts. Returns the number of links created.
+            """
+
+            new_keys, seen = [], set()
             for obj in objs:
                 if not isinstance(obj, model_cls):
                     raise TypeError('%s instance expected, got %r' %
@@ -220,41 +620,103 @@ def create_related_m2m_object_handler_cls(model_cls, lkey, rkey, join_model_cls,
                     raise ValueError('Cannot add %r: the value for field %s '
                                      'is missing (try saving the object first'
                                      ')' % (obj, rkey))
-                new_keys.add(obj_key)
+                if obj_key not in seen:
+                    seen.add(obj_key)
+                    new_keys.append(obj_key)
 
-            existing_keys = {doc[rkey]
-                            for doc in self.query.run()}
-            new_keys -= existing_keys
-
-            for obj_key in new_keys:
-                params = {mlkey: self._get_parent_lkey(),
-                          mrkey: obj_key}
-                join_model_cls.table.insert(params).run()
+            parent_lkey = self._get_parent_lkey()
+            created = 0
+            for chunk in chunks(new_keys, BATCH_SIZE):
+                existing_keys = set(self._links(parent_lkey, chunk).get_field(mrkey).run())
+                docs = [{mlkey: parent_lkey, mrkey: key}
+                        for key in chunk if key not in existing_keys]
+                if docs:
+                    result = r.table(join_model_cls._table).insert(docs).run()
+                    if result['errors'] > 0:
+                        raise OperationError(result['first_error'])
+                    created += result['inserted']
+                    self._update_reverse_counters([doc[mrkey] for doc in docs], 1, objs)
+            query_cache.invalidate(join_model_cls._table)
+            self._update_counter(created)
+            return created
 
         def remove(self, *objs):
-            old_keys = set()
+            """
+            Unlinks objs from the parent, deleting only the (parent, child)
+            join rows. Returns the number of links deleted.
+            """
+
+            old_keys, seen = [], set()
             for obj in objs:
                 if not isinstance(obj, model_cls):
                     raise TypeError('%s instance expected, got %r' %
                                     (model_cls.__name__, obj))
                 obj_key = getattr(obj.fields, rkey, None)
-                if obj_key is not None:
-                    old_keys.add(obj_key)
-
-            existing_keys = {doc[rkey]
-                            for doc in self.query.run()}
-            # Remove inexisting keys from old_keys
-            old_keys &= existing_keys
+                if obj_key is not None and obj_key not in seen:
+                    seen.add(obj_key)
+                    old_keys.append(obj_key)
 
-            if old_keys:
-                (join_model_cls.table.get_all(r.args(list(old_keys)), index=mrkey)
-                                     .delete()
-                                     .run())
+            parent_lkey = self._get_parent_lkey()
+            deleted = 0
+            for chunk in chunks(old_keys, BATCH_SIZE):
+                deleted += self._delete_links(self._links(parent_lkey, chunk), objs)
+            query_cache.invalidate(join_model_cls._table)
+            self._update_counter(-deleted)
+            return deleted
 
         def clear(self):
-            (join_model_cls.table
-             .get_all(self._get_parent_lkey(), index=mlkey)
-             .delete().run())
+            deleted = self._delete_links(
+                join_model_cls.table.get_all(self._get_parent_lkey(), index=mlkey))
+            query_cache.invalidate(join_model_cls._table)
+            self._update_counter(-deleted)
+            return deleted
+
+        def _links(self, parent_lkey, keys):
+            # Join rows linking the parent to the objects with keys
+            table = r.table(join_model_cls._table)
+            if has_index(join_model_cls._table, mindex):
+                return table.get_all(r.args([[parent_lkey, key] for key in keys]),
+                                     index=mindex)
+            # Tables created by older versions lack the compound index
+            warn('Index %s is missing on table %s, run create_indexes() to '
+                 'speed up linking objects' % (mindex, join_model_cls._table),
+                 RuntimeWarning)
+            return (table.get_all(parent_lkey, index=mlkey)
+                         .filter(lambda link: r.expr(keys).contains(link[mrkey])))
+
+        def _delete_links(self, query, objs=()):
+            # Deletes the join rows selected by query, keeping the counter
+            # cache of the other end current; returns how many went
+            track = self._reverse_counter() is not None
+            result = query.delete(return_changes=track).run()
+            if result['errors'] > 0:
+                raise OperationError(result['first_error'])
+            if track:
+                self._update_reverse_counters(
+                    [change['old_val'][mrkey] for change in result['changes']], -1, objs)
+            return result['deleted']
+
+        def _update_counter(self, delta):
+            if counter_cache is not None:
+                update_counter(parent_model_cls, lkey, self._get_parent_lkey(),
+                               counter_cache, delta, self.parent)
+
+        def _reverse_counter(self):
+            return reverse_counter() if reverse_counter is not None else None
+
+        def _update_reverse_counters(self, keys, delta, objs=()):
+            # Adds delta to the counters of the related objects with keys,
+            # once per occurrence, keeping objs current
+            reverse = self._reverse_counter()
+            if reverse is None:
+                return
+            deltas = {}
+            for key in keys:
+                deltas[key] = deltas.get(key, 0) + delta
+            instances = dict((getattr(obj.fields, rkey, None), obj.fields) for obj in objs)
+            for key, key_delta in deltas.items():
+                update_counter(model_cls, reverse.lkey, key, reverse.counter_cache,
+                               key_delta, instances.get(key))
 
         def _get_parent_lkey(self):
             parent_lkey = getattr(self.parent, lkey, None)
@@ -263,28 +725,39 @@ def create_related_m2m_object_handler_cls(model_cls, lkey, rkey, join_model_cls,
                                  'instance isn\'t saved' %  model_cls.__name__)
             return parent_lkey
 
+        def _tables(self):
+            return (model_cls._table, join_model_cls._table)
+
     return RelatedM2MObjectHandler
 
 
 class HasAndBelongsToManyDescriptor(RelationDescriptor):
-    def __init__(self, model, lkey, rkey, join_model, mlkey, mrkey):
+    def __init__(self, model, lkey, rkey, join_model, mlkey, mrkey,
+                 counter_cache=None, parent_model=None, cache='instance',
+                 on_delete=None):
         self.model = model
         self.lkey = lkey
         self.rkey = rkey
         self.join_model = join_model
         self.mlkey = mlkey
         self.mrkey = mrkey
+        # Compound join table index on (parent key, child key)
+        self.mindex = '%s_%s' % (mlkey, mrkey)
+        self.counter_cache = counter_cache
+        self.parent_model = parent_model
+        self.cache = cache
+        self.on_delete = on_delete
         self.related_cache = '_%s_cache' % tableize(model)
 
     def __get__(self, instance, owner=None):
         if instance is None:
             return self
         try:
-            return getattr(instance, self.related_cache)
+            return self.get_cached(instance)
         except AttributeError:
             rel_m2m_object_handler = self.related_m2m_object_handler_cls(instance)
             # Make related set available on parent (this) e.g.: user.artists
-            setattr(instance, self.related_cache, rel_m2m_object_handler)
+            self.set_cached(instance, rel_m2m_object_handler)
             return rel_m2m_object_handler
 
     def __set__(self, instance, value):
@@ -300,8 +773,471 @@ class HasAndBelongsToManyDescriptor(RelationDescriptor):
     def related_m2m_object_handler_cls(self):
         return create_related_m2m_object_handler_cls(
             self.model_cls, self.lkey, self.rkey,
-            self.join_model_cls, self.mlkey, self.mrkey)
+            self.join_model_cls, self.mlkey, self.mrkey, self.mindex,
+            self.parent_model_cls, self.counter_cache, self.reverse_counter)
 
-    @property
+    def count_query(self, doc):
+        return (r.table(self.join_model_cls._table)
+                .get_all(doc[self.lkey], index=self.mlkey).count())
+
+    def traverse(self, seq):
+        return (seq.eq_join(self.lkey, r.table(self.join_model_cls._table), index=self.mlkey)
+                .get_field('right')
+                .eq_join(self.mrkey, r.table(self.model_cls._table), index=self.rkey)
+                .get_field('right'))
+
+    def tables(self):
+        return [self.join_model_cls._table, self.model_cls._table]
+
+    def delete_related(self, keys):
+        # Related objects may belong to other parents too, so only the join
+        # rows ever go, whatever on_delete is
+        if self.on_delete is None or not keys:
+            return []
+        join_model_cls = self.join_model_cls
+        reverse = self.reverse_counter()
+        for chunk in chunks(keys, BATCH_SIZE):
+            result = (r.table(join_model_cls._table)
+                      .get_all(r.args(chunk), index=self.mlkey)
+                      .delete(return_changes=reverse is not None).run())
+            if result['errors'] > 0:
+                raise OperationError(result['first_error'])
+            if reverse is not None:
+                deltas = {}
+                for change in result['changes']:
+                    key = change['old_val'][self.mrkey]
+                    deltas[key] = deltas.get(key, 0) - 1
+                for key, delta in deltas.items():
+                    update_counter(self.model_cls, reverse.lkey, key,
+                                   reverse.counter_cache, delta)
+        query_cache.invalidate(join_model_cls._table)
+        return []
+
+    def reverse_counter(self):
+        # The other end of the relation, if it keeps a counter cache
+        field_handler_cls = self.model_cls._field_handler_cls
+        for field in field_handler_cls.related:
+            descriptor = field_handler_cls.__dict__[field]
+            if (getattr(descriptor, 'join_model', None) == self.join_model and
+                    descriptor.counter_cache):
+                return descriptor
+        return None
+
+    @cached_property
     def join_model_cls(self):
         return model_registry.get(self.join_model)
+
+
+def create_related_array_object_handler_cls(model_cls, lkey, rkey, owner_model_cls, akey,
+                                            counter_cache=None):
+    class RelatedArrayObjectHandler(ObjectHandler):
+        """
+        Related set of a has_and_belongs_to_many relation stored as an array
+        of related keys on the parent (owner) document.
+        """
+
+        def __init__(self, parent):
+            super(RelatedArrayObjectHandler, self).__init__(model_cls)
+            # Parent field handler instance
+            self.parent = parent
+
+        @cached_property
+        def query(self):
+            # Keys are read on the server, so the set is current even if the
+            # parent instance isn't
+            keys = (self._parent_query()
+                    .concat_map(lambda doc: doc[akey].default([]))
+                    .coerce_to('array'))
+            return r.table(model_cls._table).get_all(r.args(keys), index=rkey)
+
+        def create(self, **kwargs):
+            obj = super(RelatedArrayObjectHandler, self).create(**kwargs)
+            self.add(obj)
+            return obj
+
+        def get_or_create(self, id_=None, **kwargs):
+            obj, created = super(RelatedArrayObjectHandler, self).get_or_create(id_, **kwargs)
+            self.add(obj)
+            return obj, created
+
+        def add(self, *objs):
+            keys = self._get_keys(objs, required=True)
+            old_keys, new_keys = self._update_keys(
+                r.row[akey].default([]).set_union(keys))
+            return len(new_keys) - len(old_keys)
+
+        def remove(self, *objs):
+            keys = self._get_keys(objs, required=False)
+            old_keys, new_keys = self._update_keys(
+                r.row[akey].default([]).set_difference(keys))
+            return len(old_keys) - len(new_keys)
+
+        def clear(self):
+            old_keys, _ = self._update_keys([])
+            return len(old_keys)
+
+        def _get_keys(self, objs, required):
+            keys = []
+            for obj in objs:
+                if not isinstance(obj, model_cls):
+                    raise TypeError('%s instance expected, got %r' %
+                                    (model_cls.__name__, obj))
+                obj_key = getattr(obj.fields, rkey, None)
+                if obj_key is None:
+                    if required:
+                        raise ValueError('Cannot add %r: the value for field %s '
+                                         'is missing (try saving the object first'
+                                         ')' % (obj, rkey))
+                    continue
+                keys.append(obj_key)
+            return keys
+
+        def _update_keys(self, value):
+            update = {akey: value}
+            if counter_cache is not None:
+                # The counter lives on the same document, so it is set along
+                update[counter_cache] = r.expr(value).count()
+            result = (self._parent_query()
+                      .update(update, return_changes='always').run())
+            if result['errors'] > 0:
+                raise OperationError(result['first_error'])
+            query_cache.invalidate(owner_model_cls._table)
+            if not result['changes']:
+                return [], []
+            change = result['changes'][0]
+            # Keep the parent instance current, skipping validation
+            fields = [akey] if counter_cache is None else [akey, counter_cache]
+            for field in fields:
+                self.parent.__dict__[field] = change['new_val'][field]
+            refresh_cached(owner_model_cls, change['new_val'], fields)
+            return change['old_val'].get(akey, []), change['new_val'][akey]
+
+        def _parent_query(self):
+            return (r.table(owner_model_cls._table)
+                    .get_all(self._get_parent_lkey(), index=lkey))
+
+        def _get_parent_lkey(self):
+            parent_lkey = getattr(self.parent, lkey, None)
+            if parent_lkey is None:
+                raise ValueError('Cannot access related "%s" set: current '
+                                 'instance isn\'t saved' % model_cls.__name__)
+            return parent_lkey
+
+        def _tables(self):
+            return (model_cls._table, owner_model_cls._table)
+
+    return RelatedArrayObjectHandler
+
+
+def create_related_inverse_array_object_handler_cls(model_cls, lkey, rkey, akey,
+                                                    parent_model_cls=None, counter_cache=None):
+    class RelatedInverseArrayObjectHandler(ObjectHandler):
+        """
+        Related set of a has_and_belongs_to_many relation stored as arrays of
+        parent keys on the related (owner) documents.
+        """
+
+        def __init__(self, parent):
+            super(RelatedInverseArrayObjectHandler, self).__init__(model_cls)
+            # Parent field handler instance
+            self.parent = parent
+
+        @cached_property
+        def query(self):
+            return r.table(model_cls._table).get_all(self._get_parent_lkey(), index=akey)
+
+        def create(self, **kwargs):
+            obj = super(RelatedInverseArrayObjectHandler, self).create(**kwargs)
+            self.add(obj)
+            return obj
+
+        def get_or_create(self, id_=None, **kwargs):
+            obj, created = super(RelatedInverseArrayObjectHandler, self).get_or_create(id_, **kwargs)
+            self.add(obj)
+            return obj, created
+
+        def add(self, *objs):
+            parent_lkey = self._get_parent_lkey()
+            keys = self._get_keys(objs, required=True)
+            added = self._update_keys(
+                keys, r.row[akey].default([]).set_insert(parent_lkey),
+                lambda doc: doc[akey].default([]).contains(parent_lkey).not_())
+            for obj in objs:
+                obj_keys = obj.fields.__dict__.get(akey) or []
+                if parent_lkey not in obj_keys:
+                    # Assign field this way to skip validation
+                    obj.fields.__dict__[akey] = obj_keys + [parent_lkey]
+            self._update_counter(added)
+            return added
+
+        def remove(self, *objs):
+            parent_lkey = self._get_parent_lkey()
+            keys = self._get_keys(objs, required=False)
+            removed = self._update_keys(
+                keys, r.row[akey].set_difference([parent_lkey]),
+                lambda doc: doc[akey].default([]).contains(parent_lkey))
+            for obj in objs:
+                obj_keys = obj.fields.__dict__.get(akey) or []
+                if parent_lkey in obj_keys:
+                    obj.fields.__dict__[akey] = [key for key in obj_keys
+                                                 if key != parent_lkey]
+            self._update_counter(-removed)
+            return removed
+
+        def clear(self):
+            parent_lkey = self._get_parent_lkey()
+            track = has_document_caches(model_cls)
+            result = (r.table(model_cls._table).get_all(parent_lkey, index=akey)
+                      .update({akey: r.row[akey].set_difference([parent_lkey])},
+                              return_changes=track).run())
+            self._handle_result(result, track)
+            self._update_counter(-result['replaced'])
+            return result['replaced']
+
+        def _get_keys(self, objs, required):
+            keys = []
+            for obj in objs:
+                if not isinstance(obj, model_cls):
+                    raise TypeError('%s instance expected, got %r' %
+                                    (model_cls.__name__, obj))
+                obj_key = getattr(obj.fields, rkey, None)
+                if obj_key is None:
+                    if required:
+                        raise ValueError('Cannot add %r: the value for field %s '
+                                         'is missing (try saving the object first'
+                                         ')' % (obj, rkey))
+                    continue
+                keys.append(obj_key)
+            return keys
+
+        def _update_keys(self, keys, value, predicate):
+            track = has_document_caches(model_cls)
+            updated = 0
+            for chunk in chunks(keys, BATCH_SIZE):
+                result = (r.table(model_cls._table)
+                          .get_all(r.args(chunk), index=rkey)
+                          .filter(predicate)
+                          .update({akey: value}, return_changes=track).run())
+                self._handle_result(result, track)
+                updated += result['replaced']
+            return updated
+
+        def _handle_result(self, result, track):
+            if result['errors'] > 0:
+                raise OperationError(result['first_error'])
+            query_cache.invalidate(model_cls._table)
+            if track:
+                for change in result['changes']:
+                    refresh_cached(model_cls, change['new_val'], [akey])
+
+        def _get_parent_lkey(self):
+            parent_lkey = getattr(self.parent, lkey, None)
+            if parent_lkey is None:
+                raise ValueError('Cannot access related "%s" set: current '
+                                 'instance isn\'t saved' % model_cls.__name__)
+            return parent_lkey
+
+        def _update_counter(self, delta):
+            if counter_cache is not None:
+                update_counter(parent_model_cls, lkey, self._get_parent_lkey(),
+                               counter_cache, delta, self.parent)
+
+    return RelatedInverseArrayObjectHandler
+
+
+class HasAndBelongsToManyArrayDescriptor(RelationDescriptor):
+    """
+    has_and_belongs_to_many relation keeping the related keys in an array
+    field (akey) of the owner model's documents, instead of a join table. The
+    owner side reads related documents with a single get_all, while the
+    inverse side looks owners up through a multi index on akey.
+    """
+
+    def __init__(self, model, lkey, rkey, owner, akey, inverse,
+                 counter_cache=None, parent_model=None, cache='instance',
+                 on_delete=None):
+        self.model = model
+        self.lkey = lkey
+        self.rkey = rkey
+        self.owner = owner
+        self.akey = akey
+        self.inverse = inverse
+        self.counter_cache = counter_cache
+        self.parent_model = parent_model
+        self.cache = cache
+        self.on_delete = on_delete
+        self.related_cache = '_%s_cache' % tableize(model)
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        try:
+            return self.get_cached(instance)
+        except AttributeError:
+            rel_object_handler = self.related_object_handler_cls(instance)
+            # Make related set available on parent (this) e.g.: post.tags
+            self.set_cached(instance, rel_object_handler)
+            return rel_object_handler
+
+    def __set__(self, instance, value):
+        rel_object_handler = self.__get__(instance)
+        rel_object_handler.clear()
+        rel_object_handler.add(*value)
+
+    def __delete__(self, instance):
+        rel_object_handler = self.__get__(instance)
+        rel_object_handler.clear()
+
+    @cached_property
+    def related_object_handler_cls(self):
+        if self.inverse:
+            return create_related_inverse_array_object_handler_cls(
+                self.model_cls, self.lkey, self.rkey, self.akey,
+                self.parent_model_cls, self.counter_cache)
+        return create_related_array_object_handler_cls(
+            self.model_cls, self.lkey, self.rkey,
+            model_registry.get(self.owner), self.akey, self.counter_cache)
+
+    def count_query(self, doc):
+        if self.inverse:
+            return (r.table(self.model_cls._table)
+                    .get_all(doc[self.lkey], index=self.akey).count())
+        return doc[self.akey].default([]).count()
+
+    def traverse(self, seq):
+        table = r.table(self.model_cls._table)
+        if self.inverse:
+            return seq.eq_join(self.lkey, table, index=self.akey).get_field('right')
+        return seq.concat_map(lambda doc: table.get_all(
+            r.args(doc[self.akey].default([])), index=self.rkey).coerce_to('array'))
+
+    def delete_related(self, keys):
+        # Keys kept on the deleted documents themselves go along with them
+        if self.on_delete is None or not self.inverse or not keys:
+            return []
+        model_cls = self.model_cls
+        reverse = self.reverse_counter()
+        track = has_document_caches(model_cls)
+        for chunk in chunks(keys, BATCH_SIZE):
+            update = {self.akey: r.row[self.akey].default([]).set_difference(chunk)}
+            if reverse is not None:
+                update[reverse.counter_cache] = update[self.akey].count()
+            result = (r.table(model_cls._table)
+                      .get_all(r.args(chunk), index=self.akey)
+                      .update(update, return_changes=track).run())
+            if result['errors'] > 0:
+                raise OperationError(result['first_error'])
+            if track:
+                for change in result['changes']:
+                    refresh_cached(model_cls, change['new_val'], list(update))
+        query_cache.invalidate(model_cls._table)
+        return []
+
+    def reverse_counter(self):
+        # The owner's end of the relation, if it keeps a counter cache
+        field_handler_cls = self.model_cls._field_handler_cls
+        for field in field_handler_cls.related:
+            descriptor = field_handler_cls.__dict__[field]
+            if (isinstance(descriptor, HasAndBelongsToManyArrayDescriptor) and
+                    not descriptor.inverse and descriptor.akey == self.akey and
+                    descriptor.counter_cache):
+                return descriptor
+        return None
+
+
+def find_relation(model, other):
+    """
+    Returns the descriptor relating model to the other model, both given by
+    name, looking through model's relations in field name order.
+    """
+
+    field_handler_cls = model_registry.get(model)._field_handler_cls
+    for field in sorted(field_handler_cls.related):
+        descriptor = field_handler_cls.__dict__[field]
+        if descriptor.model == other and hasattr(descriptor, 'traverse'):
+            return descriptor
+    raise ValueError('No relation from %s to %s to traverse' % (model, other))
+
+
+def create_related_through_object_handler_cls(model_cls, parent_model_cls, hops, distinct):
+    class RelatedThroughObjectHandler(ObjectHandler):
+        """
+        Read-only set of the objects reached by walking a chain of relations
+        from the parent, in a single query.
+        """
+
+        def __init__(self, parent):
+            super(RelatedThroughObjectHandler, self).__init__(model_cls)
+            # Parent field handler instance
+            self.parent = parent
+            # Checked right away, even though the query is composed later
+            self._get_parent_id()
+
+        @cached_property
+        def query(self):
+            # Hops may need any field of the parent, so start off its
+            # stored document
+            query = r.table(parent_model_cls._table).get_all(self._get_parent_id())
+            for hop in hops:
+                query = hop.traverse(query)
+            if distinct:
+                query = query.distinct()
+            return query
+
+        def _get_parent_id(self):
+            parent_id = getattr(self.parent, 'id', None)
+            if parent_id is None:
+                raise ValueError('Cannot access related "%s" set: current '
+                                 'instance isn\'t saved' % model_cls.__name__)
+            return parent_id
+
+        def _tables(self):
+            tables = [parent_model_cls._table]
+            for hop in hops:
+                tables.extend(hop.tables())
+            return tuple(tables)
+
+    return RelatedThroughObjectHandler
+
+
+class HasManyThroughDescriptor(RelationDescriptor):
+    def __init__(self, model, through, parent_model, distinct=True, cache='instance'):
+        self.model = model
+        # Names of the models walked through, in order, from the parent
+        self.through = through
+        self.parent_model = parent_model
+        self.distinct = distinct
+        self.cache = cache
+        self.related_cache = '_%s_cache' % tableize(model)
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        try:
+            return self.get_cached(instance)
+        except AttributeError:
+            rel_object_handler = self.related_object_handler_cls(instance)
+            # Make related objects available on parent (this) e.g.: recipe.chefs
+            self.set_cached(instance, rel_object_handler)
+            return rel_object_handler
+
+    def __set__(self, instance, value):
+        raise AttributeError('Cannot assign %s objects through other '
+                             'relations' % self.model)
+
+    def __delete__(self, instance):
+        self.flush(instance)
+
+    # The chain is walked from the parent's stored document, looked up by id
+    lkey = 'id'
+
+    @cached_property
+    def hops(self):
+        models = [self.parent_model] + list(self.through) + [self.model]
+        return [find_relation(model, other)
+                for model, other in zip(models, models[1:])]
+
+    @cached_property
+    def related_object_handler_cls(self):
+        return create_related_through_object_handler_cls(
+            self.model_cls, self.parent_model_cls, self.hops, self.distinct)
@@ -0,0 +1,163 @@
+from collections import OrderedDict
+
+import rethinkdb as r
+
+from .errors import OperationError
+
+
+class Session(object):
+    """
+    Unit of work: collects new, changed and deleted objects, then writes them
+    all at once in a single query, made of one insert and one delete per
+    table plus the updates of changed objects.
+
+    Callbacks run per model, in the order objects were added, with the
+    batch ones getting all objects of their model: all before_* callbacks
+    run before the query, all after_* ones after it.
+
+        with Session() as session:
+            session.add(order, invoice)
+            session.delete(cart)
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            # Nothing has been written yet
+            self.clear()
+
+    def add(self, *objs):
+        for obj in objs:
+            key = id(obj)
+            if key in self._deleted:
+                raise ValueError('Cannot add %r: object is to be deleted' % obj)
+            if key in self._new or key in self._dirty:
+                continue
+            if 'id' in obj.fields.__dict__:
+                self._dirty[key] = obj
+            else:
+                self._new[key] = obj
+
+    def delete(self, *objs):
+        for obj in objs:
+            key = id(obj)
+            if self._new.pop(key, None) is not None:
+                # Never written, so there is nothing to delete
+                continue
+            self._dirty.pop(key, None)
+            self._deleted[key] = obj
+
+    def clear(self):
+        self._new = OrderedDict()
+        self._dirty = OrderedDict()
+        self._deleted = OrderedDict()
+
+    def flush(self):
+        new = list(self._new.values())
+        dirty = list(self._dirty.values())
+        deleted = list(self._deleted.values())
+        self.clear()
+
+        run_callbacks('before_save', new + dirty)
+        run_callbacks('before_delete', deleted)
+
+        failed = write(new, dirty, deleted)
+        if failed:
+            # Only raised once all results are handled, so that objects
+            # saved along are kept in line
+            raise failed[0][1]
+
+        run_callbacks('after_save', new + dirty)
+        run_callbacks('after_delete', deleted)
+
+
+def write(new, dirty, deleted):
+    """
+    Writes new, dirty and deleted objects in a single query, with one insert
+    and one delete per table, without running callbacks. Returns the failed
+    writes as (objects, error) pairs.
+    """
+
+    # (objects, query, function handling its result)
+    writes = []
+    for model_cls, objs in group_by_model(new).items():
+        writes.append((objs,) + insert_query(model_cls, objs))
+    for obj in dirty:
+        save = obj._save_query()
+        if save is not None:
+            writes.append(([obj],) + save)
+    for model_cls, objs in group_by_model(deleted).items():
+        writes.append((objs,) + delete_query(model_cls, objs))
+    if not writes:
+        return []
+
+    results = r.expr([query for _, query, _ in writes]).run()
+    failed = []
+    for (objs, _, handle), result in zip(writes, results):
+        try:
+            handle(result)
+        except OperationError as e:
+            failed.append((objs, e))
+    return failed
+
+
+def insert_query(model_cls, objs):
+    docs = [obj._fields_to_insert() for obj in objs]
+    return_changes = model_cls._returns_changes()
+    query = r.table(model_cls._table).insert(docs, return_changes=return_changes)
+
+    def handle(result):
+        if result['errors'] > 0:
+            raise OperationError(result['first_error'])
+        # Keys are generated, in insertion order, for documents lacking one
+        generated_keys = iter(result.get('generated_keys', []))
+        changes = dict((change['new_val']['id'], change)
+                       for change in result.get('changes', []))
+        for obj, doc in zip(objs, docs):
+            id_ = doc['id'] if 'id' in doc else next(generated_keys)
+            if return_changes:
+                obj._saved(changes[id_])
+            else:
+                obj._saved({'new_val': obj._local_doc(id_)})
+        model_cls._update_counters_for([(None, obj.fields.__dict__) for obj in objs])
+
+    return query, handle
+
+
+def delete_query(model_cls, objs):
+    ids = [obj._get_id('delete') for obj in objs]
+    track = model_cls._has_counters() or model_cls._has_on_delete()
+    query = (r.table(model_cls._table).get_all(r.args(ids))
+             .delete(return_changes=track))
+
+    def handle(result):
+        if result['errors'] > 0:
+            raise OperationError(result['first_error'])
+        for id_ in ids:
+            model_cls._evict_from_caches(id_)
+        old_vals = [change['old_val'] for change in result.get('changes', [])]
+        model_cls._update_counters_for([(old_val, None) for old_val in old_vals])
+        model_cls._delete_related(old_vals)
+        for obj in objs:
+            obj._deleted()
+
+    return query, handle
+
+
+def run_callbacks(name, objs):
+    for model_cls, model_objs in group_by_model(objs).items():
+        model_cls._run_callbacks_many(name, model_objs)
+
+
+def group_by_model(objs):
+    groups = OrderedDict()
+    for obj in objs:
+        groups.setdefault(type(obj), []).append(obj)
+    return groups
@@ -0,0 +1,265 @@
+import rethinkdb as r
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+# Shared by change sets until their first change, sparing two allocations
+# per loaded document; never mutated
+NO_PATHS = frozenset()
+NO_OPS = {}
+
+
+class ChangeSet(object):
+    """
+    Paths changed on a loaded document since it was last read or saved, as
+    recorded by its tracked containers. Paths are tuples of object keys,
+    starting with a top-level field name.
+    """
+
+    __slots__ = ('dirty', 'ops')
+
+    def __init__(self):
+        # Paths whose value is sent whole
+        self.dirty = NO_PATHS
+        # Paths of arrays -> list of (ReQL method, argument) applied in order
+        self.ops = NO_OPS
+
+    def __bool__(self):
+        return bool(self.dirty or self.ops)
+    __nonzero__ = __bool__
+
+    def mark(self, path):
+        if self.dirty is NO_PATHS:
+            self.dirty = set()
+        self.dirty.add(path)
+
+    def op(self, path, name, arg):
+        if self.ops is NO_OPS:
+            self.ops = {}
+        self.ops.setdefault(path, []).append((name, arg))
+
+    def fields(self):
+        # Top-level fields with changes
+        return set(path[0] for path in self.dirty) | set(path[0] for path in self.ops)
+
+    def forget(self, field):
+        # The field was just read from the server
+        self.dirty = set(path for path in self.dirty if path[0] != field)
+        self.ops = dict((path, ops) for path, ops in self.ops.items()
+                        if path[0] != field)
+
+    def covered(self, path, strict=False):
+        end = len(path) if strict else len(path) + 1
+        return any(path[:i] in self.dirty for i in range(1, end))
+
+    def update(self, values, exclude=()):
+        """
+        Returns the update to run on the stored document for it to match
+        values, the current fields. Changed values are sent as literals, so
+        that they replace what is stored instead of being merged into it.
+        """
+
+        update = {}
+        for path in self.dirty:
+            if path[0] in exclude or self.covered(path, strict=True):
+                continue
+            try:
+                value = r.literal(untrack(lookup(values, path)))
+            except KeyError:
+                # Removes the key
+                value = r.literal()
+            set_path(update, path, value)
+        for path, ops in self.ops.items():
+            if path[0] in exclude or self.covered(path):
+                continue
+            expr = r.row
+            for key in path:
+                expr = expr[key]
+            for name, arg in ops:
+                expr = getattr(expr, name)(arg)
+            set_path(update, path, expr)
+        return update
+
+
+def lookup(values, path):
+    for key in path:
+        if not isinstance(values, Mapping):
+            raise KeyError(key)
+        values = values[key]
+    return values
+
+
+def set_path(update, path, value):
+    for key in path[:-1]:
+        update = update.setdefault(key, {})
+    update[path[-1]] = value
+
+
+def track(value, changes, path, exact=True):
+    """
+    Wraps the dicts and lists within value so that their changes are
+    recorded in changes. Containers nested in lists can't be addressed by a
+    path, so their changes mark their closest list as changed instead.
+    """
+
+    if isinstance(value, dict):
+        return TrackedDict(value, changes, path, exact)
+    if isinstance(value, list):
+        return TrackedList(value, changes, path, exact)
+    return value
+
+
+def untrack(value):
+    if isinstance(value, dict):
+        return dict((key, untrack(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [untrack(item) for item in value]
+    return value
+
+
+class TrackedDict(dict):
+    __slots__ = ('_changes', '_path', '_exact')
+
+    def __init__(self, data, changes, path, exact):
+        self._changes = changes
+        self._path = path
+        self._exact = exact
+        dict.__init__(self, ((key, self._track(key, value))
+                             for key, value in data.items()))
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, self._track(key, value))
+        self._mark(key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._mark(key)
+
+    def pop(self, key, *args):
+        if key in self:
+            self._mark(key)
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._mark(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        dict.clear(self)
+        self._changes.mark(self._path)
+
+    def __deepcopy__(self, memo):
+        return untrack(self)
+
+    def __reduce__(self):
+        return dict, (untrack(self),)
+
+    def _track(self, key, value):
+        if self._exact:
+            return track(value, self._changes, self._path + (key,))
+        return track(value, self._changes, self._path, False)
+
+    def _mark(self, key):
+        self._changes.mark(self._path + (key,) if self._exact else self._path)
+
+
+class TrackedList(list):
+    __slots__ = ('_changes', '_path', '_exact')
+
+    def __init__(self, data, changes, path, exact):
+        self._changes = changes
+        self._path = path
+        self._exact = exact
+        list.__init__(self, (self._track(value) for value in data))
+
+    def append(self, value):
+        list.append(self, self._track(value))
+        if self._exact:
+            self._changes.op(self._path, 'append', untrack(value))
+        else:
+            self._mark()
+
+    def pop(self, index=-1):
+        value = list.pop(self, index)
+        if self._exact:
+            self._changes.op(self._path, 'delete_at', index)
+        else:
+            self._mark()
+        return value
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        if self._exact and isinstance(index, int):
+            self._changes.op(self._path, 'delete_at', index)
+        else:
+            self._mark()
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = [self._track(item) for item in value]
+        else:
+            value = self._track(value)
+        list.__setitem__(self, index, value)
+        self._mark()
+
+    def insert(self, index, value):
+        list.insert(self, index, self._track(value))
+        self._mark()
+
+    def extend(self, values):
+        list.extend(self, [self._track(value) for value in values])
+        self._mark()
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def __imul__(self, n):
+        list.__imul__(self, n)
+        self._mark()
+        return self
+
+    def remove(self, value):
+        list.remove(self, value)
+        self._mark()
+
+    def reverse(self):
+        list.reverse(self)
+        self._mark()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._mark()
+
+    def clear(self):
+        del self[:]
+
+    # Python 2 slicing
+    def __setslice__(self, i, j, values):
+        self.__setitem__(slice(i, j), values)
+
+    def __delslice__(self, i, j):
+        self.__delitem__(slice(i, j))
+
+    def __deepcopy__(self, memo):
+        return untrack(self)
+
+    def __reduce__(self):
+        return list, (untrack(self),)
+
+    def _track(self, value):
+        return track(value, self._changes, self._path, False)
+
+    def _mark(self):
+        self._changes.mark(self._path)
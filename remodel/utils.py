@@ -1,5 +1,12 @@
+import binascii
+import os
+import time
+import uuid
 from threading import Lock
 from warnings import warn
+
+from rethinkdb.net import ReQLDecoder
+
 from .decorators import synchronized
 
 
@@ -36,5 +43,83 @@ class Counter(object):
         return self.n
 
 
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
 def deprecation_warning(message):
     warn(message, DeprecationWarning, stacklevel=2)
+
+
+CROCKFORD_BASE32 = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+
+
+def uuid4_id():
+    return str(uuid.uuid4())
+
+
+def ulid_id():
+    """
+    Returns a ULID: 48 bits of millisecond timestamp followed by 80 random
+    bits, as 26 Crockford base32 characters that sort by creation time.
+    """
+
+    value = (int(time.time() * 1000) << 80) | int(binascii.hexlify(os.urandom(10)), 16)
+    chars = []
+    for _ in range(26):
+        value, index = divmod(value, 32)
+        chars.append(CROCKFORD_BASE32[index])
+    return ''.join(reversed(chars))
+
+
+ID_GENERATORS = {'uuid4': uuid4_id, 'ulid': ulid_id}
+
+
+def id_generator(generator):
+    # Resolves the id_generator of a model to a callable, or None for keys
+    # generated by the server
+    if generator is None or callable(generator):
+        return generator
+    try:
+        return ID_GENERATORS[generator]
+    except (KeyError, TypeError):
+        raise ValueError('Unknown id generator %r, use one of %s or a callable' %
+                         (generator, ', '.join(sorted(ID_GENERATORS))))
+
+
+# Run options choosing how the driver decodes pseudo-types
+FORMAT_OPTIONS = ('time_format', 'binary_format', 'group_format')
+FORMATS = ('native', 'raw')
+
+
+def run_options(json_decoder=None, **formats):
+    # Returns the run() options reading with json_decoder (a class like
+    # rethinkdb's ReQLDecoder) and formats, leaving out the defaults
+    options = {}
+    for name, value in formats.items():
+        if name not in FORMAT_OPTIONS:
+            raise TypeError('Unknown format option %s' % name)
+        if value is None:
+            continue
+        if value not in FORMATS:
+            raise ValueError('Unknown %s %r, use one of %s' %
+                             (name, value, ', '.join(FORMATS)))
+        options[name] = value
+    if json_decoder is not None:
+        options['json_decoder'] = json_decoder
+    return options
+
+
+_pseudo_type_decoder = ReQLDecoder()
+
+
+def convert_pseudo_type(value):
+    """
+    Converts value, a TIME or BINARY pseudo-type read with the raw format,
+    as the driver does with the native one. Other values are returned as is.
+    """
+
+    if type(value) is dict and '$reql_type$' in value:
+        return _pseudo_type_decoder.convert_pseudotype(value)
+    return value
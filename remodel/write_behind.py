@@ -0,0 +1,161 @@
+import atexit
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Condition, Thread
+try:
+    from queue import Full
+except ImportError:
+    from Queue import Full
+
+from .session import write, group_by_model
+
+
+class WriteBehindQueue(object):
+    """
+    Saves objects from worker threads, so that callers don't wait for the
+    database. Saves enqueued within flush_interval of each other are written
+    together, with one insert per table plus the updates of changed objects;
+    repeated saves of an object still waiting are written once.
+
+    The queue holds at most max_size objects: save() blocks until there is
+    room, or raises queue.Full once timeout expires. Objects are written as
+    they are when their batch is taken, so avoid changing them until then.
+    """
+
+    def __init__(self, workers=2, max_size=10000, flush_interval=0.05, batch_size=1000):
+        self.workers = workers
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._cond = Condition()
+        # id(object) -> (object, futures)
+        self._pending = OrderedDict()
+        # Objects being written; saving them again waits for the next batch
+        self._in_flight = set()
+        self._threads = []
+        self._closed = False
+
+    def configure(self, workers=2, max_size=10000, flush_interval=0.05, batch_size=1000):
+        self.workers = workers
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+    def save(self, obj, timeout=None):
+        """
+        Enqueues obj to be saved and returns a concurrent.futures.Future
+        resolving to obj once written. before_save callbacks run right away,
+        after_save ones from the worker thread.
+        """
+
+        obj._run_callbacks('before_save')
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Cannot save %r: write-behind queue is closed' % obj)
+            key = id(obj)
+            if key in self._pending:
+                self._pending[key][1].append(future)
+                return future
+            deadline = None if timeout is None else time.time() + timeout
+            while len(self._pending) >= self.max_size:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise Full('Write-behind queue is full')
+                self._cond.wait(remaining)
+            self._pending[key] = (obj, [future])
+            self._start()
+            self._cond.notify_all()
+        return future
+
+    def close(self, timeout=None):
+        """
+        Stops accepting saves, waits for the queued ones to be written and
+        stops the workers.
+        """
+
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _start(self):
+        # Workers are started on first use, after any fork
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = Thread(target=self._work,
+                            name='remodel-write-behind-%d' % len(self._threads))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            batch = self._take()
+            if batch is None:
+                return
+            self._write(batch)
+
+    def _take(self):
+        with self._cond:
+            while True:
+                while not self._closed and not self._available():
+                    self._cond.wait()
+                if not self._closed:
+                    # Let more saves come in and coalesce
+                    deadline = time.time() + self.flush_interval
+                    remaining = self.flush_interval
+                    while not self._closed and remaining > 0:
+                        self._cond.wait(remaining)
+                        remaining = deadline - time.time()
+                keys = self._available()[:self.batch_size]
+                if keys:
+                    break
+                if self._closed:
+                    # Closed, and nothing left for this worker
+                    return None
+                # Another worker woken along took everything; wait again
+            self._in_flight.update(keys)
+            batch = [(key,) + self._pending.pop(key) for key in keys]
+            self._cond.notify_all()
+        return batch
+
+    def _available(self):
+        return [key for key in self._pending if key not in self._in_flight]
+
+    def _write(self, batch):
+        futures = dict((key, futures) for key, _, futures in batch)
+        objs = [obj for _, obj, _ in batch]
+        try:
+            failed = write([obj for obj in objs if 'id' not in obj.fields.__dict__],
+                           [obj for obj in objs if 'id' in obj.fields.__dict__], [])
+        except Exception as e:
+            failed = [(objs, e)]
+        errors = {}
+        for failed_objs, error in failed:
+            for obj in failed_objs:
+                errors[id(obj)] = error
+        saved = [obj for obj in objs if id(obj) not in errors]
+        for model_cls, model_objs in group_by_model(saved).items():
+            try:
+                model_cls._run_callbacks_many('after_save', model_objs)
+            except Exception as e:
+                for obj in model_objs:
+                    errors[id(obj)] = e
+        for obj in objs:
+            error = errors.get(id(obj))
+            for future in futures[id(obj)]:
+                if error is None:
+                    future.set_result(obj)
+                else:
+                    future.set_exception(error)
+        with self._cond:
+            self._in_flight.difference_update(key for key, _, _ in batch)
+            self._cond.notify_all()
+
+
+writer = WriteBehindQueue()
+atexit.register(writer.close)
@@ -25,8 +25,12 @@ setup(
     install_requires=[
         'rethinkdb',
         'inflection',
-        'six'
+        'six',
+        'futures; python_version < "3"'
     ],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     classifiers=[
         'Environment :: Web Environment',
         'Intended Audience :: Developers',
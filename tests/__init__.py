@@ -6,7 +6,7 @@ import unittest
 from remodel.connection import pool, get_conn
 from remodel.helpers import create_tables
 from remodel.models import Model
-from remodel.registry import model_registry, index_registry
+from remodel.registry import model_registry, index_registry, counter_registry
 
 
 def get_env_settings():
@@ -28,6 +28,7 @@ class BaseTestCase(unittest.TestCase):
     def tearDown(self):
         model_registry.clear()
         index_registry.clear()
+        counter_registry.clear()
 
 
 class DbBaseTestCase(BaseTestCase):
@@ -0,0 +1,440 @@
+import os
+import pytest
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+import rethinkdb as r
+from rethinkdb.ast import RqlBinary, RqlTzinfo
+
+from remodel.cache import (DocumentCache, IdentityMap, NegativeCache,
+                           QueryCache, SharedMemoryCache, query_cache, query_key, fcntl)
+from remodel.helpers import create_tables, create_indexes
+from remodel.models import Model
+from remodel.utils import convert_pseudo_type
+
+from . import BaseTestCase, DbBaseTestCase
+
+
+class DocumentCacheTests(BaseTestCase):
+    def setUp(self):
+        super(DocumentCacheTests, self).setUp()
+        self.cache = DocumentCache(max_size=2)
+
+    def test_get_missing(self):
+        assert self.cache.get('a') is None
+        assert self.cache.misses == 1
+
+    def test_set_get(self):
+        self.cache.set('a', {'id': 'a'})
+        assert self.cache.get('a') == {'id': 'a'}
+        assert self.cache.hits == 1
+
+    def test_get_returns_copy(self):
+        self.cache.set('a', {'id': 'a', 'tags': []})
+        self.cache.get('a')['tags'].append('x')
+        assert self.cache.get('a') == {'id': 'a', 'tags': []}
+
+    def test_least_recently_used_evicted(self):
+        self.cache.set('a', {'id': 'a'})
+        self.cache.set('b', {'id': 'b'})
+        self.cache.get('a')
+        self.cache.set('c', {'id': 'c'})
+        assert 'a' in self.cache
+        assert 'b' not in self.cache
+        assert 'c' in self.cache
+
+    def test_delete(self):
+        self.cache.set('a', {'id': 'a'})
+        self.cache.delete('a')
+        self.cache.delete('a')
+        assert 'a' not in self.cache
+
+    def test_clear(self):
+        self.cache.set('a', {'id': 'a'})
+        self.cache.clear()
+        assert len(self.cache) == 0
+
+    def test_stale_version_not_cached(self):
+        for invalidate in (lambda: self.cache.delete('a'), self.cache.clear,
+                           lambda: self.cache.set('a', {'id': 'a', 'v': 2})):
+            self.cache.clear()
+            version = self.cache.version()
+            invalidate()
+            self.cache.set('a', {'id': 'a', 'v': 1}, version)
+            assert self.cache.get('a') in (None, {'id': 'a', 'v': 2})
+
+    def test_current_version_cached(self):
+        version = self.cache.version()
+        self.cache.set('a', {'id': 'a'}, version)
+        assert self.cache.get('a') == {'id': 'a'}
+
+    def test_stats(self):
+        self.cache.set('a', {'id': 'a'})
+        self.cache.get('a')
+        self.cache.get('b')
+        assert self.cache.stats() == {'size': 1, 'max_size': 2,
+                                      'hits': 1, 'misses': 1}
+
+
+@pytest.mark.skipif(fcntl is None, reason='requires a POSIX system')
+class SharedMemoryCacheTests(BaseTestCase):
+    def setUp(self):
+        super(SharedMemoryCacheTests, self).setUp()
+        self.path = os.path.join(tempfile.gettempdir(),
+                                 'remodel-test-%s' % uuid.uuid4().hex)
+        self.cache = SharedMemoryCache('test', slots=4, slot_size=256, ways=2,
+                                       path=self.path)
+
+    def tearDown(self):
+        super(SharedMemoryCacheTests, self).tearDown()
+        self.cache.unlink()
+
+    def test_get_missing(self):
+        assert self.cache.get('a') is None
+        assert self.cache.misses == 1
+
+    def test_set_get(self):
+        self.cache.set('a', {'id': 'a', 'tags': ['x']})
+        assert self.cache.get('a') == {'id': 'a', 'tags': ['x']}
+        assert self.cache.hits == 1
+
+    def test_stale_version_not_cached(self):
+        version = self.cache.version()
+        other = SharedMemoryCache('test', slots=4, slot_size=256, ways=2, path=self.path)
+        other.delete('a')
+        other.close()
+        self.cache.set('a', {'id': 'a'}, version)
+        assert self.cache.get('a') is None
+        self.cache.set('a', {'id': 'a'}, self.cache.version())
+        assert self.cache.get('a') == {'id': 'a'}
+
+    def test_overwrite(self):
+        self.cache.set('a', {'id': 'a', 'name': 'Andrei'})
+        self.cache.set('a', {'id': 'a', 'name': 'Bob'})
+        assert self.cache.get('a') == {'id': 'a', 'name': 'Bob'}
+        assert len(self.cache) == 1
+
+    def test_shared_between_instances(self):
+        self.cache.set('a', {'id': 'a'})
+        other = SharedMemoryCache('test', slots=4, slot_size=256, ways=2,
+                                  path=self.path)
+        assert other.get('a') == {'id': 'a'}
+        other.delete('a')
+        assert 'a' not in self.cache
+        other.close()
+
+    def test_shared_with_forked_process(self):
+        pid = os.fork()
+        if pid == 0:
+            self.cache.set('a', {'id': 'a'})
+            os._exit(0)
+        os.waitpid(pid, 0)
+        assert self.cache.get('a') == {'id': 'a'}
+
+    def test_different_layout(self):
+        with pytest.raises(ValueError):
+            SharedMemoryCache('test', slots=8, slot_size=256, ways=2,
+                              path=self.path)
+
+    def test_evicts_within_capacity(self):
+        for i in range(20):
+            self.cache.set(i, {'id': i})
+        assert len(self.cache) <= 4
+        assert self.cache.get(19) == {'id': 19}
+
+    def test_oversized_not_cached(self):
+        self.cache.set('a', {'id': 'a', 'body': 'x' * 1000})
+        assert 'a' not in self.cache
+        assert self.cache.oversized == 1
+
+    def test_clear(self):
+        self.cache.set('a', {'id': 'a'})
+        self.cache.clear()
+        assert 'a' not in self.cache
+        assert len(self.cache) == 0
+
+    def test_times_and_binaries_stored_as_pseudo_types(self):
+        when = datetime(2016, 1, 2, 3, 4, 5, 500000, tzinfo=RqlTzinfo('+02:00'))
+        self.cache.set('a', {'id': 'a', 'when': when, 'data': RqlBinary(b'\x00\x01')})
+        doc = self.cache.get('a')
+        assert doc['when']['$reql_type$'] == 'TIME'
+        assert convert_pseudo_type(doc['when']) == when
+        assert convert_pseudo_type(doc['data']) == b'\x00\x01'
+
+    def test_file_accessible_to_others_rejected(self):
+        os.chmod(self.path, 0o644)
+        with pytest.raises(ValueError):
+            SharedMemoryCache('test', slots=4, slot_size=256, ways=2, path=self.path)
+
+
+class NegativeCacheTests(BaseTestCase):
+    def setUp(self):
+        super(NegativeCacheTests, self).setUp()
+        self.cache = NegativeCache(ttl=60)
+
+    def test_unknown(self):
+        assert not self.cache.is_missing('a')
+        assert self.cache.misses == 1
+
+    def test_missing_id(self):
+        self.cache.add('a')
+        assert self.cache.is_missing('a')
+        assert self.cache.hits == 1
+
+    def test_missing_kwargs(self):
+        self.cache.add(kwargs={'name': 'Andrei'})
+        assert self.cache.is_missing(kwargs={'name': 'Andrei'})
+        assert not self.cache.is_missing(kwargs={'name': 'Bob'})
+
+    def test_unhashable_kwargs_ignored(self):
+        self.cache.add(kwargs={'tags': ['x']})
+        assert not self.cache.is_missing(kwargs={'tags': ['x']})
+
+    def test_expired(self):
+        self.cache.ttl = 0.01
+        self.cache.add('a')
+        time.sleep(0.02)
+        assert not self.cache.is_missing('a')
+
+    def test_discard_matching(self):
+        self.cache.add('a')
+        self.cache.add(kwargs={'name': 'Andrei'})
+        self.cache.add(kwargs={'name': 'Andrei', 'age': 30})
+        self.cache.discard({'id': 'a', 'name': 'Andrei', 'age': 31})
+        assert not self.cache.is_missing('a')
+        assert not self.cache.is_missing(kwargs={'name': 'Andrei'})
+        assert self.cache.is_missing(kwargs={'name': 'Andrei', 'age': 30})
+
+
+class IdentityMapTests(BaseTestCase):
+    def setUp(self):
+        super(IdentityMapTests, self).setUp()
+
+        class Artist(Model):
+            pass
+        self.Artist = Artist
+        self.identity_map = IdentityMap()
+
+    def test_add_get(self):
+        a = self.Artist()
+        self.identity_map.add('a', a)
+        assert self.identity_map.get('a') is a
+
+    def test_entry_dropped_with_instance(self):
+        self.identity_map.add('a', self.Artist())
+        assert self.identity_map.get('a') is None
+
+    def test_discard(self):
+        a = self.Artist()
+        self.identity_map.add('a', a)
+        self.identity_map.discard('a')
+        assert 'a' not in self.identity_map
+
+    def test_refetch_keeps_unsaved_changes(self):
+        Artist = self.Artist
+        Artist.identity_map = self.identity_map
+        a = Artist.objects._wrap({'id': 'a', 'name': 'x', 'genre': 'rock'})
+        a['name'] = 'y'
+        assert Artist.objects._wrap({'id': 'a', 'name': 'x', 'genre': 'pop'}) is a
+        assert a['name'] == 'y'
+        assert a['genre'] == 'pop'
+        assert a.fields._changes.dirty == set([('name',)])
+
+    def test_refetch_replaces_saved_fields(self):
+        Artist = self.Artist
+        Artist.identity_map = self.identity_map
+        a = Artist.objects._wrap({'id': 'a', 'name': 'x', 'genre': 'rock'})
+        Artist.objects._wrap({'id': 'a', 'name': 'z'})
+        assert a.fields.as_dict() == {'id': 'a', 'name': 'z'}
+        assert not a.fields._changes
+
+
+class QueryCacheTests(BaseTestCase):
+    def setUp(self):
+        super(QueryCacheTests, self).setUp()
+        self.cache = QueryCache(max_size=2)
+
+    def test_get_missing(self):
+        assert self.cache.get('q') is None
+        assert self.cache.misses == 1
+
+    def test_set_get(self):
+        self.cache.set('q', ('artists',), [{'id': 'a'}], 60)
+        assert self.cache.get('q') == [{'id': 'a'}]
+        assert self.cache.hits == 1
+
+    def test_expired(self):
+        self.cache.set('q', ('artists',), [{'id': 'a'}], 0.01)
+        time.sleep(0.02)
+        assert self.cache.get('q') is None
+        assert len(self.cache) == 0
+
+    def test_invalidate_table(self):
+        self.cache.set('q1', ('artists',), [], 60)
+        self.cache.set('q2', ('artists', 'songs'), [], 60)
+        self.cache.invalidate('songs')
+        assert self.cache.get('q1') == []
+        assert self.cache.get('q2') is None
+
+    def test_stale_generation_not_cached(self):
+        generation = self.cache.generation(('artists',))
+        self.cache.invalidate('artists')
+        self.cache.set('q', ('artists',), [], 60, generation)
+        assert self.cache.get('q') is None
+
+    def test_least_recently_used_evicted(self):
+        self.cache.set('q1', ('artists',), [], 60)
+        self.cache.set('q2', ('artists',), [], 60)
+        self.cache.set('q3', ('artists',), [], 60)
+        assert self.cache.get('q1') is None
+        assert self.cache.get('q3') == []
+
+
+class QueryKeyTests(BaseTestCase):
+    def setUp(self):
+        super(QueryKeyTests, self).setUp()
+
+        class Artist(Model):
+            has_and_belongs_to_many = ('Taste', ('Genre', {'storage': 'array'}))
+        self.Artist = Artist
+
+        class Taste(Model):
+            has_and_belongs_to_many = ('Artist',)
+
+        class Genre(Model):
+            pass
+
+    def artist(self, id_):
+        artist = self.Artist()
+        artist.fields.__dict__['id'] = id_
+        return artist
+
+    def test_relation_queries_built_alike(self):
+        for field in ('tastes', 'genres'):
+            assert (query_key(self.artist('a')[field].query) ==
+                    query_key(self.artist('a')[field].query))
+            assert (query_key(self.artist('a')[field].query) !=
+                    query_key(self.artist('b')[field].query))
+
+    def test_variables_renumbered(self):
+        key = query_key(r.table('artists').map(lambda a: a.merge(
+            {'songs': r.table('songs').filter(lambda s: s['artist_id'] == a['id'])
+                                      .coerce_to('array')})))
+        assert '[69,[[2,[1]]' in key
+        assert '[69,[[2,[2]]' in key
+        assert query_key(r.table('artists').filter(lambda a: a['name'] == 'Andrei')) != \
+            query_key(r.table('artists').filter(lambda a: a['name'] == 'Bob'))
+
+
+class ModelCacheTests(DbBaseTestCase):
+    def setUp(self):
+        super(ModelCacheTests, self).setUp()
+
+        class Artist(Model):
+            cache = DocumentCache()
+            identity_map = IdentityMap()
+        self.Artist = Artist
+
+        create_tables()
+        create_indexes()
+
+    def test_save_populates_cache(self):
+        a = self.Artist.create(name='Andrei')
+        assert self.Artist.cache.get(a['id']) == a.fields.as_dict()
+
+    def test_get_served_from_cache(self):
+        a = self.Artist.create(name='Andrei')
+        self.Artist.objects.query.get(a['id']).update({'name': 'Bob'}).run()
+        assert self.Artist.get(a['id'])['name'] == 'Andrei'
+
+    def test_get_populates_cache(self):
+        a = self.Artist.create(name='Andrei')
+        self.Artist.cache.clear()
+        self.Artist.get(a['id'])
+        assert a['id'] in self.Artist.cache
+
+    def test_delete_evicts(self):
+        a = self.Artist.create(name='Andrei')
+        id_ = a['id']
+        a.delete()
+        assert id_ not in self.Artist.cache
+        assert id_ not in self.Artist.identity_map
+
+    def test_identity_map_returns_same_instance(self):
+        a = self.Artist.create(name='Andrei')
+        assert self.Artist.get(a['id']) is a
+        assert list(self.Artist.all())[0] is a
+
+
+class ModelNegativeCacheTests(DbBaseTestCase):
+    def setUp(self):
+        super(ModelNegativeCacheTests, self).setUp()
+
+        class Artist(Model):
+            negative_cache = NegativeCache()
+        self.Artist = Artist
+
+        create_tables()
+        create_indexes()
+
+    def test_miss_remembered(self):
+        assert self.Artist.get('a') is None
+        self.Artist.objects.query.insert({'id': 'a'}).run()
+        assert self.Artist.get('a') is None
+        assert self.Artist.negative_cache.hits == 1
+
+    def test_insert_discards_miss(self):
+        assert self.Artist.get('a') is None
+        assert self.Artist.get(name='Andrei') is None
+        self.Artist.create(id='a', name='Andrei')
+        assert self.Artist.get('a') is not None
+        assert self.Artist.get(name='Andrei') is not None
+
+
+class CachedObjectSetTests(DbBaseTestCase):
+    def setUp(self):
+        super(CachedObjectSetTests, self).setUp()
+
+        class Artist(Model):
+            pass
+        self.Artist = Artist
+
+        create_tables()
+        create_indexes()
+        query_cache.clear()
+
+    def test_results_cached(self):
+        self.Artist.create(name='Andrei')
+        assert len(self.Artist.filter(name='Andrei').cached()) == 1
+        self.Artist.objects.query.delete().run()
+        assert len(self.Artist.filter(name='Andrei').cached()) == 1
+
+    def test_fresh_instances(self):
+        self.Artist.create(name='Andrei')
+        a = self.Artist.all().cached()[0]
+        a['name'] = 'Bob'
+        assert self.Artist.all().cached()[0]['name'] == 'Andrei'
+
+    def test_invalidated_by_save(self):
+        self.Artist.create(name='Andrei')
+        assert len(self.Artist.all().cached()) == 1
+        self.Artist.create(name='Bob')
+        assert len(self.Artist.all().cached()) == 2
+
+    def test_relation_query_hits(self):
+        class Taste(Model):
+            has_and_belongs_to_many = ('Band',)
+
+        class Band(Model):
+            has_and_belongs_to_many = ('Taste',)
+
+        create_tables()
+        create_indexes()
+        b = Band.create()
+        b['tastes'].add(Taste.create())
+        assert len(Band.get(b['id'])['tastes'].all().cached()) == 1
+        hits = query_cache.hits
+        assert len(Band.get(b['id'])['tastes'].all().cached()) == 1
+        assert query_cache.hits == hits + 1
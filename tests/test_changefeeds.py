@@ -0,0 +1,138 @@
+from remodel.cache import DocumentCache, IdentityMap
+from remodel.changefeeds import CacheInvalidator, LiveObjectSet
+from remodel.models import Model
+
+from . import BaseTestCase
+
+
+class CacheInvalidatorApplyTests(BaseTestCase):
+    def setUp(self):
+        super(CacheInvalidatorApplyTests, self).setUp()
+
+        class Artist(Model):
+            cache = DocumentCache()
+            identity_map = IdentityMap()
+        self.Artist = Artist
+
+        self.Artist.cache.set('a', {'id': 'a', 'name': 'Andrei'})
+
+    def test_insert_ignored(self):
+        CacheInvalidator(self.Artist).apply(
+            {'old_val': None, 'new_val': {'id': 'b', 'name': 'Bob'}})
+        assert 'b' not in self.Artist.cache
+
+    def test_update_evicts(self):
+        CacheInvalidator(self.Artist).apply(
+            {'old_val': {'id': 'a', 'name': 'Andrei'},
+             'new_val': {'id': 'a', 'name': 'Bob'}})
+        assert 'a' not in self.Artist.cache
+
+    def test_update_in_place(self):
+        CacheInvalidator(self.Artist, update=True).apply(
+            {'old_val': {'id': 'a', 'name': 'Andrei'},
+             'new_val': {'id': 'a', 'name': 'Bob'}})
+        assert self.Artist.cache.get('a') == {'id': 'a', 'name': 'Bob'}
+
+    def test_delete_evicts(self):
+        a = self.Artist()
+        self.Artist.identity_map.add('a', a)
+        CacheInvalidator(self.Artist).apply(
+            {'old_val': {'id': 'a', 'name': 'Andrei'}, 'new_val': None})
+        assert 'a' not in self.Artist.cache
+        assert 'a' not in self.Artist.identity_map
+
+    def test_identity_map_instance_updated(self):
+        a = self.Artist()
+        a.fields.__dict__.update({'id': 'a', 'name': 'Andrei'})
+        self.Artist.identity_map.add('a', a)
+        CacheInvalidator(self.Artist).apply(
+            {'old_val': {'id': 'a', 'name': 'Andrei'},
+             'new_val': {'id': 'a', 'name': 'Bob'}})
+        assert a['name'] == 'Bob'
+
+    def test_identity_map_instance_keeps_unsaved_changes(self):
+        a = self.Artist.objects._wrap({'id': 'a', 'name': 'x', 'genre': 'rock',
+                                       'tags': ['a']})
+        self.Artist.identity_map.add('a', a)
+        a['name'] = 'y'
+        a['tags'].append('b')
+        CacheInvalidator(self.Artist).apply(
+            {'old_val': {'id': 'a', 'name': 'x', 'genre': 'rock', 'tags': ['a']},
+             'new_val': {'id': 'a', 'name': 'x', 'genre': 'pop', 'tags': ['a']}})
+        assert a['name'] == 'y'
+        assert a['tags'] == ['a', 'b']
+        assert a['genre'] == 'pop'
+        changes = a.fields._changes
+        assert changes.dirty == set([('name',)])
+        assert changes.ops == {('tags',): [('append', 'b')]}
+
+    def test_flush(self):
+        CacheInvalidator(self.Artist).flush()
+        assert len(self.Artist.cache) == 0
+
+
+class LiveObjectSetApplyTests(BaseTestCase):
+    def setUp(self):
+        super(LiveObjectSetApplyTests, self).setUp()
+
+        class Artist(Model):
+            pass
+        self.Artist = Artist
+
+        self.live = LiveObjectSet(Artist.objects, Artist.objects.query,
+                                  order_by='name')
+        self.changes = []
+        self.live.subscribe(lambda old, new: self.changes.append((old, new)))
+        self.live.connected()
+        self.live.apply({'state': 'initializing'})
+        self.live.apply({'new_val': {'id': 'a', 'name': 'Zoe'}})
+        self.live.apply({'new_val': {'id': 'b', 'name': 'Andrei'}})
+
+    def names(self):
+        return [obj['name'] for obj in self.live.snapshot()]
+
+    def test_not_published_before_ready(self):
+        assert len(self.live) == 0
+        assert not self.live.wait_ready(0)
+
+    def test_published_when_ready(self):
+        self.live.apply({'state': 'ready'})
+        assert self.live.wait_ready(0)
+        assert self.names() == ['Andrei', 'Zoe']
+        assert len(self.changes) == 2
+
+    def test_insert(self):
+        self.live.apply({'state': 'ready'})
+        self.live.apply({'old_val': None, 'new_val': {'id': 'c', 'name': 'Mia'}})
+        assert self.names() == ['Andrei', 'Mia', 'Zoe']
+        old, new = self.changes[-1]
+        assert old is None
+        assert new['name'] == 'Mia'
+
+    def test_update(self):
+        self.live.apply({'state': 'ready'})
+        self.live.apply({'old_val': {'id': 'a', 'name': 'Zoe'},
+                         'new_val': {'id': 'a', 'name': 'Bob'}})
+        assert self.names() == ['Andrei', 'Bob']
+        old, new = self.changes[-1]
+        assert old['name'] == 'Zoe'
+        assert new['name'] == 'Bob'
+
+    def test_delete(self):
+        self.live.apply({'state': 'ready'})
+        self.live.apply({'old_val': {'id': 'a', 'name': 'Zoe'}, 'new_val': None})
+        assert self.names() == ['Andrei']
+        old, new = self.changes[-1]
+        assert old['name'] == 'Zoe'
+        assert new is None
+
+    def test_reconnect_reports_differences(self):
+        self.live.apply({'state': 'ready'})
+        self.live.disconnected()
+        self.live.connected()
+        self.live.apply({'new_val': {'id': 'a', 'name': 'Zoe'}})
+        self.live.apply({'state': 'ready'})
+        assert self.names() == ['Zoe']
+        old, new = self.changes[-1]
+        assert old['name'] == 'Andrei'
+        assert new is None
@@ -0,0 +1,102 @@
+import unittest
+from array import array
+
+import pytest
+
+import remodel.columns
+from remodel.columns import Columns, to_columns
+from remodel.helpers import create_tables, create_indexes
+from remodel.models import Model
+
+from . import BaseTestCase, DbBaseTestCase
+
+
+DOCS = [
+    {'id': 'a', 'name': 'Nirvana', 'albums': 3, 'tags': ['grunge']},
+    {'id': 'b', 'name': 'Pixies', 'tags': ['indie']},
+    {'id': 'c', 'name': 'Blur', 'albums': None},
+    {'id': 'd', 'name': 'Oasis', 'albums': 7},
+]
+
+
+class ChunkedTestCase(BaseTestCase):
+    def setUp(self):
+        super(ChunkedTestCase, self).setUp()
+        self.chunk_size = remodel.columns.CHUNK_SIZE
+        # Makes columns grow over several chunks
+        remodel.columns.CHUNK_SIZE = 3
+
+    def tearDown(self):
+        remodel.columns.CHUNK_SIZE = self.chunk_size
+        super(ChunkedTestCase, self).tearDown()
+
+
+@unittest.skipIf(remodel.columns.numpy is None, 'requires NumPy')
+class NumpyColumnsTests(ChunkedTestCase):
+    def test_columns(self):
+        columns = to_columns(iter(DOCS), ['name', 'albums', 'tags'], {'albums': 'i8'})
+        assert isinstance(columns, Columns)
+        assert columns['name'].dtype == object
+        assert columns['name'].tolist() == ['Nirvana', 'Pixies', 'Blur', 'Oasis']
+        assert columns['albums'].dtype == 'i8'
+        assert columns['albums'].tolist() == [3, None, None, 7]
+        assert columns['tags'].tolist() == [['grunge'], ['indie'], None, None]
+        assert set(columns.masks) == set(['albums', 'tags'])
+        assert columns.masks['albums'].tolist() == [False, True, True, False]
+
+    def test_no_missing_values(self):
+        columns = to_columns(DOCS, ['id'])
+        assert columns['id'].count() == 4
+        assert columns.masks == {}
+
+    def test_no_documents(self):
+        columns = to_columns([], ['albums'], {'albums': 'f8'})
+        assert len(columns['albums']) == 0
+
+    def test_unknown_field_dtype(self):
+        with pytest.raises(ValueError):
+            to_columns(DOCS, ['name'], {'albums': 'i8'})
+
+
+class ArrayColumnsTests(ChunkedTestCase):
+    def setUp(self):
+        super(ArrayColumnsTests, self).setUp()
+        self.numpy = remodel.columns.numpy
+        remodel.columns.numpy = None
+
+    def tearDown(self):
+        remodel.columns.numpy = self.numpy
+        super(ArrayColumnsTests, self).tearDown()
+
+    def test_columns(self):
+        columns = to_columns(DOCS, ['name', 'albums'], {'albums': 'int64'})
+        assert columns['name'] == ['Nirvana', 'Pixies', 'Blur', 'Oasis']
+        assert columns['albums'] == array('q', [3, 0, 0, 7])
+        assert columns.masks == {'albums': array('B', [0, 1, 1, 0])}
+
+    def test_typecode(self):
+        columns = to_columns(DOCS, ['albums'], {'albums': 'd'})
+        assert columns['albums'] == array('d', [3, 0, 0, 7])
+
+    def test_unknown_dtype(self):
+        with pytest.raises(ValueError):
+            to_columns(DOCS, ['albums'], {'albums': 'datetime64[s]'})
+
+
+class ObjectSetColumnsTests(DbBaseTestCase):
+    def setUp(self):
+        super(ObjectSetColumnsTests, self).setUp()
+
+        class Artist(Model):
+            pass
+        self.Artist = Artist
+
+        create_tables()
+        create_indexes()
+
+    def test_to_columns(self):
+        self.Artist.create(name='Nirvana', albums=3)
+        self.Artist.create(name='Pixies')
+        columns = self.Artist.all().to_columns(['name', 'albums'])
+        assert sorted(columns['name']) == ['Nirvana', 'Pixies']
+        assert list(columns.masks['albums']).count(True) == 1
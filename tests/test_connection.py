@@ -0,0 +1,79 @@
+import pytest
+import rethinkdb as r
+from rethinkdb.errors import RqlDriverError
+from rethinkdb.net import ReQLDecoder
+
+from remodel.connection import Connection, ConnectionPool
+
+from . import BaseTestCase
+
+
+class FakeConnection(object):
+    def __init__(self, error=None):
+        self.waited = 0
+        self.error = error
+
+    def noreply_wait(self):
+        self.waited += 1
+        if self.error is not None:
+            raise self.error
+
+
+class NoreplyWaitTests(BaseTestCase):
+    def setUp(self):
+        super(NoreplyWaitTests, self).setUp()
+        self.pool = ConnectionPool()
+
+    def test_waits_for_pending(self):
+        sent, idle = FakeConnection(), FakeConnection()
+        self.pool.q.put(sent)
+        self.pool.q.put(idle)
+        self.pool.sent_noreply(sent)
+        self.pool.noreply_wait()
+        assert sent.waited == 1
+        assert idle.waited == 0
+        # Connections are put back
+        assert self.pool.q.qsize() == 2
+        self.pool.noreply_wait()
+        assert sent.waited == 1
+
+    def test_error(self):
+        conn = FakeConnection(RqlDriverError('Connection is closed.'))
+        self.pool.q.put(conn)
+        self.pool.sent_noreply(conn)
+        with pytest.raises(RqlDriverError):
+            self.pool.noreply_wait()
+        assert self.pool.q.qsize() == 1
+
+    def test_error_handler(self):
+        errors = []
+        self.pool.configure(noreply_error_handler=errors.append)
+        conn = FakeConnection(RqlDriverError('Connection is closed.'))
+        self.pool.q.put(conn)
+        self.pool.sent_noreply(conn)
+        self.pool.noreply_wait()
+        assert errors == [conn.error]
+
+
+class ConnectionTests(BaseTestCase):
+    def connect_kwargs(self, **kwargs):
+        calls = []
+        connect = r.connect
+        r.connect = lambda **connect_kwargs: calls.append(connect_kwargs)
+        try:
+            Connection(**kwargs).connect()
+        finally:
+            r.connect = connect
+        return calls[0]
+
+    def test_default_codecs(self):
+        kwargs = self.connect_kwargs()
+        assert 'json_decoder' not in kwargs
+        assert 'json_encoder' not in kwargs
+
+    def test_json_decoder(self):
+        class Decoder(ReQLDecoder):
+            pass
+        kwargs = self.connect_kwargs(json_decoder=Decoder)
+        assert kwargs['json_decoder'] is Decoder
+        assert 'json_encoder' not in kwargs
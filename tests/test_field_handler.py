@@ -1,11 +1,13 @@
 import pytest
 import unittest
 
+from remodel.field_handler import split_options
 from remodel.helpers import create_tables, create_indexes
 from remodel.models import Model
-from remodel.registry import index_registry
+from remodel.registry import index_registry, counter_registry
 from remodel.related import (HasOneDescriptor, BelongsToDescriptor,
-                             HasManyDescriptor, HasAndBelongsToManyDescriptor)
+                             HasManyDescriptor, HasAndBelongsToManyDescriptor,
+                             HasAndBelongsToManyArrayDescriptor)
 
 from . import BaseTestCase, DbBaseTestCase
 
@@ -134,6 +136,74 @@ class AttributesTests(BaseTestCase):
         assert fhcls.related == set(['bio', 'person', 'songs', 'tastes'])
 
 
+class RelationOptionsTests(BaseTestCase):
+    def test_split_options(self):
+        assert split_options('Song') == ('Song', {})
+        assert split_options(('Song', {'a': 1})) == ('Song', {'a': 1})
+        assert split_options(('Song', 'songs', 'id', 'artist_id', {'a': 1})) == (
+            ('Song', 'songs', 'id', 'artist_id'), {'a': 1})
+
+    def test_array_storage(self):
+        class Artist(Model):
+            has_and_belongs_to_many = (('Taste', {'storage': 'array'}),)
+
+        descriptor = Artist._field_handler_cls.tastes
+        assert isinstance(descriptor, HasAndBelongsToManyArrayDescriptor)
+        assert descriptor.owner == 'Artist'
+        assert descriptor.akey == 'taste_ids'
+
+    def test_array_storage_inverse(self):
+        class Taste(Model):
+            has_and_belongs_to_many = (('Artist', {'storage': 'array', 'inverse': True}),)
+
+        descriptor = Taste._field_handler_cls.artists
+        assert descriptor.owner == 'Artist'
+        assert descriptor.akey == 'taste_ids'
+
+    def test_counter_cache(self):
+        class Artist(Model):
+            has_many = (('Song', {'counter_cache': True}),
+                        ('Concert', {'counter_cache': 'gigs'}))
+
+        assert Artist._field_handler_cls.counter_fields == set(['songs_count', 'gigs'])
+        assert Artist._field_handler_cls.songs.counter_cache == 'songs_count'
+        assert counter_registry.get_for_model('Song') == [
+            {'parent': 'Artist', 'lkey': 'id', 'rkey': 'artist_id',
+             'field': 'songs_count'}]
+
+    def test_counter_cache_habtm(self):
+        class Artist(Model):
+            has_and_belongs_to_many = (('Taste', {'counter_cache': True}),)
+
+        assert Artist._field_handler_cls.counter_fields == set(['tastes_count'])
+        # Join rows are counted by the relation itself
+        assert counter_registry.get_for_model('Taste') == []
+
+    def test_on_delete(self):
+        class Artist(Model):
+            has_many = (('Song', {'on_delete': 'cascade'}),)
+            has_one = (('Bio', {'on_delete': 'nullify'}),)
+
+        assert Artist._field_handler_cls.songs.on_delete == 'cascade'
+        assert Artist._field_handler_cls.bio.on_delete == 'nullify'
+        assert Artist._has_on_delete()
+
+    def test_on_delete_unknown(self):
+        with pytest.raises(ValueError):
+            class Artist(Model):
+                has_many = (('Song', {'on_delete': 'restrict'}),)
+
+    def test_on_delete_belongs_to(self):
+        with pytest.raises(ValueError):
+            class Song(Model):
+                belongs_to = (('Artist', {'on_delete': 'cascade'}),)
+
+    def test_unknown_storage(self):
+        with pytest.raises(ValueError):
+            class Artist(Model):
+                has_and_belongs_to_many = (('Taste', {'storage': 'unknown'}),)
+
+
 class IndexesTests(BaseTestCase):
     """
     Tests whether indexes are set on the correct tables and keys
@@ -166,7 +236,22 @@ class IndexesTests(BaseTestCase):
 
         assert index_registry.get_for_model('Bear') == set()
         assert index_registry.get_for_model('Continent') == set()
-        assert index_registry.get_for_model('_BearContinent') == set(['bear_id', 'continent_id'])
+        assert index_registry.get_for_model('_BearContinent') == set(['bear_id', 'continent_id', 'bear_id_continent_id'])
+        assert index_registry.get_spec('_BearContinent', 'bear_id_continent_id') == {
+            'fields': ['bear_id', 'continent_id'], 'multi': False}
+
+    def test_has_and_belongs_to_many_array(self):
+        class Bear(Model):
+            has_and_belongs_to_many = (('Continent', {'storage': 'array'}),)
+
+        class Continent(Model):
+            has_and_belongs_to_many = (('Bear', {'storage': 'array', 'inverse': True}),)
+
+        assert index_registry.get_for_model('Bear') == set(['continent_ids'])
+        assert index_registry.get_spec('Bear', 'continent_ids') == {
+            'fields': None, 'multi': True}
+        assert index_registry.get_for_model('Continent') == set()
+        assert '_BearContinent' not in index_registry.all()
 
     def test_all_relations(self):
         class Bear(Model):
@@ -180,7 +265,9 @@ class IndexesTests(BaseTestCase):
         assert index_registry.get_for_model('Family') == set()
         assert index_registry.get_for_model('Cub') == set(['bear_id'])
         assert index_registry.get_for_model('Continent') == set()
-        assert index_registry.get_for_model('_BearContinent') == set(['bear_id', 'continent_id'])
+        assert index_registry.get_for_model('_BearContinent') == set(['bear_id', 'continent_id', 'bear_id_continent_id'])
+        assert index_registry.get_spec('_BearContinent', 'bear_id_continent_id') == {
+            'fields': ['bear_id', 'continent_id'], 'multi': False}
 
 class AttributeAccessTests(BaseTestCase):
     """
@@ -249,3 +336,167 @@ class AsDictTests(DbBaseTestCase):
         p.save()
         a = self.Artist(person=p)
         assert a.fields.as_dict() == {'person_id': p['id']}
+
+
+class SlotFieldHandlerTests(BaseTestCase):
+    def setUp(self):
+        super(SlotFieldHandlerTests, self).setUp()
+
+        class Artist(Model):
+            has_many = ('Song',)
+        self.Artist = Artist
+
+        class Song(Model):
+            fields = ('title', 'year', 'tags', 'artist_id')
+            belongs_to = ('Artist',)
+        self.Song = Song
+
+    def load(self, **doc):
+        return self.Song.objects._wrap(doc)
+
+    def test_storage(self):
+        assert type(self.Song.objects._wrap({}).fields).__slots__ == ('id', 'title', 'year', 'tags')
+        s = self.load(id='s', title='Hey', tags=['a'], artist_id='a', genre='pop')
+        assert not hasattr(s, '__dict__')
+        # Containers, foreign keys and undeclared fields overflow
+        assert s.fields._extra == {'tags': ['a'], 'artist_id': 'a', 'genre': 'pop'}
+        assert s.fields.as_dict() == {'id': 's', 'title': 'Hey', 'tags': ['a'],
+                                      'artist_id': 'a', 'genre': 'pop'}
+
+    def test_access(self):
+        s = self.Song(title='Hey', genre='pop')
+        assert s['title'] == 'Hey'
+        assert s['genre'] == 'pop'
+        assert 'year' not in s
+        with pytest.raises(KeyError):
+            s['year']
+        del s['title']
+        assert 'title' not in s
+        with pytest.raises(KeyError):
+            del s['title']
+        s['title'] = ['Hey', 'Jude']
+        assert s['title'] == ['Hey', 'Jude']
+        s['title'] = 'Hey'
+        assert s.fields.as_dict() == {'title': 'Hey', 'genre': 'pop'}
+
+    def test_load_keeps_after_init_fields(self):
+        class Album(Model):
+            fields = ('title', 'tracks')
+
+            def after_init(self):
+                self['tracks'] = []
+                self['format'] = 'lp'
+
+        a = Album.objects._wrap({'id': 'a', 'title': 'Help', 'tracks': ['Help']})
+        assert a.fields.as_dict() == {'id': 'a', 'title': 'Help', 'tracks': ['Help'],
+                                      'format': 'lp'}
+        assert not a.fields._changes
+
+    def test_restricted(self):
+        s = self.load(id='s', artist_id='a')
+        with pytest.raises(KeyError):
+            s['artist_id']
+        with pytest.raises(KeyError):
+            s['artist_id'] = 'b'
+        assert s.fields.__dict__['artist_id'] == 'a'
+
+    def test_dict_view(self):
+        s = self.load(id='s', title='Hey', tags=[])
+        fields = s.fields.__dict__
+        assert set(fields) == set(['id', 'title', 'tags', '_changes'])
+        fields['year'] = 2000
+        fields.pop('title')
+        assert s.fields.as_dict() == {'id': 's', 'year': 2000, 'tags': []}
+        s.fields.__dict__ = {'id': 't'}
+        assert s.fields.as_dict() == {'id': 't'}
+        assert '_changes' not in s.fields.__dict__
+
+    def test_tracking(self):
+        s = self.load(id='s', title='Hey', year=2000, tags=['a'], genre='pop')
+        s['tags'].append('b')
+        s['year'] = 2001
+        del s['genre']
+        changes = s.fields._changes
+        assert changes.dirty == set([('year',), ('genre',)])
+        assert changes.ops == {('tags',): [('append', 'b')]}
+        s.fields._overwrite({'id': 's', 'title': 'Hey'})
+        assert s.fields.as_dict() == {'id': 's', 'title': 'Hey'}
+        assert not s.fields._changes
+
+    def test_inherited(self):
+        class Cover(self.Song):
+            pass
+
+        c = Cover(title='Hey')
+        assert 'title' in c.fields.slot_fields
+        assert not hasattr(c, '__dict__')
+        assert c['title'] == 'Hey'
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            class Album(Model):
+                fields = ('first title',)
+        with pytest.raises(ValueError):
+            class Album(Model):
+                fields = ('as_dict',)
+        with pytest.raises(ValueError):
+            class Album(Model):
+                has_many = ('Song',)
+                fields = ('songs',)
+
+
+class RawFormatTests(BaseTestCase):
+    """
+    Tests whether times and binaries read with the raw format are converted
+    when first read
+    """
+
+    TIME = {'$reql_type$': 'TIME', 'epoch_time': 1500000000, 'timezone': '+00:00'}
+    BINARY = {'$reql_type$': 'BINARY', 'data': 'aGV5'}
+
+    def setUp(self):
+        super(RawFormatTests, self).setUp()
+
+        class Artist(Model):
+            pass
+        self.Artist = Artist
+
+        class Song(Model):
+            fields = ('title', 'released_at')
+        self.Song = Song
+
+    def test_converted_on_access(self):
+        a = self.Artist.objects._wrap({'id': 'a', 'born_at': dict(self.TIME),
+                                       'photo': dict(self.BINARY),
+                                       'home': {'$reql_type$': 'GEOMETRY', 'type': 'Point'}})
+        assert a.fields.__dict__['born_at'] == self.TIME
+        born_at = a['born_at']
+        assert born_at.year == 2017 and born_at.utcoffset().total_seconds() == 0
+        assert a['born_at'] is born_at
+        assert a['photo'] == b'hey'
+        assert a['home']['type'] == 'Point'
+        # Converting is not a change
+        assert a.fields._changes.dirty == set()
+
+    def test_converted_on_access_slots(self):
+        s = self.Song.objects._wrap({'id': 's', 'released_at': dict(self.TIME),
+                                     'recorded_at': dict(self.TIME)})
+        assert s['released_at'].year == 2017
+        # Moved to its slot once converted
+        assert 'released_at' not in s.fields._extra
+        assert s['recorded_at'].year == 2017
+        assert s.fields._changes.dirty == set()
+
+    def test_as_dict_converts(self):
+        a = self.Artist.objects._wrap({'id': 'a', 'born_at': dict(self.TIME),
+                                       'died_at': dict(self.TIME)})
+        a['born_at']
+        fields = a.fields.as_dict()
+        assert fields['born_at'] == fields['died_at'] == a['born_at']
+        assert a.fields.__dict__['died_at'] is fields['died_at']
+        assert a.fields._changes.dirty == set()
+        s = self.Song.objects._wrap({'id': 's', 'released_at': dict(self.TIME),
+                                     'recorded_at': dict(self.TIME)})
+        fields = s.fields.as_dict()
+        assert fields['released_at'] == fields['recorded_at'] == a['born_at']
+        assert s.fields._extra == {'recorded_at': fields['recorded_at']}
@@ -1,9 +1,12 @@
 import pytest
 import rethinkdb as r
+from rethinkdb.net import ReQLEncoder
 
+from remodel.connection import noreply_wait
 from remodel.errors import OperationError
 from remodel.helpers import create_tables, create_indexes
-from remodel.models import Model, before_save, after_save, before_delete, after_delete, after_init
+from remodel.models import (Model, before_save, after_save, before_delete, after_delete,
+                            after_init, before_save_many)
 from remodel.object_handler import ObjectHandler
 from remodel.registry import model_registry
 from remodel.related import (HasOneDescriptor, BelongsToDescriptor,
@@ -336,6 +339,189 @@ class SaveTests(DbBaseTestCase):
         self.assert_saved(b._table, b.fields.as_dict())
 
 
+class PartialSaveTests(DbBaseTestCase):
+    def setUp(self):
+        super(PartialSaveTests, self).setUp()
+
+        class Artist(Model):
+            pass
+        self.Artist = Artist
+
+        create_tables()
+        create_indexes()
+
+    def test_nested_changes(self):
+        self.Artist.create(id='a', meta={'labels': ['x'], 'city': 'Paris'}, name='Andrei')
+        a = self.Artist.get('a')
+        # Changed on the server meanwhile; not overwritten by the partial save
+        r.table('artists').get('a').update({'plays': 10}).run()
+        a['meta']['city'] = 'Rome'
+        a['meta']['labels'].append('y')
+        a.save()
+        doc = r.table('artists').get('a').run()
+        assert doc['meta'] == {'labels': ['x', 'y'], 'city': 'Rome'}
+        assert doc['plays'] == 10
+        assert a['plays'] == 10
+
+    def test_removed_field(self):
+        self.Artist.create(id='a', name='Andrei', meta={'a': 1, 'b': 2})
+        a = self.Artist.get('a')
+        del a['name']
+        del a['meta']['a']
+        a.save()
+        assert r.table('artists').get('a').run() == {'id': 'a', 'meta': {'b': 2}}
+
+    def test_deleted(self):
+        self.Artist.create(id='a')
+        a = self.Artist.get('a')
+        r.table('artists').get('a').delete().run()
+        a['name'] = 'Andrei'
+        with pytest.raises(OperationError):
+            a.save()
+
+
+class IdGeneratorTests(BaseTestCase):
+    def test_default(self):
+        class Artist(Model):
+            pass
+
+        assert Artist._generate_id is None
+        assert 'id' not in Artist()._fields_to_insert()
+
+    def test_named(self):
+        class Artist(Model):
+            id_generator = 'ulid'
+
+        class Song(Model):
+            id_generator = 'uuid4'
+
+        a = Artist(name='Andrei')
+        doc = a._fields_to_insert()
+        assert len(doc['id']) == 26
+        # Only kept once inserted
+        assert 'id' not in a
+        assert len(Song()._fields_to_insert()['id']) == 36
+
+    def test_callable(self):
+        class Artist(Model):
+            id_generator = lambda: 'a'
+
+        assert Artist()._fields_to_insert()['id'] == 'a'
+        assert Artist(id='b')._fields_to_insert()['id'] == 'b'
+
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            class Artist(Model):
+                id_generator = 'sequence'
+
+
+class LocalSaveTests(DbBaseTestCase):
+    def setUp(self):
+        super(LocalSaveTests, self).setUp()
+
+        class Artist(Model):
+            id_generator = 'ulid'
+            return_changes = False
+        self.Artist = Artist
+
+        class Song(Model):
+            return_changes = False
+        self.Song = Song
+
+        create_tables()
+        create_indexes()
+
+    def test_insert(self):
+        a = self.Artist.create(name='Andrei', meta={'a': 1})
+        assert len(a['id']) == 26
+        assert r.table('artists').get(a['id']).run() == a.fields.as_dict()
+        s = self.Song.create(title='Hey')
+        assert r.table('songs').get(s['id']).run() == s.fields.as_dict()
+
+    def test_update(self):
+        self.Artist.create(id='a', meta={'labels': ['x']})
+        a = self.Artist.get('a')
+        a['meta']['labels'].append('y')
+        a.save()
+        assert a['meta'] == {'labels': ['x', 'y']}
+        # Keeps tracking changes after the save
+        a['meta']['labels'].append('z')
+        a.save()
+        assert r.table('artists').get('a').run()['meta'] == {'labels': ['x', 'y', 'z']}
+
+    def test_deleted(self):
+        a = self.Artist.create()
+        r.table('artists').get(a['id']).delete().run()
+        a['name'] = 'Andrei'
+        with pytest.raises(OperationError):
+            a.save()
+
+
+class NoreplyTests(BaseTestCase):
+    def test_counter_caches(self):
+        class Artist(Model):
+            has_many = (('Song', {'counter_cache': True}),)
+
+        class Song(Model):
+            belongs_to = ('Artist',)
+            noreply = True
+
+        with pytest.raises(ValueError):
+            Song().save()
+        with pytest.raises(ValueError):
+            Song.objects._wrap({'id': 's'}).delete()
+
+    def test_on_delete(self):
+        class Artist(Model):
+            has_many = (('Song', {'on_delete': 'cascade'}),)
+
+        with pytest.raises(ValueError):
+            Artist.objects._wrap({'id': 'a'}).delete(noreply=True)
+
+    def test_insert_id(self):
+        class Artist(Model):
+            pass
+
+        query, _ = Artist(name='Andrei')._save_query(noreply=True, durability='soft')
+        insert = ReQLEncoder().encode(query)
+        assert '"durability":"soft"' in insert
+        assert '"return_changes":false' in insert
+        assert '"id":' in insert
+
+
+class NoreplySaveTests(DbBaseTestCase):
+    def setUp(self):
+        super(NoreplySaveTests, self).setUp()
+
+        class Artist(Model):
+            noreply = True
+            durability = 'soft'
+        self.Artist = Artist
+
+        create_tables()
+        create_indexes()
+
+    def test_save(self):
+        a = self.Artist.create(name='Andrei')
+        a['name'] = 'Bogdan'
+        a.save()
+        noreply_wait()
+        assert r.table('artists').get(a['id']).run() == {'id': a['id'], 'name': 'Bogdan'}
+
+    def test_delete(self):
+        a = self.Artist.create(name='Andrei')
+        id_ = a['id']
+        a.delete()
+        noreply_wait()
+        assert 'id' not in a
+        assert r.table('artists').get(id_).run() is None
+
+    def test_per_call(self):
+        a = self.Artist(name='Andrei')
+        a.save(noreply=False)
+        assert r.table('artists').get(a['id']).run()['name'] == 'Andrei'
+
+
 class DeleteTests(DbBaseTestCase):
     def setUp(self):
         super(DeleteTests, self).setUp()
@@ -365,6 +551,61 @@ class DeleteTests(DbBaseTestCase):
     # TODO: Add tests for confirming that related objects have no reference left to the deleted object
 
 
+class OnDeleteTests(DbBaseTestCase):
+    def setUp(self):
+        super(OnDeleteTests, self).setUp()
+
+        class Artist(Model):
+            has_many = (('Song', {'on_delete': 'cascade'}),
+                        ('Concert', {'on_delete': 'nullify'}))
+            has_and_belongs_to_many = (('Taste', {'on_delete': 'cascade'}),)
+        self.Artist = Artist
+
+        class Song(Model):
+            belongs_to = ('Artist',)
+            has_many = (('Verse', {'on_delete': 'cascade'}),)
+        self.Song = Song
+
+        class Verse(Model):
+            belongs_to = ('Song',)
+        self.Verse = Verse
+
+        class Concert(Model):
+            belongs_to = ('Artist',)
+        self.Concert = Concert
+
+        class Taste(Model):
+            has_and_belongs_to_many = ('Artist',)
+        self.Taste = Taste
+
+        create_tables()
+        create_indexes()
+
+    def test_cascade(self):
+        a = self.Artist.create()
+        s = self.Song.create(artist=a)
+        self.Verse.create(song=s)
+        other = self.Song.create(artist=self.Artist.create())
+        a.delete()
+        assert self.Song.get(s['id']) is None
+        assert self.Verse.count() == 0
+        assert self.Song.get(other['id']) is not None
+
+    def test_nullify(self):
+        a = self.Artist.create()
+        c = self.Concert.create(artist=a)
+        a.delete()
+        assert 'artist_id' not in self.Concert.get(c['id']).fields.__dict__
+
+    def test_habtm_links(self):
+        a = self.Artist.create()
+        t = self.Taste.create()
+        a['tastes'].add(t)
+        a.delete()
+        assert self.Taste.get(t['id']) is not None
+        assert t['artists'].count() == 0
+
+
 class GetTests(BaseTestCase):
     def setUp(self):
         super(GetTests, self).setUp()
@@ -445,6 +686,141 @@ class UpdateTests(DbBaseTestCase):
         self.assert_updated(a._table, a.fields.as_dict())
 
 
+class AtomicUpdateTests(DbBaseTestCase):
+    def setUp(self):
+        super(AtomicUpdateTests, self).setUp()
+
+        class Artist(Model):
+            pass
+        self.Artist = Artist
+
+        class Song(Model):
+            belongs_to = ('Artist',)
+        self.Song = Song
+
+        create_tables()
+        create_indexes()
+
+    def test_increment(self):
+        a = self.Artist.create(plays=1)
+        assert a.increment('plays') == 2
+        assert a.increment('plays', by=-5) == -3
+        assert a.increment('likes') == 1
+        assert a['plays'] == -3
+        assert self.Artist.get(a['id'])['plays'] == -3
+
+    def test_increment_keeps_local_changes(self):
+        a = self.Artist.create(plays=1)
+        a['name'] = 'Andrei'
+        a.increment('plays')
+        assert a['name'] == 'Andrei'
+        assert 'name' not in self.Artist.get(a['id'])
+
+    def test_append_remove_from(self):
+        a = self.Artist.create()
+        assert a.append('genres', 'rock') == ['rock']
+        assert a.append('genres', 'pop') == ['rock', 'pop']
+        assert a.remove_from('genres', 'rock') == ['pop']
+        assert self.Artist.get(a['id'])['genres'] == ['pop']
+
+    def test_update_if(self):
+        a = self.Artist.create(status='draft')
+        assert a.update_if({'status': 'draft'}, status='live') == {'status': 'live'}
+        assert a.update_if({'status': 'draft'}, status='gone') is None
+        assert a['status'] == 'live'
+        assert a.update_if(lambda doc: doc['status'].eq('live'), status='gone') == {
+            'status': 'gone'}
+
+    def test_not_saved(self):
+        with pytest.raises(OperationError):
+            self.Artist().increment('plays')
+
+    def test_deleted(self):
+        a = self.Artist.create()
+        self.Artist.objects.query.get(a['id']).delete().run()
+        with pytest.raises(OperationError):
+            a.increment('plays')
+
+    def test_restricted_field(self):
+        s = self.Song.create()
+        with pytest.raises(AttributeError):
+            s.increment('artist_id')
+
+
+class CallbackChainTests(BaseTestCase):
+    def test_inherited(self):
+        calls = []
+
+        class Base(Model):
+            @before_save
+            def check(self):
+                calls.append('check')
+
+            def before_save(self):
+                calls.append('base')
+
+        class Artist(Base):
+            @before_save
+            def own(self):
+                calls.append('own')
+
+        Artist()._run_callbacks('before_save')
+        assert calls == ['base', 'check', 'own']
+        assert Artist._callbacks['before_save'] == ['before_save', 'check', 'own']
+
+    def test_overridden(self):
+        calls = []
+
+        class Base(Model):
+            def before_save(self):
+                calls.append('base')
+
+        class Artist(Base):
+            def before_save(self):
+                calls.append('artist')
+
+        Artist()._run_callbacks('before_save')
+        assert calls == ['artist']
+
+    def test_batch(self):
+        calls = []
+
+        class Artist(Model):
+            @before_save_many
+            def enrich(cls, objs):
+                calls.append(len(objs))
+
+            def before_save(self):
+                calls.append(self)
+
+            def before_save_many(cls, objs):
+                calls.append((cls, objs))
+
+        a, b = Artist(), Artist()
+        Artist._run_callbacks_many('before_save', [a, b])
+        assert calls == [a, b, (Artist, [a, b]), 2]
+        del calls[:]
+        a._run_callbacks('before_save')
+        assert calls == [a, (Artist, [a]), 1]
+        del calls[:]
+        Artist._run_callbacks_many('before_save', [])
+        assert calls == []
+
+    def test_batch_inherited(self):
+        calls = []
+
+        class Base(Model):
+            @before_save_many
+            def enrich(cls, objs):
+                calls.append(cls)
+
+        class Artist(Base):
+            pass
+
+        Artist._run_callbacks_many('before_save', [Artist()])
+        assert calls == [Artist]
+
+
 class CallbackTests(DbBaseTestCase):
     """
     Tests whether callbacks are run and also that they are run at the desired
@@ -1,6 +1,7 @@
 import pytest
 import rethinkdb as r
 import unittest
+from rethinkdb.net import ReQLDecoder
 
 from remodel.connection import get_conn
 from remodel.errors import OperationError
@@ -318,3 +319,66 @@ class CustomQueryTests(DbBaseTestCase):
             results = list(self.Artist.order_by('name').run(conn))
         assert results[0]['name'] == 'Andrei'
         assert results[1]['name'] == 'John'
+
+
+class RunOptionsTests(BaseTestCase):
+    def setUp(self):
+        super(RunOptionsTests, self).setUp()
+
+        class Artist(Model):
+            pass
+        self.Artist = Artist
+
+        class Decoder(ReQLDecoder):
+            pass
+        self.Decoder = Decoder
+
+        class Song(Model):
+            json_decoder = Decoder
+            time_format = 'raw'
+        self.Song = Song
+
+    def test_defaults(self):
+        assert self.Artist.all().run_options == {}
+
+    def test_model_options(self):
+        assert self.Song.all().run_options == {'json_decoder': self.Decoder,
+                                               'time_format': 'raw'}
+
+    def test_formats(self):
+        artists = self.Artist.all().formats(time_format='raw', group_format='native')
+        assert artists.run_options == {'time_format': 'raw', 'group_format': 'native'}
+        assert artists.cached().read_only().run_options == artists.run_options
+        songs = self.Song.all().formats(time_format='native', binary_format='raw')
+        assert songs.run_options == {'json_decoder': self.Decoder, 'time_format': 'native',
+                                     'binary_format': 'raw'}
+        assert self.Song.all().run_options['time_format'] == 'raw'
+
+    def test_unknown_format(self):
+        with pytest.raises(ValueError):
+            self.Artist.all().formats(time_format='iso')
+
+
+class RawFormatTests(DbBaseTestCase):
+    def setUp(self):
+        super(RawFormatTests, self).setUp()
+
+        class Artist(Model):
+            time_format = 'raw'
+        self.Artist = Artist
+
+        create_tables()
+        create_indexes()
+
+    def test_get(self):
+        a = self.Artist.create(name='Nirvana', formed_at=r.epoch_time(500000000))
+        a = self.Artist.get(a['id'])
+        assert a.fields.__dict__['formed_at']['$reql_type$'] == 'TIME'
+        assert a['formed_at'].year == 1985
+
+    def test_all(self):
+        self.Artist.create(name='Nirvana', formed_at=r.epoch_time(500000000))
+        assert self.Artist.all()[0]['formed_at'].year == 1985
+        assert self.Artist.all().read_only()[0]['formed_at'].year == 1985
+        native = self.Artist.all().formats(time_format='native')[0]
+        assert native.fields.__dict__['formed_at'].year == 1985
@@ -0,0 +1,130 @@
+import pickle
+
+import pytest
+
+from remodel.helpers import create_tables, create_indexes
+from remodel.models import Model
+from remodel.records import Record, record_wrapper
+
+from . import BaseTestCase, DbBaseTestCase
+
+
+class RecordTests(BaseTestCase):
+    def setUp(self):
+        super(RecordTests, self).setUp()
+
+        class Artist(Model):
+            has_many = ('Song',)
+        self.Artist = Artist
+
+        class Song(Model):
+            pass
+        self.Song = Song
+
+        self.wrap = record_wrapper(Artist)
+
+    def test_fields(self):
+        a = self.wrap({'id': 'a', 'name': 'Nirvana'})
+        assert isinstance(a, Record)
+        assert a['name'] == 'Nirvana'
+        assert a.name == 'Nirvana'
+        assert a.get('genre') is None
+        assert 'name' in a
+        assert 'genre' not in a
+        assert sorted(a.keys()) == ['id', 'name']
+        assert a.as_dict() == {'id': 'a', 'name': 'Nirvana'}
+
+    def test_fields_named_like_methods(self):
+        a = self.wrap({'id': 'a', 'count': 3, 'keys': ['k'], 'as_dict': None})
+        assert a.count == 3
+        assert a.keys == ['k']
+        assert a.as_dict is None
+        assert a['count'] == 3
+        assert sorted(Record.keys(a)) == ['as_dict', 'count', 'id', 'keys']
+        assert a == self.wrap({'id': 'a', 'count': 3, 'keys': ['k'], 'as_dict': None})
+        assert repr(a) == '<Artist record: a>'
+        # Other records keep their methods
+        assert self.wrap({'id': 'b'}).keys() == ['id']
+
+    def test_missing_field(self):
+        a = self.wrap({'id': 'a'})
+        with pytest.raises(KeyError):
+            a['name']
+        with pytest.raises(AttributeError):
+            a.name
+
+    def test_read_only(self):
+        a = self.wrap({'id': 'a', 'name': 'Nirvana'})
+        with pytest.raises(TypeError):
+            a['name'] = 'Foo Fighters'
+        with pytest.raises(TypeError):
+            del a['name']
+        with pytest.raises(AttributeError):
+            a.name = 'Foo Fighters'
+
+    def test_shares_class_per_fields(self):
+        a = self.wrap({'id': 'a', 'name': 'Nirvana'})
+        b = self.wrap({'id': 'b', 'name': 'Pixies'})
+        c = self.wrap({'id': 'c'})
+        assert type(a) is type(b)
+        assert type(a) is not type(c)
+        assert type(a) is type(record_wrapper(self.Artist)({'id': 'd', 'name': 'Blur'}))
+
+    def test_equality(self):
+        a = self.wrap({'id': 'a', 'name': 'Nirvana'})
+        assert a == self.wrap({'name': 'Nirvana', 'id': 'a'})
+        assert a != self.wrap({'id': 'a', 'name': 'Pixies'})
+        assert a != record_wrapper(self.Song)({'id': 'a', 'name': 'Nirvana'})
+
+    def test_pickle(self):
+        a = self.wrap({'id': 'a', 'name': 'Nirvana'})
+        # Models defined here cannot be pickled, so unpickling is simulated
+        make, args = a.__reduce__()
+        b = make(args[0], pickle.loads(pickle.dumps(args[1])))
+        assert b == a
+        assert type(b) is type(a)
+
+    def test_raw_time(self):
+        time = {'$reql_type$': 'TIME', 'epoch_time': 1500000000, 'timezone': '+00:00'}
+        a = self.wrap({'id': 'a', 'formed_at': time})
+        assert a['formed_at'].year == 2017
+        assert a.as_dict()['formed_at'] == time
+
+    def test_has_no_instance_dict(self):
+        a = self.wrap({'id': 'a', 'name': 'Nirvana'})
+        assert not hasattr(a, '__dict__')
+
+
+class ReadOnlyTests(DbBaseTestCase):
+    def setUp(self):
+        super(ReadOnlyTests, self).setUp()
+
+        class Artist(Model):
+            has_many = ('Song',)
+        self.Artist = Artist
+
+        class Song(Model):
+            pass
+        self.Song = Song
+
+        create_tables()
+        create_indexes()
+
+    def test_yields_records(self):
+        self.Artist.create(name='Nirvana')
+        artists = list(self.Artist.all().read_only())
+        assert len(artists) == 1
+        assert isinstance(artists[0], Record)
+        assert artists[0]['name'] == 'Nirvana'
+
+    def test_filter(self):
+        self.Artist.create(name='Nirvana')
+        self.Artist.create(name='Pixies')
+        artists = self.Artist.filter(name='Pixies').read_only()
+        assert [a['name'] for a in artists] == ['Pixies']
+
+    def test_relations(self):
+        a = self.Artist.create(name='Nirvana')
+        self.Song.create(title='Lithium', artist=a)
+        record = list(self.Artist.all().read_only())[0]
+        assert [s['title'] for s in record['songs'].all()] == ['Lithium']
@@ -3,7 +3,7 @@ import pytest
 
 from remodel.errors import AlreadyRegisteredError
 from remodel.models import Model
-from remodel.registry import ModelRegistry, IndexRegistry
+from remodel.registry import ModelRegistry, IndexRegistry, CounterRegistry
 
 from . import BaseTestCase
 
@@ -105,6 +105,23 @@ class IndexRegistryTests(BaseTestCase):
         self.ir.unregister('Artist', 'person_id')
         assert self.ir.get_for_model('Artist') == set()
 
+    def test_register_compound(self):
+        self.ir.register('_ArtistTaste', 'artist_id_taste_id',
+                         fields=['artist_id', 'taste_id'])
+        assert self.ir.get_for_model('_ArtistTaste') == set(['artist_id_taste_id'])
+        assert self.ir.get_spec('_ArtistTaste', 'artist_id_taste_id') == {
+            'fields': ['artist_id', 'taste_id'], 'multi': False}
+
+    def test_get_spec_simple(self):
+        self.ir.register('Artist', 'person_id')
+        assert self.ir.get_spec('Artist', 'person_id') is None
+
+    def test_unregister_compound(self):
+        self.ir.register('_ArtistTaste', 'artist_id_taste_id',
+                         fields=['artist_id', 'taste_id'])
+        self.ir.unregister('_ArtistTaste', 'artist_id_taste_id')
+        assert self.ir.get_spec('_ArtistTaste', 'artist_id_taste_id') is None
+
     def test_get_all(self):
         self.ir.register('Artist', 'person_id')
         assert self.ir.all() == defaultdict(set, Artist=set(['person_id']))
@@ -113,3 +130,24 @@ class IndexRegistryTests(BaseTestCase):
         self.ir.register('Artist', 'person_id')
         self.ir.clear()
         assert self.ir._data == defaultdict(set)
+
+
+class CounterRegistryTests(BaseTestCase):
+    def setUp(self):
+        super(CounterRegistryTests, self).setUp()
+        self.cr = CounterRegistry()
+
+    def test_register(self):
+        self.cr.register('Song', 'Artist', 'id', 'artist_id', 'songs_count')
+        assert self.cr.get_for_model('Song') == [
+            {'parent': 'Artist', 'lkey': 'id', 'rkey': 'artist_id',
+             'field': 'songs_count'}]
+
+    def test_get_for_unregistered_model(self):
+        assert self.cr.get_for_model('Song') == []
+        assert 'Song' not in self.cr.all()
+
+    def test_clear(self):
+        self.cr.register('Song', 'Artist', 'id', 'artist_id', 'songs_count')
+        self.cr.clear()
+        assert self.cr.all() == defaultdict(list)
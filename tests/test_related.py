@@ -1,10 +1,15 @@
 import pytest
+import rethinkdb as r
+from rethinkdb.net import ReQLEncoder
 
+from remodel.cache import DocumentCache, IdentityMap
 from remodel.connection import get_conn
-from remodel.helpers import create_tables, create_indexes
+from remodel.helpers import create_tables, create_indexes, rebuild_counters
 from remodel.models import Model
-from remodel.related import (HasOneDescriptor, BelongsToDescriptor,
-                             HasManyDescriptor, HasAndBelongsToManyDescriptor)
+from remodel.related import (HasOneDescriptor, BelongsToDescriptor, HasManyThroughDescriptor,
+                             HasManyDescriptor, HasAndBelongsToManyDescriptor,
+                             _found_indexes)
+from remodel.tracking import ChangeSet
 
 from . import BaseTestCase, DbBaseTestCase
 
@@ -500,6 +505,69 @@ class RelatedSetTests(DbBaseTestCase):
         assert s.fields.__dict__['artist_id'] == a['id']
         assert len(a['songs'].all()) == 1
 
+    def test_add_with_saved_objects(self):
+        a = self.Artist()
+        a.save()
+        s1 = self.Song.create(name='Sandstorm')
+        s2 = self.Song()
+        a['songs'].add(s1, s2)
+        assert 'id' in s2.fields.__dict__
+        assert self.Song.get(s1['id']).fields.__dict__['artist_id'] == a['id']
+        assert self.Song.get(s2['id']).fields.__dict__['artist_id'] == a['id']
+        assert self.Song.get(s1['id'])['name'] == 'Sandstorm'
+
+    def test_add_remove_keep_unsaved_fields(self):
+        class Album(Model):
+            has_many = ('Track',)
+
+        class Track(Model):
+            belongs_to = ('Album',)
+            cache = DocumentCache()
+            identity_map = IdentityMap()
+
+            def before_save(self):
+                if 'album_id' in self.fields.__dict__:
+                    self['price'] = 999
+
+        create_tables()
+        create_indexes()
+        a = Album.create()
+        t = Track.create(name='Intro')
+        t['name'] = 'Outro'
+        a['tracks'].add(t)
+        assert t.fields.__dict__['album_id'] == a['id']
+        # Only the foreign key was written, so save callbacks didn't run
+        assert 'price' not in t
+        assert t.fields._changes.dirty == set([('name',)])
+        assert Track.cache.get(t['id']) is None
+        # Read as stored, not through the instance
+        Track.identity_map.clear()
+        stored = Track.get(t['id'])
+        assert stored.fields.__dict__['album_id'] == a['id']
+        assert stored['name'] == 'Intro'
+        assert 'price' not in stored
+        assert Track.cache.get(t['id'])['name'] == 'Intro'
+        t['name'] = 'Bonus'
+        a['tracks'].remove(t)
+        assert 'album_id' not in t.fields.__dict__
+        assert ('name',) in t.fields._changes.dirty
+        assert Track.cache.get(t['id']) is None
+
+    def test_add_same_object_twice(self):
+        a = self.Artist()
+        a.save()
+        s = self.Song()
+        a['songs'].add(s, s)
+        assert len(a['songs'].all()) == 1
+
+    def test_add_many_objects(self):
+        a = self.Artist()
+        a.save()
+        songs = [self.Song(nr=i) for i in range(2500)]
+        a['songs'].add(*songs)
+        assert a['songs'].count() == 2500
+        assert all('id' in s.fields.__dict__ for s in songs)
+
     def test_remove_with_invalid_object(self):
         a = self.Artist()
         a.save()
@@ -554,6 +622,72 @@ class RelatedSetTests(DbBaseTestCase):
         assert 'artist_id' not in self.Song.get(s2['id']).fields.__dict__
         assert len(a['songs'].all()) == 0
 
+    def test_remove_returns_count(self):
+        a = self.Artist()
+        a.save()
+        s1 = self.Song()
+        s2 = self.Song()
+        a['songs'] = [s1, s2]
+        assert a['songs'].remove(s1, s2) == 2
+
+    def test_remove_rejects_unknown_arguments(self):
+        a = self.Artist()
+        a.save()
+        s = self.Song()
+        a['songs'].add(s)
+        with pytest.raises(TypeError):
+            a['songs'].remove(s, callback=True)
+        assert s.fields.__dict__['artist_id'] == a['id']
+
+    def test_clear_returns_count(self):
+        a = self.Artist()
+        a.save()
+        a['songs'] = [self.Song(), self.Song()]
+        assert a['songs'].clear() == 2
+        assert a['songs'].clear() == 0
+
+    def test_clear_callbacks_opt_in(self):
+        saved = []
+
+        class Track(Model):
+            def after_save(self):
+                saved.append(self['id'])
+
+        class Album(Model):
+            has_many = ('Track',)
+
+        create_tables()
+        create_indexes()
+        album = Album.create()
+        album['tracks'] = [Track(), Track()]
+        del saved[:]
+        album['tracks'].clear()
+        assert saved == []
+        album['tracks'] = [Track(), Track()]
+        del saved[:]
+        album['tracks'].clear(callbacks=True)
+        assert len(saved) == 2
+
+    def test_remove_callbacks_save_fields_they_set(self):
+        class Track(Model):
+            def before_save(self):
+                self['saves'] = self.fields.__dict__.get('saves', 0) + 1
+
+        class Album(Model):
+            has_many = ('Track',)
+
+        create_tables()
+        create_indexes()
+        album = Album.create()
+        t = Track.create()
+        album['tracks'].add(t)
+        assert t['saves'] == 1
+        album['tracks'].remove(t, callbacks=True)
+        stored = Track.get(t['id'])
+        assert 'album_id' not in stored
+        assert stored['saves'] == 2
+        assert not t.fields._changes
+
     def test_custom_query_correctly_handled(self):
         a = self.Artist()
         a.save()
@@ -938,6 +1072,46 @@ class RelatedM2MSetTests(DbBaseTestCase):
         a['tastes'].remove(t)
         assert len(a['tastes'].all()) == 0
 
+    def test_remove_keeps_other_parents_links(self):
+        a1 = self.Artist()
+        a1.save()
+        a2 = self.Artist()
+        a2.save()
+        t = self.Taste()
+        t.save()
+        a1['tastes'] = [t]
+        a2['tastes'] = [t]
+        assert a1['tastes'].remove(t) == 1
+        assert len(a1['tastes'].all()) == 0
+        assert len(a2['tastes'].all()) == 1
+
+    def test_links_without_compound_index(self):
+        descriptor = self.Artist._field_handler_cls.tastes
+        table = descriptor.join_model_cls._table
+        r.table(table).index_drop(descriptor.mindex).run()
+        _found_indexes.discard((table, descriptor.mindex))
+        a = self.Artist()
+        a.save()
+        t1 = self.Taste()
+        t1.save()
+        t2 = self.Taste()
+        t2.save()
+        with pytest.warns(RuntimeWarning):
+            assert a['tastes'].add(t1, t2) == 2
+            assert a['tastes'].add(t1) == 0
+            assert a['tastes'].remove(t1) == 1
+        assert [t['id'] for t in a['tastes'].all()] == [t2['id']]
+
+    def test_add_returns_created_links(self):
+        a = self.Artist()
+        a.save()
+        t1 = self.Taste()
+        t1.save()
+        t2 = self.Taste()
+        t2.save()
+        assert a['tastes'].add(t1) == 1
+        assert a['tastes'].add(t1, t2, t2) == 1
+
     def test_clear_nothing_set(self):
         a = self.Artist()
         a.save()
@@ -965,3 +1139,381 @@ class RelatedM2MSetTests(DbBaseTestCase):
             results = list(a['tastes'].order_by('name').run(conn))
         assert results[0]['name'] == 'Classical'
         assert results[1]['name'] == 'House'
+
+
+class RelatedArraySetTests(DbBaseTestCase):
+    def setUp(self):
+        super(RelatedArraySetTests, self).setUp()
+
+        class Post(Model):
+            has_and_belongs_to_many = (('Tag', {'storage': 'array'}),)
+        self.Post = Post
+
+        class Tag(Model):
+            has_and_belongs_to_many = (('Post', {'storage': 'array', 'inverse': True}),)
+        self.Tag = Tag
+
+        create_tables()
+        create_indexes()
+
+    def test_all_nothing_set(self):
+        p = self.Post.create()
+        assert len(p['tags'].all()) == 0
+
+    def test_add(self):
+        p = self.Post.create()
+        t1 = self.Tag.create()
+        t2 = self.Tag.create()
+        assert p['tags'].add(t1, t2) == 2
+        assert p['tags'].add(t1) == 0
+        assert set(p['tag_ids']) == set([t1['id'], t2['id']])
+        assert len(p['tags'].all()) == 2
+        assert p['tags'].count() == 2
+
+    def test_add_with_unsaved_object(self):
+        p = self.Post.create()
+        with pytest.raises(ValueError):
+            p['tags'].add(self.Tag())
+
+    def test_remove(self):
+        p = self.Post.create()
+        t1 = self.Tag.create()
+        t2 = self.Tag.create()
+        p['tags'] = [t1, t2]
+        assert p['tags'].remove(t1) == 1
+        assert p['tag_ids'] == [t2['id']]
+        assert len(p['tags'].all()) == 1
+
+    def test_clear(self):
+        p = self.Post.create()
+        p['tags'] = [self.Tag.create(), self.Tag.create()]
+        assert p['tags'].clear() == 2
+        assert len(p['tags'].all()) == 0
+
+    def test_inverse_all(self):
+        p1 = self.Post.create()
+        p2 = self.Post.create()
+        t = self.Tag.create()
+        p1['tags'].add(t)
+        p2['tags'].add(t)
+        assert len(t['posts'].all()) == 2
+
+    def test_inverse_add_remove(self):
+        p = self.Post.create()
+        t = self.Tag.create()
+        assert t['posts'].add(p) == 1
+        assert p['tag_ids'] == [t['id']]
+        assert len(self.Post.get(p['id'])['tags'].all()) == 1
+        assert t['posts'].remove(p) == 1
+        assert p['tag_ids'] == []
+        assert len(t['posts'].all()) == 0
+
+    def test_inverse_clear(self):
+        t = self.Tag.create()
+        t['posts'] = [self.Post.create(), self.Post.create()]
+        assert t['posts'].clear() == 2
+        assert len(t['posts'].all()) == 0
+
+
+class CounterCacheTests(DbBaseTestCase):
+    def setUp(self):
+        super(CounterCacheTests, self).setUp()
+
+        class Artist(Model):
+            has_many = (('Song', {'counter_cache': True}),)
+            has_and_belongs_to_many = (('Taste', {'counter_cache': True}),)
+        self.Artist = Artist
+
+        class Song(Model):
+            belongs_to = ('Artist',)
+        self.Song = Song
+
+        class Taste(Model):
+            has_and_belongs_to_many = ('Artist',)
+        self.Taste = Taste
+
+        create_tables()
+        create_indexes()
+
+    def get_count(self, artist, field='songs_count'):
+        return self.Artist.get(artist['id']).get(field, 0)
+
+    def test_create_and_delete(self):
+        a = self.Artist.create()
+        s = self.Song.create(artist=a)
+        assert self.get_count(a) == 1
+        s.delete()
+        assert self.get_count(a) == 0
+
+    def test_reassign(self):
+        a1 = self.Artist.create()
+        a2 = self.Artist.create()
+        s = self.Song.create(artist=a1)
+        s['artist'] = a2
+        s.save()
+        assert self.get_count(a1) == 0
+        assert self.get_count(a2) == 1
+
+    def test_related_add_remove_clear(self):
+        a = self.Artist.create()
+        a['songs'].add(self.Song(), self.Song(), self.Song.create())
+        assert a['songs_count'] == 3
+        assert self.get_count(a) == 3
+        a['songs'].remove(a['songs'].all()[0])
+        assert self.get_count(a) == 2
+        a['songs'].clear()
+        assert a['songs_count'] == 0
+        assert self.get_count(a) == 0
+
+    def test_bulk_create(self):
+        a = self.Artist.create()
+        self.Song.bulk_create([self.Song(artist=a) for _ in range(3)])
+        assert self.get_count(a) == 3
+
+    def test_save_does_not_overwrite_counter(self):
+        a = self.Artist.create()
+        stale = self.Artist.get(a['id'])
+        self.Song.create(artist=a)
+        stale['name'] = 'Andrei'
+        stale.save()
+        assert stale['songs_count'] == 1
+
+    def test_habtm(self):
+        a = self.Artist.create()
+        t1, t2 = self.Taste.create(), self.Taste.create()
+        a['tastes'].add(t1, t2)
+        assert a['tastes_count'] == 2
+        a['tastes'].remove(t1)
+        assert self.get_count(a, 'tastes_count') == 1
+
+    def test_habtm_counters_on_both_sides(self):
+        class Album(Model):
+            has_and_belongs_to_many = (('Genre', {'counter_cache': True}),)
+
+        class Genre(Model):
+            has_and_belongs_to_many = (('Album', {'counter_cache': True}),)
+
+        create_tables()
+        create_indexes()
+        a1, a2 = Album.create(), Album.create()
+        g1, g2 = Genre.create(), Genre.create()
+        a1['genres'].add(g1, g2)
+        a2['genres'].add(g1)
+        # Instances passed along are kept current
+        assert g1['albums_count'] == 2
+        assert Genre.get(g1['id'])['albums_count'] == 2
+        assert Genre.get(g2['id'])['albums_count'] == 1
+        a1['genres'].remove(g1)
+        assert Genre.get(g1['id'])['albums_count'] == 1
+        a2['genres'].clear()
+        assert Genre.get(g1['id'])['albums_count'] == 0
+        assert Album.get(a1['id'])['genres_count'] == 1
+
+    def test_rebuild_counters(self):
+        a = self.Artist.create()
+        self.Song.create(artist=a)
+        self.Artist.objects.query.update({'songs_count': 10}).run()
+        rebuild_counters()
+        assert self.get_count(a) == 1
+        assert self.get_count(a, 'tastes_count') == 0
+
+
+class RelationCachePolicyTests(BaseTestCase):
+    def setUp(self):
+        super(RelationCachePolicyTests, self).setUp()
+
+        class Artist(Model):
+            pass
+        self.Artist = Artist
+
+        self.artist = Artist()
+        self.artist.fields.__dict__['id'] = 'a'
+
+    def create_song(self, cache='instance'):
+        class Song(Model):
+            belongs_to = (('Artist', {'cache': cache}),)
+        song = Song()
+        song.fields.__dict__['id'] = 's'
+        song['artist'] = self.artist
+        return song
+
+    def test_overwrite_keeps_cache(self):
+        s = self.create_song()
+        s.fields._overwrite({'id': 's', 'artist_id': 'a', 'name': 'Hey'})
+        assert s.fields._artist_cache is self.artist
+        assert s['name'] == 'Hey'
+
+    def test_overwrite_flushes_changed_key(self):
+        s = self.create_song()
+        s.fields._overwrite({'id': 's', 'artist_id': 'b'})
+        with pytest.raises(AttributeError):
+            s.fields._artist_cache
+
+    def test_key_saved(self):
+        s = self.create_song()
+        s.fields.__dict__['_changes'] = ChangeSet()
+        s['name'] = 'Hey'
+        s.fields.__dict__['artist_id'] = 'b'
+        s.fields._key_saved('artist_id', 'a')
+        with pytest.raises(AttributeError):
+            s.fields._artist_cache
+        assert s.fields._changes.dirty == set([('name',)])
+        s.fields._key_saved('artist_id', 'b')
+        assert s.fields.__dict__['artist_id'] == 'b'
+
+    def test_ttl_expired(self):
+        s = self.create_song(cache=0)
+        descriptor = type(s.fields).artist
+        with pytest.raises(AttributeError):
+            descriptor.get_cached(s.fields)
+
+    def test_ttl_valid(self):
+        s = self.create_song(cache=60)
+        assert type(s.fields).artist.get_cached(s.fields) is self.artist
+
+    def test_none(self):
+        s = self.create_song(cache='none')
+        with pytest.raises(AttributeError):
+            type(s.fields).artist.get_cached(s.fields)
+
+    def test_flush(self):
+        s = self.create_song(cache=60)
+        type(s.fields).artist.flush(s.fields)
+        assert '_artist_cache' not in s.fields.__dict__
+        assert '_artist_cache_expires' not in s.fields.__dict__
+
+    def test_unknown_policy(self):
+        with pytest.raises(ValueError):
+            self.create_song(cache='forever')
+
+    def test_refresh_related_unknown(self):
+        s = self.create_song()
+        with pytest.raises(KeyError):
+            s.refresh_related('album')
+
+
+class RefreshRelatedTests(DbBaseTestCase):
+    def setUp(self):
+        super(RefreshRelatedTests, self).setUp()
+
+        class Artist(Model):
+            pass
+        self.Artist = Artist
+
+        class Song(Model):
+            belongs_to = ('Artist',)
+        self.Song = Song
+
+        create_tables()
+        create_indexes()
+
+    def test_refresh_related(self):
+        a = self.Artist.create(name='Andrei')
+        s = self.Song.create(artist=a)
+        self.Artist.objects.query.update({'name': 'Bogdan'}).run()
+        assert s['artist'] is a
+        assert s.refresh_related('artist')['name'] == 'Bogdan'
+
+    def test_save_keeps_related_cache(self):
+        a = self.Artist.create()
+        s = self.Song.create(artist=a)
+        s['name'] = 'Hey'
+        s.save()
+        assert s.fields._artist_cache is a
+
+
+class HasManyThroughTests(BaseTestCase):
+    def setUp(self):
+        super(HasManyThroughTests, self).setUp()
+
+        class Recipe(Model):
+            has_many = ('SpecificSpice',)
+            has_many_through = (('Chef', 'SpecificSpice'),)
+        self.Recipe = Recipe
+
+        class Chef(Model):
+            has_many = ('SpecificSpice',)
+            has_and_belongs_to_many = ('Award',)
+        self.Chef = Chef
+
+        class SpecificSpice(Model):
+            belongs_to = ('Recipe', 'Chef')
+        self.SpecificSpice = SpecificSpice
+
+        class Award(Model):
+            has_and_belongs_to_many = ('Chef',)
+        self.Award = Award
+
+    def test_descriptor(self):
+        descriptor = self.Recipe._field_handler_cls.chefs
+        assert isinstance(descriptor, HasManyThroughDescriptor)
+        assert descriptor.through == ('SpecificSpice',)
+        assert [hop.model for hop in descriptor.hops] == ['SpecificSpice', 'Chef']
+
+    def test_single_query(self):
+        recipe = self.Recipe()
+        recipe.fields.__dict__['id'] = 'r'
+        query = ReQLEncoder().encode(recipe['chefs'].query)
+        # Every hop is an indexed join
+        assert query.count('"right"') == 2
+        assert '"index":"recipe_id"' in query
+        assert recipe['chefs']._tables() == ('recipes', 'specific_spices', 'chefs')
+
+    def test_multiple_hops(self):
+        class Menu(Model):
+            has_many_through = (('Award', ('SpecificSpice', 'Chef'), 'prizes'),)
+        descriptor = Menu._field_handler_cls.prizes
+        assert descriptor.through == ('SpecificSpice', 'Chef')
+
+    def test_unsaved_parent(self):
+        with pytest.raises(ValueError):
+            self.Recipe()['chefs']
+
+    def test_set(self):
+        recipe = self.Recipe()
+        with pytest.raises(KeyError):
+            recipe['chefs'] = []
+
+    def test_missing_relation(self):
+        class Menu(Model):
+            has_many_through = (('Chef', 'Recipe'),)
+        with pytest.raises(ValueError):
+            Menu._field_handler_cls.chefs.hops
+
+    def test_invalid_definition(self):
+        with pytest.raises(ValueError):
+            class Menu(Model):
+                has_many_through = ('Chef',)
+
+
+class HasManyThroughQueryTests(DbBaseTestCase):
+    def setUp(self):
+        super(HasManyThroughQueryTests, self).setUp()
+
+        class Recipe(Model):
+            has_many = ('SpecificSpice',)
+            has_many_through = (('Chef', 'SpecificSpice'),)
+        self.Recipe = Recipe
+
+        class Chef(Model):
+            has_many = ('SpecificSpice',)
+        self.Chef = Chef
+
+        class SpecificSpice(Model):
+            belongs_to = ('Recipe', 'Chef')
+        self.SpecificSpice = SpecificSpice
+
+        create_tables()
+        create_indexes()
+
+    def test_all(self):
+        recipe = self.Recipe.create()
+        andrei, bogdan = self.Chef.create(name='Andrei'), self.Chef.create(name='Bogdan')
+        self.SpecificSpice.create(recipe=recipe, chef=andrei, oregano=True)
+        self.SpecificSpice.create(recipe=recipe, chef=andrei, love=True)
+        self.SpecificSpice.create(recipe=recipe, chef=bogdan)
+        self.SpecificSpice.create(recipe=self.Recipe.create(), chef=self.Chef.create())
+        chefs = recipe['chefs'].all()
+        assert len(chefs) == 2
+        assert set(chef['name'] for chef in chefs) == set(['Andrei', 'Bogdan'])
+        assert recipe['chefs'].count() == 2
@@ -0,0 +1,108 @@
+import pytest
+
+from remodel.errors import OperationError
+from remodel.helpers import create_tables, create_indexes
+from remodel.models import Model
+from remodel.session import Session
+
+from . import BaseTestCase, DbBaseTestCase
+
+
+class SessionTests(BaseTestCase):
+    def setUp(self):
+        super(SessionTests, self).setUp()
+
+        class Artist(Model):
+            pass
+        self.Artist = Artist
+
+    def loaded(self, **fields):
+        return self.Artist.objects._wrap(fields)
+
+    def test_add(self):
+        session = Session()
+        new, saved = self.Artist(), self.loaded(id='a')
+        session.add(new, saved, new)
+        assert list(session._new.values()) == [new]
+        assert list(session._dirty.values()) == [saved]
+
+    def test_delete(self):
+        session = Session()
+        new, saved = self.Artist(), self.loaded(id='a')
+        session.add(new, saved)
+        session.delete(new, saved)
+        assert not session._new
+        assert not session._dirty
+        assert list(session._deleted.values()) == [saved]
+
+    def test_add_deleted(self):
+        session = Session()
+        saved = self.loaded(id='a')
+        session.delete(saved)
+        with pytest.raises(ValueError):
+            session.add(saved)
+
+    def test_flush_without_changes(self):
+        calls = []
+
+        class Song(Model):
+            def before_save(self):
+                calls.append('before')
+
+            def after_save(self):
+                calls.append('after')
+
+        with Session() as session:
+            # Nothing changed, so no query is run
+            session.add(Song.objects._wrap({'id': 's'}))
+        assert calls == ['before', 'after']
+
+    def test_exception_discards(self):
+        session = Session()
+        with pytest.raises(RuntimeError):
+            with session:
+                session.add(self.Artist())
+                raise RuntimeError()
+        assert not session._new
+
+
+class SessionFlushTests(DbBaseTestCase):
+    def setUp(self):
+        super(SessionFlushTests, self).setUp()
+
+        class Artist(Model):
+            has_many = (('Song', {'counter_cache': True}),)
+        self.Artist = Artist
+
+        class Song(Model):
+            belongs_to = ('Artist',)
+
+            def before_save(self):
+                self['title'] = self.get('title', 'untitled')
+        self.Song = Song
+
+        create_tables()
+        create_indexes()
+
+    def test_flush(self):
+        a = self.Artist.create(name='Andrei')
+        old = self.Song.create(artist=a)
+        loaded = self.Artist.get(a['id'])
+        with Session() as session:
+            loaded['name'] = 'Bogdan'
+            s1, s2 = self.Song(artist=a), self.Song(artist=a, title='Hey')
+            session.add(loaded, s1, s2)
+            session.delete(old)
+        assert s1['title'] == 'untitled'
+        assert 'id' in s1 and 'id' in s2
+        assert 'id' not in old
+        assert self.Song.count() == 2
+        assert self.Artist.get(a['id'])['name'] == 'Bogdan'
+        assert self.Artist.get(a['id'])['songs_count'] == 2
+
+    def test_error(self):
+        a = self.Artist.create()
+        session = Session()
+        session.add(self.Artist(id=a['id']))
+        with pytest.raises(OperationError):
+            session.flush()
@@ -0,0 +1,114 @@
+import copy
+import pickle
+
+import rethinkdb as r
+from rethinkdb.net import ReQLEncoder
+
+from remodel.models import Model
+from remodel.tracking import ChangeSet, TrackedDict, TrackedList, track
+
+from . import BaseTestCase
+
+
+def encode(query):
+    return ReQLEncoder().encode(query)
+
+
+class TrackTests(BaseTestCase):
+    def setUp(self):
+        super(TrackTests, self).setUp()
+        self.changes = ChangeSet()
+        self.doc = track({'a': {'b': 1, 'l': [1, {'x': 2}]}}, self.changes, ('doc',))
+
+    def test_wraps_nested(self):
+        assert isinstance(self.doc, TrackedDict)
+        assert isinstance(self.doc['a']['l'], TrackedList)
+        assert isinstance(self.doc['a']['l'][1], TrackedDict)
+        assert not self.changes
+
+    def test_set_nested_key(self):
+        self.doc['a']['b'] = 2
+        assert self.changes.dirty == set([('doc', 'a', 'b')])
+        assert encode(self.changes.update({'doc': self.doc})) == encode(
+            {'doc': {'a': {'b': r.literal(2)}}})
+
+    def test_delete_nested_key(self):
+        del self.doc['a']['b']
+        assert encode(self.changes.update({'doc': self.doc})) == encode(
+            {'doc': {'a': {'b': r.literal()}}})
+
+    def test_list_ops(self):
+        self.doc['a']['l'].append(3)
+        self.doc['a']['l'].pop(0)
+        assert self.changes.ops == {('doc', 'a', 'l'): [('append', 3), ('delete_at', 0)]}
+        assert not self.changes.dirty
+
+    def test_dict_within_list_marks_list(self):
+        self.doc['a']['l'][1]['x'] = 3
+        assert self.changes.dirty == set([('doc', 'a', 'l')])
+
+    def test_other_list_changes_mark_list(self):
+        self.doc['a']['l'].append(3)
+        self.doc['a']['l'].sort(key=str)
+        update = self.changes.update({'doc': self.doc})
+        # The whole list is sent, covering the recorded append
+        assert encode(update) == encode(
+            {'doc': {'a': {'l': r.literal([1, 3, {'x': 2}])}}})
+
+    def test_covered_paths(self):
+        self.doc['a']['b'] = 2
+        self.doc['a'] = {'c': 1}
+        self.doc['a']['c'] = 2
+        assert encode(self.changes.update({'doc': self.doc})) == encode(
+            {'doc': {'a': r.literal({'c': 2})}})
+
+    def test_exclude(self):
+        self.doc['a']['b'] = 2
+        assert self.changes.update({'doc': self.doc}, exclude=['doc']) == {}
+
+    def test_forget(self):
+        self.doc['a']['b'] = 2
+        self.changes.forget('doc')
+        assert not self.changes
+
+    def test_copies_are_plain(self):
+        assert type(copy.deepcopy(self.doc)['a']['l']) is list
+        assert type(pickle.loads(pickle.dumps(self.doc))) is dict
+        assert copy.deepcopy(self.doc) == {'a': {'b': 1, 'l': [1, {'x': 2}]}}
+
+
+class FieldTrackingTests(BaseTestCase):
+    def setUp(self):
+        super(FieldTrackingTests, self).setUp()
+
+        class Artist(Model):
+            has_many = ('Song',)
+        self.Artist = Artist
+
+        class Song(Model):
+            belongs_to = ('Artist',)
+        self.Song = Song
+
+    def test_new_objects_untracked(self):
+        a = self.Artist(meta={'a': 1})
+        assert type(a['meta']) is dict
+        assert '_changes' not in a.fields.__dict__
+
+    def test_loaded_objects_tracked(self):
+        a = self.Artist.objects._wrap({'id': '1', 'meta': {'a': 1}, 'name': 'x'})
+        assert not a.fields._changes
+        a['meta']['a'] = 2
+        a['name'] = 'y'
+        assert a.fields._changes.dirty == set([('meta', 'a'), ('name',)])
+
+    def test_relation_key_tracked(self):
+        a = self.Artist.objects._wrap({'id': '1'})
+        s = self.Song.objects._wrap({'id': '2'})
+        s['artist'] = a
+        assert s.fields._changes.dirty == set([('artist_id',)])
+
+    def test_overwrite_resets(self):
+        a = self.Artist.objects._wrap({'id': '1', 'name': 'x'})
+        a['name'] = 'y'
+        a.fields._overwrite({'id': '1', 'name': 'y'})
+        assert not a.fields._changes
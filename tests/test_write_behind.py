@@ -0,0 +1,108 @@
+import threading
+import time
+
+import pytest
+import rethinkdb as r
+
+from remodel.helpers import create_tables, create_indexes
+from remodel.models import Model
+from remodel.write_behind import WriteBehindQueue, Full
+
+from . import BaseTestCase, DbBaseTestCase
+
+
+class RecordingQueue(WriteBehindQueue):
+    def __init__(self, **kwargs):
+        super(RecordingQueue, self).__init__(**kwargs)
+        self.batches = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def _write(self, batch):
+        self.release.wait()
+        self.batches.append([obj for _, obj, _ in batch])
+        for _, obj, futures in batch:
+            for future in futures:
+                future.set_result(obj)
+        with self._cond:
+            self._in_flight.difference_update(key for key, _, _ in batch)
+            self._cond.notify_all()
+
+
+class WriteBehindQueueTests(BaseTestCase):
+    def setUp(self):
+        super(WriteBehindQueueTests, self).setUp()
+
+        class Artist(Model):
+            pass
+        self.Artist = Artist
+
+    def test_batches_and_coalesces(self):
+        queue = RecordingQueue(workers=1, flush_interval=0.05)
+        a, b = self.Artist(), self.Artist()
+        futures = [queue.save(a), queue.save(b), queue.save(a)]
+        assert [future.result(1) for future in futures] == [a, b, a]
+        assert queue.batches == [[a, b]]
+        queue.close()
+
+    def test_backpressure(self):
+        queue = RecordingQueue(workers=1, max_size=1, flush_interval=0)
+        queue.release.clear()
+        queue.save(self.Artist())
+        # Wait for the worker to take the first object
+        while queue._pending:
+            time.sleep(0.001)
+        queue.save(self.Artist())
+        with pytest.raises(Full):
+            queue.save(self.Artist(), timeout=0.01)
+        queue.release.set()
+        queue.close()
+        assert sum(len(batch) for batch in queue.batches) == 2
+
+    def test_workers_kept_alive(self):
+        started = []
+
+        class CountingQueue(RecordingQueue):
+            def _work(self):
+                started.append(threading.current_thread())
+                super(CountingQueue, self)._work()
+
+        queue = CountingQueue(workers=4, flush_interval=0.001)
+        futures = []
+        for _ in range(50):
+            futures.append(queue.save(self.Artist()))
+            time.sleep(0.001)
+        for future in futures:
+            future.result(1)
+        assert len(started) == 4
+        assert all(thread.is_alive() for thread in started)
+        queue.close()
+        assert not any(thread.is_alive() for thread in started)
+
+    def test_close_drains(self):
+        queue = RecordingQueue(workers=2, flush_interval=10)
+        futures = [queue.save(self.Artist()) for _ in range(3)]
+        queue.close()
+        assert all(future.done() for future in futures)
+        with pytest.raises(RuntimeError):
+            queue.save(self.Artist())
+
+
+class SaveAsyncTests(DbBaseTestCase):
+    def setUp(self):
+        super(SaveAsyncTests, self).setUp()
+
+        class Artist(Model):
+            pass
+        self.Artist = Artist
+
+        create_tables()
+        create_indexes()
+
+    def test_save_async(self):
+        a = self.Artist(name='Andrei')
+        assert a.save_async().result(5) is a
+        assert r.table('artists').get(a['id']).run()['name'] == 'Andrei'
+        a['name'] = 'Bogdan'
+        a.save_async().result(5)
+        assert r.table('artists').get(a['id']).run()['name'] == 'Bogdan'